@@ -0,0 +1,130 @@
+"""Admission control: per-user rate limits and per-stage concurrency limits.
+
+RateLimiter keeps a token bucket per phone number. Each message spends tokens (a voice note
+can cost more than a text) and the bucket refills at a steady rate up to a burst size, so a
+user can send a few messages in quick succession but not a continuous stream. Buckets are
+in-process: under gunicorn each worker has its own, so the limit a user sees is the
+configured one times the number of workers their messages land on.
+
+StageLimiter caps how many calls run at once in each expensive stage (transcription, the mood
+model, LLM calls, TTS). A caller waits up to max_wait for a slot and otherwise gets
+Overloaded, so under load work is shed quickly instead of piling up behind the slow stage.
+Its slots are in-process as well, so the caps apply per worker.
+Both expose their state for the metrics endpoint.
+This module has no dependency on app.py.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    """No slot in a stage became free within the wait limit"""
+
+    def __init__(self, stage):
+        super().__init__(f"{stage} is at capacity")
+        self.stage = stage
+
+
+class RateLimiter:
+    """Token bucket per key: `rate` tokens per second, holding at most `burst` tokens"""
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def allow(self, key, cost=1.0):
+        """Spend cost tokens from key's bucket.
+
+        Returns (allowed, first_refusal); first_refusal is True for the first refused message
+        since the key was last allowed, so the caller can tell the user once rather than
+        answering every message of a burst.
+        """
+        if self.rate <= 0:
+            return True, False
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self._prune(now)
+                bucket = self.buckets[key] = {'tokens': float(self.burst), 'updated': now, 'refused': False}
+            bucket['tokens'] = min(self.burst, bucket['tokens'] + (now - bucket['updated']) * self.rate)
+            bucket['updated'] = now
+            if bucket['tokens'] >= cost:
+                bucket['tokens'] -= cost
+                bucket['refused'] = False
+                return True, False
+            first_refusal = not bucket['refused']
+            bucket['refused'] = True
+            return False, first_refusal
+
+    def _prune(self, now):
+        """Forget buckets that have refilled completely; they behave exactly like new ones"""
+        full_after = self.burst / self.rate
+        for key in [key for key, bucket in self.buckets.items() if now - bucket['updated'] >= full_after]:
+            del self.buckets[key]
+
+    def state(self):
+        with self.lock:
+            now = time.monotonic()
+            # Refused last time and still short of the token a text message needs
+            limited = sum(
+                1 for bucket in self.buckets.values()
+                if bucket['refused'] and bucket['tokens'] + (now - bucket['updated']) * self.rate < 1
+            )
+            return {'tracked': len(self.buckets), 'limited': limited}
+
+
+class StageLimiter:
+    """Concurrency limit per stage name; stages without a limit (or a limit of 0) are not limited"""
+
+    def __init__(self, limits, max_wait=5.0, metrics=None):
+        self.limits = {stage: limit for stage, limit in limits.items() if limit > 0}
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.condition = threading.Condition()
+        self.inflight = {stage: 0 for stage in self.limits}
+        self.waiting = {stage: 0 for stage in self.limits}
+
+    @contextmanager
+    def slot(self, stage, max_wait=None):
+        """Hold one of the stage's slots for the duration of the block; raises Overloaded on timeout"""
+        limit = self.limits.get(stage)
+        if limit is None:
+            yield
+            return
+        deadline = time.monotonic() + (self.max_wait if max_wait is None else max_wait)
+        started = time.monotonic()
+        with self.condition:
+            self.waiting[stage] += 1
+            try:
+                while self.inflight[stage] >= limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if self.metrics:
+                            self.metrics.inc("stage_rejected_total", {"stage": stage})
+                        raise Overloaded(stage)
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting[stage] -= 1
+            self.inflight[stage] += 1
+        if self.metrics:
+            self.metrics.observe("stage_slot_wait_seconds", time.monotonic() - started, {"stage": stage})
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.inflight[stage] -= 1
+                self.condition.notify_all()
+
+    def state(self):
+        """{stage: {'limit', 'inflight', 'waiting'}}"""
+        with self.condition:
+            return {
+                stage: {'limit': limit, 'inflight': self.inflight[stage], 'waiting': self.waiting[stage]}
+                for stage, limit in self.limits.items()
+            }
@@ -22,31 +22,1227 @@ from flask import Flask, request, send_from_directory
 from pydub import AudioSegment
 from elevenlabs.client import ElevenLabs
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 from twilio.twiml.messaging_response import MessagingResponse
 import time
 import threading
 import uuid
 import json
+import base64
+import io
+import hashlib
+import socket
+import sqlite3
+import random
+import difflib
+import unicodedata
+import contextvars
+import atexit
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlparse
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from poi_store import POIStore, categories_for_query, haversine_m
+from route_planner import make_stop, plan_route, describe_route
+from vector_index import VectorIndex, create_embedder, rank_candidates
+from outbound_queue import OutboundQueue, is_transient
+from admission import Overloaded, RateLimiter, StageLimiter
+from speech_text import strip_markdown, chunk_text
 
 load_dotenv()
 elevenlabs_client = ElevenLabs()
 
 firebase_json_str = os.getenv("FIREBASE_CREDENTIALS_JSON")
-cred_dict = json.loads(firebase_json_str)
+if os.getenv("FIRESTORE_EMULATOR_HOST") and not firebase_json_str:
+    # Local Firestore emulator (development, replay benchmark): no service account needed
+    from google.auth.credentials import AnonymousCredentials
+    db = firestore.Client(project=os.getenv("FIRESTORE_PROJECT_ID", "demo-cityguide"), credentials=AnonymousCredentials())
+else:
+    cred_dict = json.loads(firebase_json_str)
+
+    if 'private_key' in cred_dict:
+            cred_dict['private_key'] = cred_dict['private_key'].replace('\\n', '\n')
+
+    cred = credentials.Certificate(cred_dict)
+    firebase_admin.initialize_app(cred)
+    db = firestore.client()
+
+# Time budgets (seconds) for external calls; each call also stops at the turn deadline
+TURN_DEADLINE_SECONDS = float(os.getenv("TURN_DEADLINE_SECONDS", "60"))
+UPSTREAM_TIMEOUTS = {
+    upstream: float(os.getenv(f"UPSTREAM_TIMEOUT_{upstream.upper()}", default))
+    for upstream, default in {
+        'gemini': "30",
+        'serpapi': "8",
+        'twilio_media': "10",
+        'twilio': "10",
+        'elevenlabs': "30",
+    }.items()
+}
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "1"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+# Calls that outlived their timeout keep a thread of the shared upstream pool busy; with this
+# many still running for one upstream, new calls to it fail fast like an open breaker
+UPSTREAM_MAX_OVERRUNNING = int(os.getenv("UPSTREAM_MAX_OVERRUNNING", "8"))
+
+# Cache shared by all gunicorn workers: "sqlite" (single node), "redis" or "none"
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite")
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", "cache.sqlite3")
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+SERP_CACHE_TTLS = {
+    'weather': int(os.getenv("SERP_CACHE_TTL_WEATHER", "900")),
+    'events': int(os.getenv("SERP_CACHE_TTL_EVENTS", "21600")),
+    'news': int(os.getenv("SERP_CACHE_TTL_NEWS", "1800")),
+    'places': int(os.getenv("SERP_CACHE_TTL_PLACES", "86400")),
+}
+TTS_CACHE_TTL = int(os.getenv("TTS_CACHE_TTL", "86400"))
+# TTS preparation (see speech_text.py): markdown is stripped, the text is split at sentence
+# boundaries into chunks of up to TTS_CHUNK_CHARS, and at most TTS_CONCURRENCY chunks (across
+# all replies) are synthesized at once. Spoken text longer than TTS_SUMMARY_CHARS is first
+# condensed by the LLM (0 = always read the full reply).
+TTS_CHUNK_CHARS = int(os.getenv("TTS_CHUNK_CHARS", "400"))
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))
+TTS_SUMMARY_CHARS = int(os.getenv("TTS_SUMMARY_CHARS", "0"))
+# Voice note formats. ElevenLabs synthesizes into tts_format; "opus" asks for raw PCM and
+# encodes it locally to Ogg/Opus at a speech bitrate (the codec of WhatsApp voice notes), so the
+# chunks can still be joined byte-wise before encoding. The format is chosen per channel of the
+# recipient address; channels without an entry use "default".
+AUDIO_FORMATS = {
+    'opus': {'tts_format': "pcm_24000", 'sample_rate': 24000, 'bitrate': os.getenv("AUDIO_OPUS_BITRATE", "24k"), 'extension': "ogg"},
+    'mp3_low': {'tts_format': "mp3_22050_32", 'extension': "mp3"},
+    'mp3': {'tts_format': "mp3_44100_128", 'extension': "mp3"},
+}
+AUDIO_CHANNEL_FORMATS = {
+    'whatsapp': os.getenv("AUDIO_FORMAT_WHATSAPP", "opus"),
+    'default': os.getenv("AUDIO_FORMAT_DEFAULT", "mp3_low"),
+}
+
+# Background cache warming for the user's current city (see CityPrefetcher)
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+PREFETCH_MAX_PENDING = int(os.getenv("PREFETCH_MAX_PENDING", "32"))
+PREFETCH_COOLDOWN = int(os.getenv("PREFETCH_COOLDOWN", "900"))
+PREFETCH_PLACE_QUERIES = [q.strip() for q in os.getenv("PREFETCH_PLACE_QUERIES", "restaurants,tourist attractions").split(",") if q.strip()]
 
-if 'private_key' in cred_dict:
-        cred_dict['private_key'] = cred_dict['private_key'].replace('\\n', '\n')
-
-cred = credentials.Certificate(cred_dict)
-firebase_admin.initialize_app(cred)
-db = firestore.client()
-
-llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash")
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_NUMBER = os.getenv("TWILIO_NUMBER")
 TO_NUMBER = os.getenv("TO_NUMBER")
-client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=TwilioHttpClient(timeout=UPSTREAM_TIMEOUTS['twilio']))
+
+# Per-user turn scheduling (see ConversationScheduler)
+TURN_WORKERS = int(os.getenv("TURN_WORKERS", "8"))
+TURN_MERGE_MESSAGES = os.getenv("TURN_MERGE_MESSAGES", "true").lower() == "true"
+TURN_MERGE_WINDOW = float(os.getenv("TURN_MERGE_WINDOW", "0"))
+TURN_LEASE_SECONDS = int(os.getenv("TURN_LEASE_SECONDS", "120"))
+
+# Admission control (see admission.py). Each phone number has a bucket of RATE_LIMIT_BURST
+# message tokens refilled at RATE_LIMIT_PER_MINUTE (0 = no limit); a voice note costs
+# RATE_LIMIT_VOICE_COST. Both limits are per gunicorn worker process: the buckets and stage
+# slots are not shared, so a user whose webhooks land on several workers can get up to that
+# many times the rate limit, and the whole deployment runs up to workers x STAGE_LIMITS calls.
+# Each worker runs at most STAGE_LIMITS calls at once per expensive stage (0 = unlimited).
+# A turn that waits STAGE_WAIT_SECONDS for a slot, or arrives while TURN_MAX_BACKLOG
+# messages are already queued, is answered with BUSY_MESSAGE instead.
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "10"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "5"))
+RATE_LIMIT_VOICE_COST = float(os.getenv("RATE_LIMIT_VOICE_COST", "2"))
+STAGE_LIMITS = {
+    'transcription': int(os.getenv("STAGE_LIMIT_TRANSCRIPTION", "4")),
+    'mood': int(os.getenv("STAGE_LIMIT_MOOD", "2")),
+    'llm': int(os.getenv("STAGE_LIMIT_LLM", "16")),
+    'tts': int(os.getenv("STAGE_LIMIT_TTS", "8")),
+}
+STAGE_WAIT_SECONDS = float(os.getenv("STAGE_WAIT_SECONDS", "10"))
+TURN_MAX_BACKLOG = int(os.getenv("TURN_MAX_BACKLOG", "200"))
+TOOL_INPUT_RETRIES = int(os.getenv("TOOL_INPUT_RETRIES", "1"))
+
+# Deferred generation (see GenerationJobs): stories and day plans are written on a background
+# pool after a quick acknowledgement and pushed to the user when ready
+DEFERRED_GENERATION = os.getenv("DEFERRED_GENERATION", "true").lower() == "true"
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+GENERATION_DEADLINE_SECONDS = float(os.getenv("GENERATION_DEADLINE_SECONDS", "180"))
+GENERATION_LEASE_SECONDS = int(os.getenv("GENERATION_LEASE_SECONDS", "300"))
+GENERATION_MAX_ATTEMPTS = int(os.getenv("GENERATION_MAX_ATTEMPTS", "2"))
+# How often each worker looks for jobs whose lease expired (a crashed worker's) or whose result was not delivered
+GENERATION_SWEEP_SECONDS = float(os.getenv("GENERATION_SWEEP_SECONDS", "60"))
+GENERATION_AUDIO = os.getenv("GENERATION_AUDIO", "false").lower() == "true"
+# WhatsApp rejects message bodies over 1600 characters
+WHATSAPP_TEXT_LIMIT = 1500
+
+# How replies reach the user unless their profile says otherwise: "text", "audio" or "both".
+# The text is sent as soon as the agent answers; the audio follows once TTS is done.
+DEFAULT_DELIVERY_MODE = os.getenv("DEFAULT_DELIVERY_MODE", "both")
+DELIVERY_MODES = ("text", "audio", "both")
+
+# Durable outbound WhatsApp queue (see outbound_queue.py), shared by the workers on this node
+OUTBOUND_QUEUE_PATH = os.getenv("OUTBOUND_QUEUE_PATH", "outbox.sqlite3")
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "4"))
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "6"))
+OUTBOUND_RETRY_BASE = float(os.getenv("OUTBOUND_RETRY_BASE", "2"))
+OUTBOUND_DRAIN_SECONDS = float(os.getenv("OUTBOUND_DRAIN_SECONDS", "20"))
+
+# In-process user profile cache (see ProfileCache)
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "256"))
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", "900"))
+PROFILE_CACHE_LISTENERS = os.getenv("PROFILE_CACHE_LISTENERS", "true").lower() == "true"
+
+# Agent prompt: "precompiled" renders the static prompt once, "full" re-renders everything per turn
+PROMPT_MODE = os.getenv("PROMPT_MODE", "precompiled")
+# The static agent prompt (instructions and the tool catalog) is kept in a Gemini context cache
+# per model tier. Gemini rejects caches below a per-model minimum size (GEMINI_CACHE_MIN_TOKENS,
+# counted at roughly 4 characters per token); smaller static prompts are sent inline instead
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "true").lower() == "true"
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CACHE_MIN_TOKENS", "1024"))
+
+# Local intent router that answers trivial tool requests without the LLM (see IntentRouter)
+INTENT_ROUTER = os.getenv("INTENT_ROUTER", "true").lower() == "true"
+INTENT_ROUTER_THRESHOLD = float(os.getenv("INTENT_ROUTER_THRESHOLD", "0.85"))
+
+# Local gazetteer used to map free-text locations to canonical city IDs (see LocationNormalizer)
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.json"))
+LOCATION_FUZZY_CUTOFF = float(os.getenv("LOCATION_FUZZY_CUTOFF", "0.8"))
+
+# Optional offline POI store imported from OpenStreetMap (see poi_store.py); used when the file exists
+POI_DB_PATH = os.getenv("POI_DB_PATH", "pois.sqlite3")
+POI_AREA_RADIUS = float(os.getenv("POI_AREA_RADIUS", "1500"))
+POI_CITY_RADIUS = float(os.getenv("POI_CITY_RADIUS", "8000"))
+# How far from a city's centre a named area can be and still count as in that city
+POI_CITY_EXTENT = float(os.getenv("POI_CITY_EXTENT", "40000"))
+
+# Day planner stop ordering from bookmarks and the POI store (see route_planner.py)
+ROUTE_PLANNER = os.getenv("ROUTE_PLANNER", "true").lower() == "true"
+ROUTE_MAX_STOPS = int(os.getenv("ROUTE_MAX_STOPS", "12"))
+ROUTE_TIME_BUDGET = float(os.getenv("ROUTE_TIME_BUDGET", "0.3"))
+
+# Per-user similarity index over likes, bookmarks and stories (see vector_index.py);
+# EMBEDDING_MODEL=hashing skips the model and uses hashed word features. The model is loaded
+# in the background at startup and hashed features are used until it is ready.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "numpy")
+RECOMMEND_TOP_K = int(os.getenv("RECOMMEND_TOP_K", "8"))
+
+# Span tracing of each turn (see Tracer); TRACING_OTEL mirrors spans to an OpenTelemetry SDK if installed
+TRACING_MAX_SPANS = int(os.getenv("TRACING_MAX_SPANS", "10000"))
+TRACING_OTEL = os.getenv("TRACING_OTEL", "false").lower() == "true"
+
+# LLM usage ledger (see UsageLedger): per-call token counts, flushed to Firestore in batches.
+# USAGE_DAILY_TOKEN_BUDGET caps the tokens one user may spend per UTC day (0 = no limit)
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "30"))
+USAGE_FLUSH_MAX_PENDING = int(os.getenv("USAGE_FLUSH_MAX_PENDING", "500"))
+USAGE_DAILY_TOKEN_BUDGET = int(os.getenv("USAGE_DAILY_TOKEN_BUDGET", "0"))
+# USD per million (input, output) tokens, for the cost estimate
+LLM_PRICES = {
+    'gemini-2.5-flash': (0.30, 2.50),
+    'gemini-2.5-flash-lite': (0.10, 0.40),
+    'gemini-2.5-pro': (1.25, 10.00),
+}
+# Model tiers (see ModelPolicy): each LLM call site runs on a tier, and a tier names the Gemini
+# model, its output limits and its latency SLO. A tier whose p95 breaks the SLO, or any tier
+# while too many LLM calls are in flight, is downgraded along MODEL_TIER_DOWNGRADES.
+MODEL_TIERS = {
+    tier: {
+        'model': os.getenv(f"MODEL_TIER_{tier.upper()}", model),
+        'max_output_tokens': int(os.getenv(f"MODEL_TIER_{tier.upper()}_MAX_TOKENS", max_tokens)),
+        'temperature': float(os.getenv(f"MODEL_TIER_{tier.upper()}_TEMPERATURE", temperature)),
+        'slo_seconds': float(os.getenv(f"MODEL_TIER_{tier.upper()}_SLO", slo)),
+    }
+    for tier, (model, max_tokens, temperature, slo) in {
+        'lite': ("gemini-2.5-flash-lite", "4096", "0.4", "4"),
+        'standard': ("gemini-2.5-flash", "2048", "0.7", "8"),
+        'creative': ("gemini-2.5-flash", "4096", "0.9", "20"),
+    }.items()
+}
+MODEL_TIER_DOWNGRADES = {'creative': 'standard', 'standard': 'lite'}
+# call_site:tier pairs; agent_final only restates tool output, so it runs on the lite tier
+MODEL_CALL_SITES = dict(
+    pair.strip().split(":", 1) for pair in os.getenv(
+        "MODEL_CALL_SITES",
+        "agent:standard,agent_retry:standard,agent_final:lite,bookmark_enhance:lite,"
+        "interest_suggestions:lite,poi:standard,day_planner:creative,story:creative,tts_summary:lite,"
+        "translate:lite"
+    ).split(",") if ":" in pair
+)
+MODEL_DOWNGRADE_INFLIGHT = int(os.getenv("MODEL_DOWNGRADE_INFLIGHT", "16"))
+MODEL_SLO_WINDOW = int(os.getenv("MODEL_SLO_WINDOW", "50"))
+MODEL_DOWNGRADE_COOLDOWN = float(os.getenv("MODEL_DOWNGRADE_COOLDOWN", "60"))
+
+BUDGET_EXCEEDED_MESSAGE = os.getenv(
+    "BUDGET_EXCEEDED_MESSAGE",
+    "You've reached today's limit for CityGuide. Please message me again tomorrow!"
+)
+RATE_LIMITED_MESSAGE = os.getenv(
+    "RATE_LIMITED_MESSAGE",
+    "You're sending messages faster than I can answer. Give me a minute, then try again!"
+)
+BUSY_MESSAGE = os.getenv(
+    "BUSY_MESSAGE",
+    "I'm a bit busy right now. Please try again in a minute!"
+)
+
+class Metrics:
+    """Minimal Prometheus-style registry of counters, gauges and histograms, rendered by /metrics"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, amount=1):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.DEFAULT_BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.DEFAULT_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        label_str = ",".join(f'{k}="{v}"' for k, v in tuple(labels) + tuple(extra))
+        return f"{{{label_str}}}" if label_str else ""
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append(f"{name}{self._labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.DEFAULT_BUCKETS, histogram['buckets']):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{self._labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+rate_limiter = RateLimiter(RATE_LIMIT_PER_MINUTE / 60, RATE_LIMIT_BURST)
+stage_limiter = StageLimiter(STAGE_LIMITS, STAGE_WAIT_SECONDS, metrics)
+
+
+class Span:
+    """One timed stage of a turn; fields follow the OpenTelemetry span data model"""
+
+    def __init__(self, name, trace_id, parent_span_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes or {})
+        self.status = "OK"
+        self.start_time_unix_nano = time.time_ns()
+        self.end_time_unix_nano = None
+        self._started = time.perf_counter()
+        self.duration_seconds = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self):
+        self.duration_seconds = time.perf_counter() - self._started
+        self.end_time_unix_nano = self.start_time_unix_nano + int(self.duration_seconds * 1e9)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_span_id,
+            'start_time_unix_nano': self.start_time_unix_nano,
+            'end_time_unix_nano': self.end_time_unix_nano,
+            'attributes': self.attributes,
+            'status': self.status,
+        }
+
+
+class InMemorySpanExporter:
+    """Keeps the most recent finished spans, e.g. for tests and the replay benchmark"""
+
+    def __init__(self, max_spans=10000):
+        self.lock = threading.Lock()
+        self.spans = deque(maxlen=max_spans)
+
+    def export(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def get_finished_spans(self, trace_id=None):
+        with self.lock:
+            return [span for span in self.spans if trace_id is None or span.trace_id == trace_id]
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """Span tracing keyed by a per-message trace ID.
+
+    Spans nest through a context variable, so stages inside a turn become children of the
+    turn span; work handed to another thread keeps its parent when started with
+    contextvars.copy_context().run. Every finished span is observed in the
+    stage_duration_seconds histogram and handed to the exporters.
+    """
+
+    def __init__(self, exporters=(), metrics=None, otel_tracer=None):
+        self.exporters = list(exporters)
+        self.metrics = metrics
+        self.otel_tracer = otel_tracer
+
+    @staticmethod
+    def new_trace_id():
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def current_trace_id():
+        span = _current_span.get()
+        return span.trace_id if span else None
+
+    @contextmanager
+    def span(self, name, attributes=None, trace_id=None):
+        """Time a stage; passing trace_id starts a new trace root with that ID"""
+        parent = None if trace_id else _current_span.get()
+        span = Span(name, trace_id or (parent.trace_id if parent else self.new_trace_id()),
+                    parent.span_id if parent else None, attributes)
+        token = _current_span.set(span)
+        otel_span = self.otel_tracer.start_as_current_span(name, attributes=span.attributes) if self.otel_tracer else nullcontext()
+        try:
+            with otel_span:
+                yield span
+        except Exception as e:
+            span.status = "ERROR"
+            span.set_attribute("error", type(e).__name__)
+            raise
+        finally:
+            span.end()
+            _current_span.reset(token)
+            self._export(span)
+
+    def _export(self, span):
+        if self.metrics:
+            self.metrics.observe("stage_duration_seconds", span.duration_seconds, {"stage": span.name})
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                print(f"Span export failed: {e}")
+
+
+def create_tracer():
+    otel_tracer = None
+    if TRACING_OTEL:
+        try:
+            from opentelemetry import trace as otel_trace
+            otel_tracer = otel_trace.get_tracer("cityguide")
+        except ImportError:
+            print("TRACING_OTEL is set but opentelemetry is not installed")
+    return Tracer([InMemorySpanExporter(TRACING_MAX_SPANS)], metrics, otel_tracer)
+
+
+tracer = create_tracer()
+span_exporter = tracer.exporters[0]
+
+
+def usage_from_response(response):
+    """(input, output, cached input) token counts from a langchain message or a genai response"""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return 0, 0, 0
+    if isinstance(usage, dict):
+        cached = (usage.get('input_token_details') or {}).get('cache_read', 0)
+        return usage.get('input_tokens', 0), usage.get('output_tokens', 0), cached or 0
+    return (getattr(usage, 'prompt_token_count', 0) or 0,
+            getattr(usage, 'candidates_token_count', 0) or 0,
+            getattr(usage, 'cached_content_token_count', 0) or 0)
+
+
+class UsageLedger:
+    """Token, cost and latency accounting for every LLM call.
+
+    Calls are counted in /metrics right away and aggregated in memory per user, day, call
+    site and model; a background thread adds the aggregates to Firestore (llm_usage/{day}_{user})
+    with Increment transforms, in batches, every flush interval or once enough rows are
+    pending. Per-user daily totals combine the stored document (read once per user and day)
+    with this process's calls since, which is enough to enforce a soft daily budget.
+    """
+
+    def __init__(self, db, flush_interval=30, max_pending=500, daily_budget=0):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.daily_budget = daily_budget
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = {}
+        # (user, day) -> tokens: stored total when first read, plus this process's calls since
+        self.daily_tokens = {}
+        self.wake = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def today():
+        return time.strftime("%Y-%m-%d", time.gmtime())
+
+    @staticmethod
+    def cost(model, input_tokens, output_tokens):
+        input_price, output_price = LLM_PRICES.get(model, (0.0, 0.0))
+        return (input_tokens * input_price + output_tokens * output_price) / 1e6
+
+    def record(self, call_site, model, input_tokens, output_tokens, seconds, user_id=None,
+               cached_tokens=0, ok=True):
+        labels = {"call_site": call_site, "model": model}
+        metrics.inc("llm_calls_total", {**labels, "outcome": "success" if ok else "failure"})
+        metrics.inc("llm_tokens_total", {**labels, "kind": "input"}, input_tokens)
+        metrics.inc("llm_tokens_total", {**labels, "kind": "output"}, output_tokens)
+        if cached_tokens:
+            metrics.inc("llm_tokens_total", {**labels, "kind": "cached_input"}, cached_tokens)
+        cost = self.cost(model, input_tokens, output_tokens)
+        metrics.inc("llm_cost_usd_total", labels, cost)
+        metrics.observe("llm_call_seconds", seconds, labels)
+
+        day = self.today()
+        user = user_id or "system"
+        with self.lock:
+            row = self.pending.setdefault((day, user, call_site, model), {
+                'calls': 0, 'failures': 0, 'input_tokens': 0, 'output_tokens': 0,
+                'cached_tokens': 0, 'cost_usd': 0.0, 'seconds': 0.0,
+            })
+            row['calls'] += 1
+            row['failures'] += 0 if ok else 1
+            row['input_tokens'] += input_tokens
+            row['output_tokens'] += output_tokens
+            row['cached_tokens'] += cached_tokens
+            row['cost_usd'] += cost
+            row['seconds'] += seconds
+            if (user, day) in self.daily_tokens:
+                self.daily_tokens[(user, day)] += input_tokens + output_tokens
+            pending = len(self.pending)
+        self._ensure_thread()
+        if pending >= self.max_pending:
+            self.wake.set()
+
+    def _ensure_thread(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="usage-flush", daemon=True)
+                    self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write the pending aggregates; rows that fail to write are kept for the next flush"""
+        with self.flush_lock:
+            with self.lock:
+                rows, self.pending = self.pending, {}
+            if not rows:
+                return
+            totals = {}
+            for (day, user, call_site, model), row in rows.items():
+                document = totals.setdefault((day, user), {'fields': {}, 'by_call_site': {}, 'models': set()})
+                for field, value in row.items():
+                    document['fields'][field] = document['fields'].get(field, 0) + value
+                site = document['by_call_site'].setdefault(call_site, {})
+                for field in ('calls', 'input_tokens', 'output_tokens', 'cost_usd', 'seconds'):
+                    site[field] = site.get(field, 0) + row[field]
+                document['models'].add(model)
+            documents = {
+                key: {
+                    'day': key[0],
+                    'user': key[1],
+                    **{field: firestore.Increment(value) for field, value in totals[key]['fields'].items()},
+                    'by_call_site': {
+                        call_site: {field: firestore.Increment(value) for field, value in site.items()}
+                        for call_site, site in totals[key]['by_call_site'].items()
+                    },
+                    'models': firestore.ArrayUnion(sorted(totals[key]['models'])),
+                }
+                for key in totals
+            }
+            items = list(documents.items())
+            written = 0
+            try:
+                for start in range(0, len(items), 400):
+                    batch = self.db.batch()
+                    for (day, user), document in items[start:start + 400]:
+                        document['updated_at'] = firestore.SERVER_TIMESTAMP
+                        batch.set(self.db.collection('llm_usage').document(f"{day}_{user}"), document, merge=True)
+                    with tracer.span("firestore_write", {"collection": "llm_usage", "documents": len(items[start:start + 400])}):
+                        batch.commit()
+                    written = start + 400
+                metrics.inc("usage_flushes_total", {"outcome": "success"})
+            except Exception as e:
+                print(f"Usage ledger flush failed: {e}")
+                metrics.inc("usage_flushes_total", {"outcome": "failure"})
+                unwritten = {key for key, _ in items[written:]}
+                with self.lock:
+                    for key, row in rows.items():
+                        if (key[0], key[1]) not in unwritten:
+                            continue
+                        merged = self.pending.setdefault(key, dict.fromkeys(row, 0))
+                        for field, value in row.items():
+                            merged[field] += value
+
+    def tokens_today(self, user_id):
+        day = self.today()
+        with self.lock:
+            tokens = self.daily_tokens.get((user_id, day))
+        if tokens is not None:
+            return tokens
+        try:
+            stored = self.db.collection('llm_usage').document(f"{day}_{user_id}").get()
+            data = stored.to_dict() if stored.exists else {}
+        except Exception as e:
+            print(f"Could not read usage for {user_id}: {e}")
+            return 0
+        with self.lock:
+            # Calls made here but not yet flushed are not in the stored document
+            unflushed = sum(row['input_tokens'] + row['output_tokens']
+                            for (row_day, user, _, _), row in self.pending.items()
+                            if row_day == day and user == user_id)
+            tokens = self.daily_tokens.setdefault(
+                (user_id, day), (data.get('input_tokens', 0) + data.get('output_tokens', 0) + unflushed))
+            for key in [key for key in self.daily_tokens if key[1] != day]:
+                del self.daily_tokens[key]
+        return tokens
+
+    def over_budget(self, user_id):
+        return bool(self.daily_budget and user_id) and self.tokens_today(user_id) >= self.daily_budget
+
+
+usage_ledger = UsageLedger(db, USAGE_FLUSH_INTERVAL, USAGE_FLUSH_MAX_PENDING, USAGE_DAILY_TOKEN_BUDGET)
+
+
+class ModelPolicy:
+    """Chooses the model tier for each LLM call and keeps per-tier latency and quality stats.
+
+    A call site runs on its configured tier unless that tier is degraded or the process is
+    overloaded; then it steps down the downgrade chain (creative -> standard -> lite). A tier
+    is degraded for a cooldown once the p95 of its recent calls exceeds its SLO, and after
+    the cooldown it takes traffic again with a fresh window. Quality is tracked through cheap
+    signals: failures, empty replies and replies cut off at max_output_tokens. A downgraded
+    call keeps its own tier's max_output_tokens if that is higher, so a creative itinerary
+    run on the standard model is not cut short.
+    """
+
+    def __init__(self, tiers, call_sites, downgrades, max_inflight=16, window=50, cooldown=60):
+        self.tiers = tiers
+        self.call_sites = call_sites
+        self.downgrades = downgrades
+        self.max_inflight = max_inflight
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.models = {}
+        self.inflight = 0
+        self.latencies = {tier: deque(maxlen=window) for tier in tiers}
+        self.degraded_until = {}
+        self.stats = {tier: {'calls': 0, 'failures': 0, 'empty': 0, 'truncated': 0, 'output_tokens': 0,
+                             'downgraded_to': 0, 'seconds': deque(maxlen=1000)} for tier in tiers}
+
+    def base_tier(self, call_site):
+        tier = self.call_sites.get(call_site, 'standard')
+        return tier if tier in self.tiers else 'standard'
+
+    def choose(self, call_site):
+        """Tier for the next call from call_site"""
+        tier = self.base_tier(call_site)
+        reason = "policy"
+        now = time.time()
+        with self.lock:
+            overloaded = self.inflight >= self.max_inflight
+            if overloaded and tier in self.downgrades:
+                tier, reason = self.downgrades[tier], "load"
+            while tier in self.downgrades and self.degraded_until.get(tier, 0) > now:
+                tier, reason = self.downgrades[tier], "slo"
+            if reason != "policy":
+                self.stats[tier]['downgraded_to'] += 1
+        metrics.inc("llm_tier_calls_total", {"call_site": call_site, "tier": tier, "reason": reason})
+        return tier
+
+    def output_limit(self, tier, call_site=None):
+        """max_output_tokens for a call on tier: the higher of that tier's and the call site's own tier's"""
+        limit = self.tiers[tier]['max_output_tokens']
+        if call_site is not None:
+            limit = max(limit, self.tiers[self.base_tier(call_site)]['max_output_tokens'])
+        return limit
+
+    def chat_model(self, tier, call_site=None):
+        """Shared chat model for a tier, with the tier's generation limits (see output_limit)"""
+        max_output_tokens = self.output_limit(tier, call_site)
+        with self.lock:
+            model = self.models.get((tier, max_output_tokens))
+            if model is None:
+                config = self.tiers[tier]
+                model = self.models[(tier, max_output_tokens)] = ChatGoogleGenerativeAI(
+                    model=config['model'],
+                    max_output_tokens=max_output_tokens,
+                    temperature=config['temperature'],
+                    timeout=UPSTREAM_TIMEOUTS['gemini'],
+                    max_retries=LLM_MAX_RETRIES
+                )
+        return model
+
+    def started(self):
+        with self.lock:
+            self.inflight += 1
+
+    def finished(self, tier, seconds, response=None):
+        """Record a finished call; response is None when the call failed"""
+        quality = "failure"
+        if response is not None:
+            finish_reason = str((getattr(response, 'response_metadata', None) or {}).get('finish_reason', ''))
+            if not (response.content or "").strip():
+                quality = "empty"
+            elif 'MAX_TOKENS' in finish_reason.upper():
+                quality = "truncated"
+            else:
+                quality = "ok"
+        metrics.inc("llm_tier_responses_total", {"tier": tier, "quality": quality})
+        metrics.observe("llm_tier_seconds", seconds, {"tier": tier})
+        now = time.time()
+        with self.lock:
+            self.inflight -= 1
+            stats = self.stats[tier]
+            stats['calls'] += 1
+            stats['seconds'].append(seconds)
+            if quality == "failure":
+                stats['failures'] += 1
+            elif quality in ("empty", "truncated"):
+                stats[quality] += 1
+            if response is not None:
+                stats['output_tokens'] += usage_from_response(response)[1]
+            window = self.latencies[tier]
+            window.append(seconds)
+            if len(window) >= 10 and self._p95(window) > self.tiers[tier]['slo_seconds']:
+                print(f"Model tier {tier} is over its {self.tiers[tier]['slo_seconds']}s SLO, downgrading for {self.cooldown}s")
+                self.degraded_until[tier] = now + self.cooldown
+                window.clear()
+            degraded = self.degraded_until.get(tier, 0) > now
+        metrics.set("llm_tier_degraded", int(degraded), {"tier": tier})
+
+    @staticmethod
+    def _p95(values):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+    def report(self):
+        """Per-tier latency and quality summary"""
+        now = time.time()
+        report = {}
+        with self.lock:
+            for tier, stats in self.stats.items():
+                seconds = sorted(stats['seconds'])
+                calls = stats['calls']
+                report[tier] = {
+                    'model': self.tiers[tier]['model'],
+                    'slo_seconds': self.tiers[tier]['slo_seconds'],
+                    'degraded': self.degraded_until.get(tier, 0) > now,
+                    'calls': calls,
+                    'downgraded_to': stats['downgraded_to'],
+                    'p50_seconds': seconds[len(seconds) // 2] if seconds else None,
+                    'p95_seconds': self._p95(seconds) if seconds else None,
+                    'failure_rate': stats['failures'] / calls if calls else 0.0,
+                    'empty_rate': stats['empty'] / calls if calls else 0.0,
+                    'truncated_rate': stats['truncated'] / calls if calls else 0.0,
+                    'mean_output_tokens': stats['output_tokens'] / calls if calls else 0.0,
+                }
+        return report
+
+
+model_policy = ModelPolicy(MODEL_TIERS, MODEL_CALL_SITES, MODEL_TIER_DOWNGRADES,
+                           MODEL_DOWNGRADE_INFLIGHT, MODEL_SLO_WINDOW, MODEL_DOWNGRADE_COOLDOWN)
+
+
+class DeadlineExceeded(Exception):
+    """The turn ran out of time before an external call could start"""
+
+
+class CircuitOpenError(Exception):
+    """An upstream is failing and calls are rejected until it recovers"""
+
+
+class CircuitBreaker:
+    """Per-upstream breaker: opens after consecutive failures, half-opens after a cool-down"""
+
+    STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self, upstream, failure_threshold=5, reset_seconds=30, max_overrunning=8):
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.max_overrunning = max_overrunning
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = 0
+        self.overrunning = 0
+        self.state = "closed"
+        self._export()
+
+    def _export(self):
+        metrics.set("upstream_circuit_state", self.STATE_VALUES[self.state], {"upstream": self.upstream})
+
+    def before_call(self):
+        with self.lock:
+            if self.max_overrunning and self.overrunning >= self.max_overrunning:
+                raise CircuitOpenError(f"{self.upstream} has {self.overrunning} timed-out calls still running, failing fast")
+            if self.state == "open":
+                if time.time() - self.opened_at < self.reset_seconds:
+                    raise CircuitOpenError(f"{self.upstream} is unavailable, failing fast")
+                # Let a single trial call through
+                self.state = "half_open"
+                self._export()
+            elif self.state == "half_open":
+                raise CircuitOpenError(f"{self.upstream} is recovering, failing fast")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.state = "closed"
+            self._export()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.time()
+            self._export()
+
+    def overrun_started(self):
+        with self.lock:
+            self.overrunning += 1
+            metrics.set("upstream_overrunning_calls", self.overrunning, {"upstream": self.upstream})
+
+    def overrun_finished(self, _future=None):
+        with self.lock:
+            self.overrunning -= 1
+            metrics.set("upstream_overrunning_calls", self.overrunning, {"upstream": self.upstream})
+
+
+circuit_breakers = {
+    upstream: CircuitBreaker(upstream, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS, UPSTREAM_MAX_OVERRUNNING)
+    for upstream in UPSTREAM_TIMEOUTS
+}
+_turn_deadline = threading.local()
+# Runs calls whose client library cannot take a per-call timeout
+upstream_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="upstream")
+
+
+def set_turn_deadline(seconds):
+    """Start the deadline for the turn running on this thread (None clears it)"""
+    _turn_deadline.expires_at = time.time() + seconds if seconds else None
+
+
+def remaining_budget(upstream):
+    """Seconds the next call to upstream may take: its own budget capped by the turn deadline"""
+    timeout = UPSTREAM_TIMEOUTS[upstream]
+    expires_at = getattr(_turn_deadline, 'expires_at', None)
+    if expires_at is not None:
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"turn deadline reached before calling {upstream}")
+        timeout = min(timeout, remaining)
+    return timeout
+
+
+def call_upstream(upstream, fn):
+    """Call fn(timeout) for an external service under its circuit breaker and the turn deadline"""
+    breaker = circuit_breakers[upstream]
+    try:
+        timeout = remaining_budget(upstream)
+        breaker.before_call()
+    except (DeadlineExceeded, CircuitOpenError):
+        metrics.inc("upstream_calls_total", {"upstream": upstream, "outcome": "rejected"})
+        raise
+    try:
+        result = fn(timeout)
+    except Exception as e:
+        if is_transient(e):
+            breaker.record_failure()
+            metrics.inc("upstream_calls_total", {"upstream": upstream, "outcome": "failure"})
+        else:
+            # A bad request (unknown number, quota, validation) says nothing about the upstream's health
+            breaker.record_success()
+            metrics.inc("upstream_calls_total", {"upstream": upstream, "outcome": "rejected_request"})
+        raise
+    breaker.record_success()
+    metrics.inc("upstream_calls_total", {"upstream": upstream, "outcome": "success"})
+    return result
+
+
+def run_with_timeout(fn, timeout, upstream=None):
+    """Wait at most timeout seconds for fn(); the call keeps running in the background if it overruns.
+
+    Overrunning calls are counted on the upstream's breaker until they finish, so a hung
+    upstream cannot quietly fill the shared pool.
+    """
+    future = upstream_executor.submit(contextvars.copy_context().run, fn)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        if upstream:
+            breaker = circuit_breakers[upstream]
+            breaker.overrun_started()
+            future.add_done_callback(breaker.overrun_finished)
+        raise TimeoutError(f"call did not finish within {timeout:.1f}s")
+
+
+def invoke_llm(messages, call_site, chat_model=None, tier=None):
+    """Single entry point for Gemini chat calls, tagged with the call site that made them.
+
+    The model comes from the call site's tier (see ModelPolicy); callers that pass their own
+    chat_model (the context-cached agent model) also pass the tier it belongs to.
+    """
+    tier = tier or model_policy.choose(call_site)
+    chat_model = chat_model or model_policy.chat_model(tier, call_site)
+    model = MODEL_TIERS[tier]['model']
+    user_id = user_manager.current_user_id
+    with tracer.span(f"llm.{call_site}", {"call_site": call_site, "model": model, "tier": tier}) as span, \
+            stage_limiter.slot('llm'):
+        started = time.perf_counter()
+        model_policy.started()
+        try:
+            response = call_upstream('gemini', lambda timeout: run_with_timeout(lambda: chat_model.invoke(messages), timeout, 'gemini'))
+        except Exception:
+            model_policy.finished(tier, time.perf_counter() - started)
+            usage_ledger.record(call_site, model, 0, 0, time.perf_counter() - started, user_id, ok=False)
+            raise
+        model_policy.finished(tier, time.perf_counter() - started, response)
+        input_tokens, output_tokens, cached_tokens = usage_from_response(response)
+        span.set_attribute("input_tokens", input_tokens)
+        span.set_attribute("output_tokens", output_tokens)
+        usage_ledger.record(call_site, model, input_tokens, output_tokens, time.perf_counter() - started,
+                            user_id, cached_tokens)
+        return response
+
+
+class SharedCache:
+    """Cache tier shared across gunicorn workers.
+
+    Values are JSON (bytes and datetimes are stored tagged) so every backend round-trips the
+    same types. get_or_compute() is stampede-safe: one thread per process computes a missing
+    key, and a short-lived lock key in the backend keeps other workers waiting for that result
+    instead of calling the upstream themselves. Backend errors are logged and treated as misses.
+    The base class is the no-op backend used when caching is disabled; subclasses override the
+    _get_raw/_set_raw/_add_raw/_delete primitives.
+    """
+
+    def __init__(self):
+        self.local_locks = {}
+        self.local_locks_guard = threading.Lock()
+
+    @staticmethod
+    def encode(value):
+        def default(obj):
+            if isinstance(obj, bytes):
+                return {"__bytes__": base64.b64encode(obj).decode("ascii")}
+            if isinstance(obj, datetime.datetime):
+                # Firestore timestamps come back as datetimes, not as their string form
+                return {"__datetime__": obj.isoformat()}
+            return str(obj)
+
+        return json.dumps(value, default=default)
+
+    @staticmethod
+    def decode(raw):
+        def object_hook(obj):
+            if set(obj) == {"__bytes__"}:
+                return base64.b64decode(obj["__bytes__"])
+            if set(obj) == {"__datetime__"}:
+                return datetime.datetime.fromisoformat(obj["__datetime__"])
+            return obj
+
+        return json.loads(raw, object_hook=object_hook)
+
+    @staticmethod
+    def make_key(namespace, *parts):
+        digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return f"{namespace}:{digest}"
+
+    def get(self, key):
+        try:
+            raw = self._get_raw(key)
+        except Exception as e:
+            print(f"Shared cache read failed for {key}: {e}")
+            return None
+        return self.decode(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        try:
+            self._set_raw(key, self.encode(value), ttl)
+        except Exception as e:
+            print(f"Shared cache write failed for {key}: {e}")
+
+    def delete(self, key):
+        try:
+            self._delete(key)
+        except Exception as e:
+            print(f"Shared cache delete failed for {key}: {e}")
+
+    def get_or_compute(self, key, ttl, compute, should_cache=None, lock_seconds=15):
+        """Return the cached value for key, computing and storing it at most once across workers"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self.local_locks_guard:
+            local_lock = self.local_locks.setdefault(key, threading.Lock())
+        with local_lock:
+            try:
+                value = self.get(key)
+                if value is not None:
+                    return value
+                lock_key = f"lock:{key}"
+                locked = self._try_lock(lock_key, lock_seconds)
+                if not locked:
+                    # Another worker is computing this key; wait for its result
+                    waited_until = time.time() + lock_seconds
+                    while time.time() < waited_until:
+                        time.sleep(0.1)
+                        value = self.get(key)
+                        if value is not None:
+                            return value
+                    # It gave up or is slow; take the lock if it has expired, else compute without it
+                    locked = self._try_lock(lock_key, lock_seconds)
+                try:
+                    value = compute()
+                    if value is not None and (should_cache is None or should_cache(value)):
+                        self.set(key, value, ttl)
+                    return value
+                finally:
+                    if locked:
+                        # Never release a lock another worker holds
+                        self.delete(lock_key)
+            finally:
+                with self.local_locks_guard:
+                    self.local_locks.pop(key, None)
+
+    def _try_lock(self, lock_key, lock_seconds):
+        try:
+            return self._add_raw(lock_key, "1", lock_seconds)
+        except Exception as e:
+            print(f"Shared cache lock failed for {lock_key}: {e}")
+            return True
+
+    def _get_raw(self, key):
+        return None
+
+    def _set_raw(self, key, raw, ttl):
+        pass
+
+    def _add_raw(self, key, raw, ttl):
+        """Set key only if it is absent; True when this call created it"""
+        return True
+
+    def _delete(self, key):
+        pass
+
+
+class NullCache(SharedCache):
+    """Caching disabled: every read misses and writes are dropped"""
+
+
+class SQLiteCache(SharedCache):
+    """Shared cache in a local SQLite file, for all workers on a single node"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.connections = threading.local()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _connection(self):
+        conn = getattr(self.connections, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.connections.conn = conn
+        return conn
+
+    def _get_raw(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_raw(self, key, raw, ttl):
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, raw, time.time() + ttl))
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+
+    def _add_raw(self, key, raw, ttl):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM cache WHERE key = ? AND expires_at <= ?", (key, time.time()))
+            cursor = conn.execute("INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                                  (key, raw, time.time() + ttl))
+            return cursor.rowcount == 1
+
+    def _delete(self, key):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+
+class RedisCache(SharedCache):
+    """Shared cache on any server speaking the Redis protocol (Redis, Valkey, a local stand-in)"""
+
+    def __init__(self, url, timeout=1.0):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db_index = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.reader = self.sock.makefile('rb')
+        if self.password:
+            self._send("AUTH", self.password)
+        if self.db_index:
+            self._send("SELECT", str(self.db_index))
+
+    def _send(self, *args):
+        payload = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            payload.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        self.sock.sendall(b"".join(payload))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by cache server")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b"+":
+            return rest.decode()
+        if prefix == b"-":
+            raise RuntimeError(rest.decode())
+        if prefix == b":":
+            return int(rest)
+        if prefix == b"$":
+            length = int(rest)
+            if length == -1:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2].decode("utf-8")
+        if prefix == b"*":
+            count = int(rest)
+            return None if count == -1 else [self._read_reply() for _ in range(count)]
+        raise RuntimeError(f"unexpected reply from cache server: {line!r}")
+
+    def _command(self, *args):
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    return self._send(*args)
+                except (OSError, ConnectionError):
+                    self._close()
+                    if attempt:
+                        raise
+
+    def _close(self):
+        try:
+            if self.sock:
+                self.sock.close()
+        finally:
+            self.sock = None
+            self.reader = None
+
+    def _get_raw(self, key):
+        return self._command("GET", key)
+
+    def _set_raw(self, key, raw, ttl):
+        self._command("SET", key, raw, "EX", max(1, int(ttl)))
+
+    def _add_raw(self, key, raw, ttl):
+        return self._command("SET", key, raw, "NX", "EX", max(1, int(ttl))) == "OK"
+
+    def _delete(self, key):
+        self._command("DEL", key)
+
+
+def create_shared_cache():
+    if CACHE_BACKEND == "redis":
+        return RedisCache(CACHE_REDIS_URL)
+    if CACHE_BACKEND == "sqlite":
+        try:
+            return SQLiteCache(CACHE_SQLITE_PATH)
+        except Exception as e:
+            print(f"SQLite cache unavailable, caching disabled: {e}")
+    return NullCache()
+
+
+shared_cache = create_shared_cache()
+
+
+def serp_search(params, cache_kind=None):
+    """Run a SerpAPI query with the serpapi budget as the HTTP timeout.
+
+    With cache_kind set, results are shared across workers for SERP_CACHE_TTLS[cache_kind].
+    """
+    def search(timeout):
+        client_search = GoogleSearch(dict(params, api_key=os.getenv("SERP_API_KEY")))
+        client_search.timeout = timeout
+        return client_search.get_dict()
+
+    if not cache_kind:
+        return call_upstream('serpapi', search)
+    return shared_cache.get_or_compute(
+        SharedCache.make_key("serp", params),
+        SERP_CACHE_TTLS[cache_kind],
+        lambda: call_upstream('serpapi', search),
+        should_cache=lambda results: "error" not in results
+    )
+
 
 @dataclass
 class Bookmark:
@@ -67,11 +1263,513 @@ class UserInterest:
     current_location: str = ""
 
 
+class ProfileCache:
+    """LRU + TTL cache of user documents shared by all turns in this worker.
+
+    Writes go through FirebaseUserManager, which updates Firestore and then the cached
+    copy. Every write also bumps a 'version' field on the document; when snapshot
+    listeners are enabled each cached user is watched and a snapshot from another
+    worker replaces the cached copy unless it is older than what we already hold.
+    """
+
+    def __init__(self, db_instance, max_size=256, ttl=900, use_listeners=True):
+        self.db = db_instance
+        self.max_size = max_size
+        self.ttl = ttl
+        self.use_listeners = use_listeners
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+
+    def get(self, phone_number):
+        """Return the cached user data, or None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(phone_number)
+            if not entry:
+                return None
+            if entry['expires_at'] < time.time():
+                self._evict(phone_number)
+                return None
+            self.entries.move_to_end(phone_number)
+            return entry['data']
+
+    def put(self, phone_number, data):
+        with self.lock:
+            if phone_number in self.entries:
+                self._evict(phone_number)
+            self.entries[phone_number] = {
+                'data': data,
+                'version': data.get('version', 0),
+                'expires_at': time.time() + self.ttl,
+                'watch': None,
+                'attachments': {}
+            }
+            while len(self.entries) > self.max_size:
+                self._evict(next(iter(self.entries)))
+        if self.use_listeners:
+            self._watch(phone_number)
+
+    def version(self, phone_number):
+        with self.lock:
+            entry = self.entries.get(phone_number)
+            return entry['version'] if entry else None
+
+    def apply(self, phone_number, apply_local, applied_data=None, base_version=None):
+        """Apply a local write to the cached copy and bump its version.
+
+        base_version is the cached version the write was made against. If a snapshot newer
+        than that has already replaced the cached copy, the snapshot includes this write (or
+        a later snapshot will), so it is not applied a second time.
+        """
+        with self.lock:
+            entry = self.entries.get(phone_number)
+            if not entry:
+                return
+            if base_version is not None and entry['version'] > base_version:
+                return
+            if entry['data'] is not applied_data:
+                apply_local(entry['data'])
+            entry['version'] += 1
+            entry['data']['version'] = entry['version']
+            entry['expires_at'] = time.time() + self.ttl
+
+    def attach(self, phone_number, name, value):
+        """Keep a derived structure (e.g. a bookmark index) alongside the cached profile"""
+        with self.lock:
+            entry = self.entries.get(phone_number)
+            if entry:
+                entry['attachments'][name] = value
+
+    def attachment(self, phone_number, name):
+        with self.lock:
+            entry = self.entries.get(phone_number)
+            return entry['attachments'].get(name) if entry else None
+
+    def invalidate(self, phone_number):
+        with self.lock:
+            if phone_number in self.entries:
+                self._evict(phone_number)
+
+    def _evict(self, phone_number):
+        entry = self.entries.pop(phone_number)
+        if entry.get('watch'):
+            try:
+                entry['watch'].unsubscribe()
+            except Exception as e:
+                print(f"Error stopping profile listener for {phone_number}: {e}")
+
+    def _watch(self, phone_number):
+        def on_snapshot(doc_snapshots, changes, read_time):
+            for doc in doc_snapshots:
+                if not doc.exists:
+                    self.invalidate(phone_number)
+                    continue
+                data = doc.to_dict()
+                with self.lock:
+                    entry = self.entries.get(phone_number)
+                    if entry and data.get('version', 0) > entry['version']:
+                        entry['data'] = data
+                        entry['version'] = data.get('version', 0)
+                        entry['expires_at'] = time.time() + self.ttl
+                        # Derived structures (the bookmark index) may miss the other worker's write
+                        entry['attachments'] = {}
+
+        try:
+            watch = self.db.collection('users').document(phone_number).on_snapshot(on_snapshot)
+        except Exception as e:
+            print(f"Error starting profile listener for {phone_number}: {e}")
+            return
+        with self.lock:
+            entry = self.entries.get(phone_number)
+            if entry and entry['watch'] is None:
+                entry['watch'] = watch
+                return
+        # The entry was evicted or replaced while the listener was starting
+        watch.unsubscribe()
+
+
+def normalize_key(text):
+    """Normalize free text into a stable key, e.g. 'Connaught Place, Delhi ' -> 'connaught_place_delhi'.
+
+    Works for any script ('लाल किला' -> 'लाल_किला'); text with no letters or digits at all
+    (only emoji or punctuation) is keyed on a hash of the text, so it never shares a key.
+    """
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    # str.isalnum() misses combining marks such as Devanagari vowel signs, which belong to the word
+    kept = "".join(ch if ch.isalnum() or unicodedata.category(ch).startswith("M") else " " for ch in text)
+    key = "_".join(kept.split())
+    if not key and text.strip():
+        key = "h" + hashlib.sha1(text.strip().encode("utf-8")).hexdigest()[:12]
+    return key
+
+
+class LocationNormalizer:
+    """Maps free-text locations to canonical city IDs using a local gazetteer.
+
+    Each gazetteer city has an ID, a display name, coordinates, aliases ('bombay') and
+    well-known areas ('bandra'). Resolution tries, in order: the whole text as a name or
+    alias, the longest name/alias/area contained in the text ('connaught place delhi'),
+    then a fuzzy match against the names and aliases for typos ('dehli'). Unknown places
+    fall back to normalize_key so they still get a stable key.
+
+    city_name is stricter, because it rewrites the text sent to search: a city found inside
+    a longer phrase ('Paris, Texas', 'Delhi Darbar, Mumbai') is not taken as the location.
+    """
+
+    def __init__(self, path=None, fuzzy_cutoff=0.8):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.cities = {}
+        self.names = {}
+        self.areas = {}
+        self.max_words = 1
+        self.lock = threading.Lock()
+        self.resolved = OrderedDict()
+        if path:
+            self.load(path)
+
+    def load(self, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                gazetteer = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Gazetteer not loaded from {path}: {e}")
+            return
+        for city in gazetteer.get('cities', []):
+            self.add_city(city)
+
+    def add_city(self, city):
+        self.cities[city['id']] = city
+        for name in [city['id'], city['name']] + city.get('aliases', []):
+            self._register(self.names, name, city['id'])
+        for area in city.get('areas', []):
+            self._register(self.areas, area, city['id'])
+
+    def _register(self, table, name, city_id):
+        key = normalize_key(name)
+        if key:
+            table.setdefault(key, city_id)
+            self.max_words = max(self.max_words, key.count('_') + 1)
+
+    def resolve(self, text):
+        """Gazetteer entry for a location, or None if it is not a known city"""
+        key = normalize_key(text)
+        if not key:
+            return None
+        with self.lock:
+            if key in self.resolved:
+                self.resolved.move_to_end(key)
+                city_id = self.resolved[key]
+                return self.cities.get(city_id) if city_id else None
+        city_id = self._match(key)
+        with self.lock:
+            self.resolved[key] = city_id
+            if len(self.resolved) > 4096:
+                self.resolved.popitem(last=False)
+        return self.cities.get(city_id) if city_id else None
+
+    def _match(self, key):
+        if key in self.names:
+            return self.names[key]
+        words = key.split('_')
+        # Longest contained phrase wins, so 'new york' beats 'york' and areas imply their city
+        for size in range(min(len(words), self.max_words), 0, -1):
+            for start in range(len(words) - size + 1):
+                phrase = '_'.join(words[start:start + size])
+                if len(phrase) < 4 and phrase not in self.cities:
+                    # Short aliases ('la', 'cp') only count when they are the whole text
+                    continue
+                city_id = self.names.get(phrase) or self.areas.get(phrase)
+                if city_id:
+                    return city_id
+        close = difflib.get_close_matches(key, self.names.keys(), n=1, cutoff=self.fuzzy_cutoff)
+        if not close and len(words) > 1:
+            # Typo in one word of a longer phrase, e.g. 'hotels near banglore'
+            for word in words:
+                if len(word) >= 4:
+                    close = difflib.get_close_matches(word, self.names.keys(), n=1, cutoff=self.fuzzy_cutoff)
+                    if close:
+                        break
+        return self.names[close[0]] if close else None
+
+    def city_id(self, text):
+        """Canonical key for a location: the gazetteer city ID, else the normalized text"""
+        city = self.resolve(text)
+        return city['id'] if city else normalize_key(text)
+
+    def city_name(self, text):
+        """Canonical display name for city-level lookups (weather, events, news).
+
+        Only the whole text (a name, alias, area or a typo of a name) or its last comma
+        segment ('Bandra, Mumbai') is matched; anything else is passed through unchanged.
+        """
+        key = normalize_key(text)
+        city_id = self.names.get(key) or self.areas.get(key)
+        if not city_id and ',' in (text or ""):
+            city_id = self.names.get(normalize_key(text.rsplit(',', 1)[1]))
+        if not city_id and key:
+            close = difflib.get_close_matches(key, self.names.keys(), n=1, cutoff=self.fuzzy_cutoff)
+            city_id = self.names[close[0]] if close else None
+        return self.cities[city_id]['name'] if city_id else (text or "").strip()
+
+    def exact(self, text):
+        """Gazetteer entry when the whole text is a city name or alias, else None"""
+        city_id = self.names.get(normalize_key(text))
+        return self.cities[city_id] if city_id else None
+
+    def canonical_location(self, text):
+        """Canonical name when the text is just a city or alias; more specific places are kept as-is"""
+        city = self.exact(text)
+        return city['name'] if city else (text or "").strip()
+
+
+location_normalizer = LocationNormalizer(GAZETTEER_PATH, LOCATION_FUZZY_CUTOFF)
+
+
+def location_id(text):
+    return location_normalizer.city_id(text)
+
+
+def in_location(text, location):
+    """Whether a free-text place (e.g. a visited place) is in the given location"""
+    city_id = location_id(location)
+    return bool(city_id) and (location_id(text) == city_id or normalize_key(location) in normalize_key(text))
+
+
+poi_store = POIStore(POI_DB_PATH) if os.path.exists(POI_DB_PATH) else None
+
+
+def locate(location):
+    """Search centre and radius for a location: a named area from the POI store, else the gazetteer city.
+
+    Areas are only looked up inside the city the location names, or else the user's current
+    city, since the same area name exists in many cities.
+    """
+    city = location_normalizer.resolve(location) or location_normalizer.resolve(stored_current_location())
+    if poi_store is not None and city and 'lat' in city:
+        for name in [location] + [part for part in (location or "").split(',') if part.strip()]:
+            place = poi_store.find_place(name, city['lat'], city['lon'], POI_CITY_EXTENT)
+            if place:
+                return place['lat'], place['lon'], POI_AREA_RADIUS
+    city = location_normalizer.resolve(location)
+    if city and 'lat' in city:
+        return city['lat'], city['lon'], POI_CITY_RADIUS
+    return None
+
+
+def local_places(query, location, limit=5):
+    """Nearby POIs from the offline store for a request like ('ATMs', 'Connaught Place'), or []"""
+    if poi_store is None:
+        return []
+    categories = categories_for_query(query)
+    center = locate(location)
+    if not categories or not center:
+        return []
+    try:
+        return poi_store.nearby(center[0], center[1], categories, center[2], limit)
+    except sqlite3.Error as e:
+        print(f"POI store lookup failed: {e}")
+        return []
+
+
+# Bumped when bookmark document IDs change shape; older users' documents are re-keyed once
+BOOKMARK_KEY_VERSION = 2
+
+
+def make_bookmark_record(bookmark_data):
+    """Add the normalized lookup keys stored with each bookmark document"""
+    record = dict(bookmark_data)
+    # A bookmark without a place name is keyed on its whole content rather than a shared "untitled"
+    record['place_key'] = normalize_key(record.get('place', '')) or normalize_key(
+        json.dumps(bookmark_data, sort_keys=True, default=str))
+    record['location_key'] = normalize_key(record.get('location', ''))
+    record['city_id'] = location_id(record.get('location', ''))
+    record['category_key'] = normalize_key(record.get('category', ''))
+    # Keyed on the city so 'Red Fort, New Delhi' and 'Red Fort, Delhi' are the same bookmark
+    record['key'] = f"{record['place_key']}--{record['city_id']}"
+    return record
+
+
+def empty_profile_stats():
+    return {
+        'bookmarks_total': 0,
+        'stories_total': 0,
+        'bookmarks_by_city': {},
+        'stories_by_city': {},
+        'cities': []
+    }
+
+
+def build_profile_stats(bookmarks, stories):
+    """Compute profile aggregates from scratch (used once to backfill older profiles)"""
+    stats = empty_profile_stats()
+    for bookmark in bookmarks:
+        location_key = location_id(bookmark.get('location', '')) or "unknown"
+        stats['bookmarks_total'] += 1
+        stats['bookmarks_by_city'][location_key] = stats['bookmarks_by_city'].get(location_key, 0) + 1
+        if location_key != "unknown" and location_key not in stats['cities']:
+            stats['cities'].append(location_key)
+    for story in stories:
+        location_key = location_id(story.get('location', '')) or "unknown"
+        stats['stories_total'] += 1
+        stats['stories_by_city'][location_key] = stats['stories_by_city'].get(location_key, 0) + 1
+    return stats
+
+
+def count_for_location(counts, location, overall=0):
+    """Per-city counter lookup; older free-text keys ('connaught_place_delhi') are folded into their city.
+    Without a location the overall total is returned."""
+    city_id = location_id(location)
+    if not city_id:
+        return overall
+    total = sum(count for key, count in counts.items() if key == city_id or location_id(key.replace('_', ' ')) == city_id)
+    if total:
+        return total
+    return sum(count for key, count in counts.items() if city_id in key)
+
+
+class BookmarkIndex:
+    """In-memory index of one user's bookmarks by (place, city) key, city, location and category"""
+
+    def __init__(self, bookmarks=()):
+        self.by_key = {}
+        self.by_city = {}
+        self.by_location = {}
+        self.by_category = {}
+        # Bumped on every change, so derived data (the profile vectors) knows when to rebuild
+        self.revision = 0
+        for bookmark in bookmarks:
+            self.add(bookmark)
+
+    def __len__(self):
+        return len(self.by_key)
+
+    def add(self, bookmark):
+        if 'city_id' not in bookmark:
+            # Stored before city IDs existed and not yet migrated by _migrate_bookmark_keys
+            bookmark = make_bookmark_record(bookmark)
+        key = bookmark['key']
+        if key in self.by_key:
+            self.remove(key)
+        self.by_key[key] = bookmark
+        self.revision += 1
+        self.by_city.setdefault(bookmark['city_id'], set()).add(key)
+        self.by_location.setdefault(bookmark.get('location_key', ''), set()).add(key)
+        self.by_category.setdefault(bookmark.get('category_key', ''), set()).add(key)
+
+    def remove(self, key):
+        bookmark = self.by_key.pop(key, None)
+        if bookmark:
+            self.revision += 1
+            self.by_city.get(bookmark['city_id'], set()).discard(key)
+            self.by_location.get(bookmark.get('location_key', ''), set()).discard(key)
+            self.by_category.get(bookmark.get('category_key', ''), set()).discard(key)
+
+    def get(self, key):
+        return self.by_key.get(key)
+
+    def find(self, location="", category=""):
+        """Bookmarks matching a location and/or category, oldest first"""
+        keys = None
+        if location:
+            keys = self.by_city.get(location_id(location))
+            location_key = normalize_key(location)
+            if not keys:
+                # Partial matches ('delhi' -> 'connaught_place_delhi') only scan the distinct locations
+                keys = set().union(*[k for loc, k in self.by_location.items() if location_key and location_key in loc])
+            keys = set(keys)
+        if category:
+            category_keys = self.by_category.get(normalize_key(category), set())
+            keys = set(category_keys) if keys is None else keys & category_keys
+        if keys is None:
+            keys = self.by_key.keys()
+        return sorted((self.by_key[k] for k in keys), key=lambda b: b.get('timestamp', ''))
+
+
+_embedder_lock = threading.Lock()
+_embedder = {'embedder': None, 'fallback': None}
+
+
+def warm_embedder():
+    """Load EMBEDDING_MODEL (a download on a fresh host); run in the background at startup"""
+    started = time.perf_counter()
+    embedder = create_embedder(EMBEDDING_MODEL)
+    with _embedder_lock:
+        _embedder['embedder'] = embedder
+    print(f"Embedding model {embedder.name} ready in {time.perf_counter() - started:.1f}s")
+
+
+def get_embedder():
+    """The embedding model once warm_embedder has loaded it, hashed features until then.
+
+    A user's turn never waits for the model; profile indexes built with the fallback are
+    rebuilt once the model is ready (see get_profile_vectors).
+    """
+    with _embedder_lock:
+        if _embedder['embedder'] is not None:
+            return _embedder['embedder']
+        if EMBEDDING_MODEL == "hashing":
+            _embedder['embedder'] = create_embedder("hashing")
+            return _embedder['embedder']
+        if _embedder['fallback'] is None:
+            _embedder['fallback'] = create_embedder("hashing")
+        return _embedder['fallback']
+
+
+def query_embedder(index):
+    """Embedder for queries against an index: the one that built it, so the vectors are comparable"""
+    return index.embedder if index is not None and index.embedder is not None else get_embedder()
+
+
+def profile_vector_items(user_data, bookmarks):
+    """Items embedded in a user's profile index: likes, dislikes, bookmarks and story themes"""
+    interests = user_data.get('interests', {})
+    items = [{'kind': 'like', 'text': like} for like in interests.get('likes', []) if like]
+    items += [{'kind': 'dislike', 'text': dislike} for dislike in interests.get('dislikes', []) if dislike]
+    for bookmark in bookmarks:
+        items.append({
+            'kind': 'bookmark',
+            'text': ' '.join(part for part in (bookmark.get('place'), bookmark.get('category'), bookmark.get('note')) if part),
+            'name': bookmark.get('place', ''),
+            'city_id': bookmark.get('city_id', ''),
+        })
+    for story in user_data.get('story_history', []):
+        locations = story.get('locations', [])
+        items.append({
+            'kind': 'story',
+            'text': ' '.join([story.get('theme', '')] + (locations if isinstance(locations, list) else [str(locations)])),
+            'city_id': location_id(story.get('location', '')),
+        })
+    return items
+
+
 class FirebaseUserManager:
-    def __init__(self,db_instance):
+    def __init__(self,db_instance, shared_cache=None):
         self.db = db_instance
-        self.current_user_id = None
-        self.current_user_data = None
+        # Second tier shared with the other workers, consulted before Firestore
+        self.shared_cache = shared_cache
+        self.profile_cache = ProfileCache(
+            db_instance,
+            max_size=PROFILE_CACHE_SIZE,
+            ttl=PROFILE_CACHE_TTL,
+            use_listeners=PROFILE_CACHE_LISTENERS
+        )
+        # The selected user is kept per thread so turns for different users can run concurrently
+        self._local = threading.local()
+
+    @property
+    def current_user_id(self):
+        return getattr(self._local, 'current_user_id', None)
+
+    @current_user_id.setter
+    def current_user_id(self, value):
+        self._local.current_user_id = value
+
+    @property
+    def current_user_data(self):
+        return getattr(self._local, 'current_user_data', None)
+
+    @current_user_data.setter
+    def current_user_data(self, value):
+        self._local.current_user_data = value
 
     def validate_phone_number(self, phone):
         """Validate phone number format"""
@@ -80,24 +1778,41 @@ class FirebaseUserManager:
             return None
         return phone
 
-    def get_or_create_user(self, phone_number):
-        """Get existing user or create new one"""
+    def get_or_create_user(self, phone_number, reload=False):
+        """Get existing user or create new one.
+
+        reload skips the cached copies and reads the user document, for a turn that follows
+        one handled by another worker (see ConversationScheduler).
+        """
         phone_number = self.validate_phone_number(phone_number)
         if not phone_number:
             raise ValueError("Invalid phone number format")
 
-        user_ref = db.collection('users').document(phone_number)
+        cached_data = None if reload else self.profile_cache.get(phone_number)
+        if cached_data is None and self.shared_cache and not reload:
+            cached_data = self.shared_cache.get(f"profile:{phone_number}")
+            if cached_data is not None:
+                self.profile_cache.put(phone_number, cached_data)
+        if cached_data is not None:
+            self.current_user_id = phone_number
+            self.current_user_data = cached_data
+            return False, cached_data
+
+        user_ref = self.db.collection('users').document(phone_number)
         user_doc = user_ref.get()
 
         if user_doc.exists:
             self.current_user_id = phone_number
             self.current_user_data = user_doc.to_dict()
+            self.profile_cache.put(phone_number, self.current_user_data)
+            if self.shared_cache:
+                # Published once per load; writes invalidate it rather than re-serializing the profile
+                self.shared_cache.set(f"profile:{phone_number}", self.current_user_data, self.profile_cache.ttl)
             return False, self.current_user_data
         else:
             default_data = {
                 'phone_number': phone_number,
                 'name': '',
-                'bookmarks': [],
                 'interests': {
                     'likes': [],
                     'dislikes': [],
@@ -108,7 +1823,11 @@ class FirebaseUserManager:
                 },
                 'current_plan': {},
                 'story_history': [],
+                'stats': empty_profile_stats(),
+                'bookmark_key_version': BOOKMARK_KEY_VERSION,
                 'detected_language': "Unknown",
+                'delivery_mode': DEFAULT_DELIVERY_MODE,
+                'version': 0,
                 'created_at': firestore.SERVER_TIMESTAMP,
                 'last_active': firestore.SERVER_TIMESTAMP
             }
@@ -116,38 +1835,30 @@ class FirebaseUserManager:
             user_ref.set(default_data)
             self.current_user_id = phone_number
             self.current_user_data = default_data
+            self.profile_cache.put(phone_number, default_data)
             return True, default_data
 
     def update_user_name(self, name):
         """Update user's name"""
         if self.current_user_id:
-            db.collection('users').document(self.current_user_id).update({
-                'name': name,
-                'last_active': firestore.SERVER_TIMESTAMP
-            })
-            self.current_user_data['name'] = name
+            self.update_user_data('name', name)
 
     def load_chat_history(self):
-        """Load chat history for the current user from Firestore."""
+        """Load chat history for the current user from the cached profile."""
         if not self.current_user_id:
             return []  # No user selected, return empty history
 
-        user_doc_ref = self.db.collection('users').document(self.current_user_id)
-        user_doc = user_doc_ref.get()
-
-        if user_doc.exists:
-            chat_history_data = user_doc.to_dict().get('chat_history', [])
-            # Convert stored dicts back to Langchain Message objects
-            loaded_messages = []
-            for msg_data in chat_history_data:
-                if msg_data.get("type") == "human":
-                    loaded_messages.append(HumanMessage(content=msg_data.get("content")))
-                elif msg_data.get("type") == "ai":
-                    loaded_messages.append(AIMessage(content=msg_data.get("content")))
-                elif msg_data.get("type") == "system":
-                    loaded_messages.append(SystemMessage(content=msg_data.get("content")))
-            return loaded_messages
-        return []
+        chat_history_data = self.current_user_data.get('chat_history', [])
+        # Convert stored dicts back to Langchain Message objects
+        loaded_messages = []
+        for msg_data in chat_history_data:
+            if msg_data.get("type") == "human":
+                loaded_messages.append(HumanMessage(content=msg_data.get("content")))
+            elif msg_data.get("type") == "ai":
+                loaded_messages.append(AIMessage(content=msg_data.get("content")))
+            elif msg_data.get("type") == "system":
+                loaded_messages.append(SystemMessage(content=msg_data.get("content")))
+        return loaded_messages
 
     def save_chat_history(self, messages: List[str]):
         """Save chat history for the current user to Firestore."""
@@ -169,34 +1880,235 @@ class FirebaseUserManager:
         """Get current user's data"""
         return self.current_user_data
 
-    def ensure_user_exists(self, phone_number):
+    def ensure_user_exists(self, phone_number, reload=False):
         """Ensures the user exists and sets current_user_id and current_user_data."""
-        self.get_or_create_user(phone_number)
+        self.get_or_create_user(phone_number, reload)
 
     def update_user_data(self, field, value):
         """Update specific field in user data"""
         if self.current_user_id:
-            db.collection('users').document(self.current_user_id).update({
-                field: value,
-                'last_active': firestore.SERVER_TIMESTAMP
-            })
-            self.current_user_data[field] = value
+            self._write_through({field: value}, lambda data: data.__setitem__(field, value))
+
+    def _write_through(self, updates, apply_local):
+        """Write updates to Firestore, then apply the same change to the cached profile"""
+        updates = dict(updates)
+        updates['last_active'] = firestore.SERVER_TIMESTAMP
+        updates['version'] = firestore.Increment(1)
+        base_version = self.profile_cache.version(self.current_user_id)
+        with tracer.span("firestore_write", {"collection": "users", "fields": ",".join(sorted(updates))[:200]}):
+            self.db.collection('users').document(self.current_user_id).update(updates)
+        apply_local(self.current_user_data)
+        self.profile_cache.apply(self.current_user_id, apply_local, self.current_user_data, base_version)
+        if self.shared_cache:
+            # The next worker without a copy reloads from Firestore and publishes the fresh profile
+            self.shared_cache.delete(f"profile:{self.current_user_id}")
+
+    def _bookmarks_ref(self):
+        return self.db.collection('users').document(self.current_user_id).collection('bookmarks')
+
+    def _migrate_legacy_bookmarks(self):
+        """Move bookmarks stored as an array on the user document into the bookmarks subcollection"""
+        legacy_bookmarks = self.current_user_data.get('bookmarks')
+        if not legacy_bookmarks:
+            return
+        for start in range(0, len(legacy_bookmarks), 400):
+            batch = self.db.batch()
+            for bookmark in legacy_bookmarks[start:start + 400]:
+                record = make_bookmark_record(bookmark)
+                batch.set(self._bookmarks_ref().document(record['key']), record, merge=True)
+            batch.commit()
+        self._write_through({'bookmarks': firestore.DELETE_FIELD}, lambda data: data.pop('bookmarks', None))
+
+    def _migrate_bookmark_keys(self):
+        """Move bookmark documents stored under pre-city-ID keys to their canonical key, once per user.
+
+        Point reads (get_bookmark, add_bookmark) address documents by key, so a document left
+        under its old ID would be missed and bookmarked again. Documents that now share a key
+        ('Red Fort, New Delhi' and 'Red Fort, Delhi') are merged into one, preferring the document
+        already under that key and then the newest, and the profile counters are recomputed so
+        the merged ones are not counted twice.
+        """
+        if self.current_user_data.get('bookmark_key_version', 0) >= BOOKMARK_KEY_VERSION:
+            return
+        kept = {}
+        moves = []
+        for doc in self._bookmarks_ref().stream():
+            record = make_bookmark_record(doc.to_dict())
+            if doc.id == record['key']:
+                kept[doc.id] = record
+            else:
+                moves.append((doc.id, record))
+        moves.sort(key=lambda move: move[1].get('timestamp', ''), reverse=True)
+        merged = 0
+        for start in range(0, len(moves), 200):
+            batch = self.db.batch()
+            for old_key, record in moves[start:start + 200]:
+                if record['key'] in kept:
+                    merged += 1
+                else:
+                    kept[record['key']] = record
+                    batch.set(self._bookmarks_ref().document(record['key']), record)
+                batch.delete(self._bookmarks_ref().document(old_key))
+            batch.commit()
+        updates = {'bookmark_key_version': BOOKMARK_KEY_VERSION}
+        if merged and self.current_user_data.get('stats') is not None:
+            updates['stats'] = build_profile_stats(kept.values(), self.current_user_data.get('story_history', []))
+        self._write_through(updates, lambda data: data.update(updates))
+        if moves:
+            print(f"Re-keyed {len(moves)} bookmarks ({merged} merged) for {self.current_user_id}")
+
+    def _migrate_bookmarks(self):
+        self._migrate_legacy_bookmarks()
+        self._migrate_bookmark_keys()
+
+    def get_bookmark_index(self):
+        """Load the user's bookmark index once per cached session"""
+        index = self.profile_cache.attachment(self.current_user_id, 'bookmark_index')
+        if index is None:
+            self._migrate_bookmarks()
+            index = BookmarkIndex(doc.to_dict() for doc in self._bookmarks_ref().stream())
+            self.profile_cache.attach(self.current_user_id, 'bookmark_index', index)
+        return index
+
+    def get_profile_vectors(self):
+        """Similarity index over the user's profile.
+
+        Rebuilt only when what it embeds changes: the likes and dislikes, the bookmarks (by
+        the bookmark index's revision), the number of stories, or the embedder. The profile
+        'version' is not used because every saved chat turn bumps it.
+        """
+        if not self.current_user_id:
+            return None
+        embedder = get_embedder()
+        bookmarks = self.get_bookmark_index()
+        interests = self.current_user_data.get('interests', {})
+        revision = (embedder, bookmarks, bookmarks.revision, tuple(interests.get('likes', [])),
+                    tuple(interests.get('dislikes', [])), len(self.current_user_data.get('story_history', [])))
+        cached = self.profile_cache.attachment(self.current_user_id, 'profile_vectors')
+        if cached is not None and cached[0] == revision:
+            return cached[1]
+        items = profile_vector_items(self.current_user_data, bookmarks.by_key.values())
+        index = VectorIndex(embedder.dim, VECTOR_BACKEND, embedder=embedder)
+        if items:
+            # Texts are memoized by the embedder, so a rebuild only embeds what changed
+            index.add(embedder.embed([item['text'] for item in items]), items)
+        self.profile_cache.attach(self.current_user_id, 'profile_vectors', (revision, index))
+        return index
+
+    def get_bookmark(self, place, location):
+        """Look up a single bookmark by its normalized (place, location) key"""
+        if not self.current_user_id:
+            return None
+        key = make_bookmark_record({'place': place, 'location': location})['key']
+        index = self.profile_cache.attachment(self.current_user_id, 'bookmark_index')
+        if index is not None:
+            return index.get(key)
+        self._migrate_bookmarks()
+        doc = self._bookmarks_ref().document(key).get()
+        return doc.to_dict() if doc.exists else None
+
+    def find_bookmarks(self, location="", category=""):
+        """Bookmarks filtered by location and/or category, oldest first"""
+        if not self.current_user_id:
+            return []
+        index = self.profile_cache.attachment(self.current_user_id, 'bookmark_index')
+        if index is None and (location or category):
+            # Serve filtered lookups from the composite indexes instead of loading every bookmark
+            self._migrate_bookmarks()
+            query = self._bookmarks_ref()
+            if location:
+                query = query.where('city_id', '==', location_id(location))
+            if category:
+                query = query.where('category_key', '==', normalize_key(category))
+            results = [doc.to_dict() for doc in query.order_by('timestamp').stream()]
+            if results or not location:
+                return results
+        return self.get_bookmark_index().find(location, category)
+
+    def count_bookmarks(self):
+        return self.get_profile_stats()['bookmarks_total'] if self.current_user_id else 0
+
+    def get_profile_stats(self):
+        """Aggregate counters stored with the profile, backfilled once for older users"""
+        stats = self.current_user_data.get('stats')
+        if stats is None:
+            stats = build_profile_stats(
+                self.get_bookmark_index().by_key.values(),
+                self.current_user_data.get('story_history', [])
+            )
+            self.update_user_data('stats', stats)
+        return stats
+
+    def _stats_changes(self, location, bookmarks=0, stories=0):
+        """Firestore updates and the matching local change that bump the per-city counters.
+
+        'cities' (cities explored) holds the cities of bookmarked places only, as before the
+        aggregates existed; stories and bookmarks without a location do not add a city.
+        """
+        location_key = location_id(location) or "unknown"
+        add_city = bool(bookmarks) and location_key != "unknown"
+        updates = {'stats.cities': firestore.ArrayUnion([location_key])} if add_city else {}
+        if bookmarks:
+            updates['stats.bookmarks_total'] = firestore.Increment(bookmarks)
+            updates[firestore.FieldPath('stats', 'bookmarks_by_city', location_key).to_api_repr()] = firestore.Increment(bookmarks)
+        if stories:
+            updates['stats.stories_total'] = firestore.Increment(stories)
+            updates[firestore.FieldPath('stats', 'stories_by_city', location_key).to_api_repr()] = firestore.Increment(stories)
+
+        def apply_local(data):
+            stats = data.setdefault('stats', empty_profile_stats())
+            stats['bookmarks_total'] = stats.get('bookmarks_total', 0) + bookmarks
+            stats['stories_total'] = stats.get('stories_total', 0) + stories
+            for field, amount in (('bookmarks_by_city', bookmarks), ('stories_by_city', stories)):
+                if amount:
+                    counts = stats.setdefault(field, {})
+                    counts[location_key] = counts.get(location_key, 0) + amount
+            cities = stats.setdefault('cities', [])
+            if add_city and location_key not in cities:
+                cities.append(location_key)
+
+        return updates, apply_local
+
+    def _increment_stats(self, location, bookmarks=0, stories=0):
+        """Bump the per-city counters in the same way the profile tool reads them"""
+        self._write_through(*self._stats_changes(location, bookmarks, stories))
 
     def add_bookmark(self, bookmark_data):
         """Add bookmark to user's data"""
         if self.current_user_id:
-            current_bookmarks = self.current_user_data.get('bookmarks', [])
-            current_bookmarks.append(bookmark_data)
-            self.update_user_data('bookmarks', current_bookmarks)
-            self.current_user_data['bookmarks'] = current_bookmarks
+            self.get_profile_stats()
+            record = make_bookmark_record(bookmark_data)
+            index = self.profile_cache.attachment(self.current_user_id, 'bookmark_index')
+            if index is not None:
+                is_new = index.get(record['key']) is None
+            else:
+                # Without the index, a point read tells a re-bookmark from a new one
+                self._migrate_bookmarks()
+                is_new = not self._bookmarks_ref().document(record['key']).get().exists
+            with tracer.span("firestore_write", {"collection": "bookmarks"}):
+                self._bookmarks_ref().document(record['key']).set(record)
+            if index is not None:
+                index.add(record)
+            if is_new:
+                self._increment_stats(record.get('location', ''), bookmarks=1)
+            else:
+                # Bookmarks live in a subcollection; bumping the profile version is what tells
+                # other workers' listeners to drop their bookmark index
+                self._write_through({}, lambda data: None)
 
     def add_story(self, story_data):
         """Add story to user's history"""
         if self.current_user_id:
-            current_stories = self.current_user_data.get('story_history', [])
-            current_stories.append(story_data)
-            self.update_user_data('story_history', current_stories)
-            self.current_user_data['story_history'] = current_stories
+            self.get_profile_stats()
+            updates, apply_stats = self._stats_changes(story_data.get('location', ''), stories=1)
+            updates['story_history'] = firestore.ArrayUnion([story_data])
+
+            def apply_local(data):
+                data.setdefault('story_history', []).append(story_data)
+                apply_stats(data)
+
+            # One update, so the story and its counters are written together
+            self._write_through(updates, apply_local)
 
     def update_interests(self, interests_data):
         """Update user's interests"""
@@ -204,7 +2116,35 @@ class FirebaseUserManager:
             self.update_user_data('interests', interests_data)
             self.current_user_data['interests'] = interests_data
 
-user_manager = FirebaseUserManager(db)
+    def add_interest(self, kind, interest):
+        """Add an interest to 'likes' or 'dislikes' without rewriting the interests map"""
+        if self.current_user_id:
+            def apply_local(data):
+                values = data.setdefault('interests', {}).setdefault(kind, [])
+                if interest not in values:
+                    values.append(interest)
+
+            self._write_through({f'interests.{kind}': firestore.ArrayUnion([interest])}, apply_local)
+
+    def remove_interest(self, kind, interest):
+        """Remove an interest from 'likes' or 'dislikes' without rewriting the interests map"""
+        if self.current_user_id:
+            def apply_local(data):
+                values = data.setdefault('interests', {}).setdefault(kind, [])
+                while interest in values:
+                    values.remove(interest)
+
+            self._write_through({f'interests.{kind}': firestore.ArrayRemove([interest])}, apply_local)
+
+    def update_interest_field(self, field, value):
+        """Set a single interests field such as 'current_location'"""
+        if self.current_user_id:
+            self._write_through(
+                {f'interests.{field}': value},
+                lambda data: data.setdefault('interests', {}).__setitem__(field, value)
+            )
+
+user_manager = FirebaseUserManager(db, shared_cache)
 google_client = genai
 
 def transcribe_and_identify_language(audio_file_path: str):
@@ -213,14 +2153,21 @@ def transcribe_and_identify_language(audio_file_path: str):
     and returns the detected language and the transcribed text.
     """
     try:
-        myfile = google_client.upload_file(audio_file_path)
-        response = google_client.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                "First, identify the language of this audio clip. Then, provide a perfect word-for-word transcription. Format your response as: 'Language: [Detected Language]\nTranscription: [Perfect Transcription]'",
-                myfile
-            ]
-        )
+        def transcribe():
+            myfile = google_client.upload_file(audio_file_path)
+            return google_client.generate_content(
+                model="gemini-2.5-flash",
+                contents=[
+                    "First, identify the language of this audio clip. Then, provide a perfect word-for-word transcription. Format your response as: 'Language: [Detected Language]\nTranscription: [Perfect Transcription]'",
+                    myfile
+                ]
+            )
+
+        started = time.perf_counter()
+        response = call_upstream('gemini', lambda timeout: run_with_timeout(transcribe, timeout, 'gemini'))
+        input_tokens, output_tokens, cached_tokens = usage_from_response(response)
+        usage_ledger.record("transcribe", "gemini-2.5-flash", input_tokens, output_tokens,
+                            time.perf_counter() - started, user_manager.current_user_id, cached_tokens)
         full_response_text = response.text
         detected_language = "Unknown"
         transcribed_text = full_response_text
@@ -263,12 +2210,110 @@ def get_current_time(*args, **kwargs):
     now = datetime.datetime.now()
     return now.strftime("%I:%M %p")
 
+def relevant_interests(index, text, kind, k=RECOMMEND_TOP_K):
+    """The user's likes or dislikes most similar to a request, best first"""
+    if index is None or not len(index):
+        return []
+    query = query_embedder(index).embed([text])[0]
+    return [item['text'] for _, item in index.search(query, k, where=lambda item: item['kind'] == kind)]
+
+
+def saved_matches(index, text, location, k=3):
+    """Names of the user's bookmarks in this city that are most similar to a request"""
+    if index is None or not len(index):
+        return []
+    city_id = location_id(location)
+    query = query_embedder(index).embed([text])[0]
+    hits = index.search(query, k, where=lambda item: item['kind'] == 'bookmark' and item['city_id'] == city_id)
+    return [item['name'] for score, item in hits if score > 0.3]
+
+
+def rank_places(index, text, places, k=RECOMMEND_TOP_K):
+    """Local candidate places ranked by the request and the user's likes/dislikes"""
+    if not places:
+        return []
+    embedder = query_embedder(index)
+    vectors = embedder.embed([f"{p['name']} {p['category'].replace('_', ' ')}" for p in places])
+    query = embedder.embed([text])[0]
+    liked = disliked = None
+    if index is not None and len(index):
+        liked = index.vectors_where(lambda item: item['kind'] == 'like')
+        disliked = index.vectors_where(lambda item: item['kind'] == 'dislike')
+    return [places[i] for i in rank_candidates(query, vectors, liked, disliked)[:k]]
+
+
+def route_candidates(location, interests, limit):
+    """Stops with coordinates for the day planner: the user's bookmarks first, then nearby POIs"""
+    stops = []
+    seen = set()
+    # Bookmarks are matched to POIs by name, so only places near the planned city count
+    city = location_normalizer.resolve(location)
+    center = (city['lat'], city['lon']) if city and 'lat' in city else (locate(location) or (None, None))[:2]
+    for bookmark in user_manager.find_bookmarks(location):
+        place = None
+        if poi_store is not None and center[0] is not None:
+            place = poi_store.find_place(bookmark.get('place'), center[0], center[1], POI_CITY_EXTENT)
+        if 'lat' in bookmark and 'lon' in bookmark:
+            place = dict(place or {}, lat=bookmark['lat'], lon=bookmark['lon'])
+        if place and center[0] is not None and haversine_m(center[0], center[1], place['lat'], place['lon']) > POI_CITY_EXTENT:
+            place = None
+        if place and normalize_key(bookmark['place']) not in seen:
+            tags = json.loads(place.get('tags') or '{}')
+            stops.append(make_stop(bookmark['place'], place['lat'], place['lon'], place.get('category', ''),
+                                   tags.get('opening_hours'), source='bookmark'))
+            seen.add(normalize_key(bookmark['place']))
+    for place in local_places(interests or "attractions", location, limit=limit):
+        if len(stops) >= limit:
+            break
+        if normalize_key(place['name']) not in seen:
+            tags = json.loads(place.get('tags') or '{}')
+            stops.append(make_stop(place['name'], place['lat'], place['lon'], place['category'],
+                                   tags.get('opening_hours'), source='map'))
+            seen.add(normalize_key(place['name']))
+    return stops[:limit]
+
+
+def plan_day_route(location, interests, time_slot):
+    """Optimized stop order for the itinerary, or None when there are too few located places"""
+    if not ROUTE_PLANNER:
+        return None
+    try:
+        stops = route_candidates(location, interests, ROUTE_MAX_STOPS)
+        if len(stops) < 3:
+            return None
+        started = time.perf_counter()
+        route = plan_route(stops, time_slot, ROUTE_TIME_BUDGET)
+        metrics.inc("route_plans_total")
+        metrics.inc("route_plan_seconds_total", amount=time.perf_counter() - started)
+        return route if route['visits'] else None
+    except Exception as e:
+        print(f"Route planning failed: {e}")
+        return None
+
+
 def day_planner_tool(mood: str, time_slot: str, specific_interests: str, location: str) -> str:
     """Generate a customized day itinerary for any city based on user preferences."""
 
+    if DEFERRED_GENERATION:
+        update_current_location(location)
+        generation_jobs.submit('day_planner', {
+            'mood': mood, 'time_slot': time_slot, 'specific_interests': specific_interests, 'location': location,
+            'language': reply_language()
+        })
+        return DeferredReply(f"I'm putting together your {time_slot} plan for {location} now. "
+                             f"It'll arrive here in a minute or two!")
+    return write_day_plan(mood, time_slot, specific_interests, location)
+
+
+def write_day_plan(mood, time_slot, specific_interests, location, language="English"):
+    """Write the itinerary and store it as the user's current plan.
+
+    language is set for deferred jobs, whose result is sent as-is rather than restated by
+    the agent in the user's language.
+    """
+    update_current_location(location)
     user_data = user_manager.get_user_data()
     user_interests = user_data.get('interests', {})
-    user_interests['current_location'] = location
     user_likes = user_interests.get('likes', [])
     user_dislikes = user_interests.get('dislikes', [])
     user_visited_places = user_interests.get('visited_places', [])
@@ -276,6 +2321,14 @@ def day_planner_tool(mood: str, time_slot: str, specific_interests: str, locatio
                                              'not specified')
     user_budget_range = user_interests.get('budget_range', 'not specified')
 
+    route = plan_day_route(location, specific_interests, time_slot)
+    route_lines = '\n'.join(f"    {line}" for line in describe_route(route)) if route else ""
+    route_section = f"""
+    Planned route (already ordered for travel time and opening hours; keep this order and these times,
+    and describe each stop, how to get there and what to do nearby):
+{route_lines}
+""" if route else ""
+
     prompt = f"""Create a detailed day itinerary for {location} with the following specifications:
 
     Location: {location}
@@ -286,16 +2339,17 @@ def day_planner_tool(mood: str, time_slot: str, specific_interests: str, locatio
     User Profile:
     - Likes: {', '.join(user_likes)}
     - Dislikes: {', '.join(user_dislikes)}
-    - Previously visited in {location}: {', '.join([p for p in user_visited_places if location.lower() in p.lower()])}
+    - Previously visited in {location}: {', '.join([p for p in user_visited_places if in_location(p, location)])}
     - Preferred time: {user_preferred_time}
     - Budget range: {user_budget_range}
-
+{route_section}
     Generate a structured itinerary with time slots and activities.
     Include specific {location} locations, brief descriptions, and practical tips.
     Focus on authentic local experiences and hidden gems when possible.
     Consider local culture, weather, and transportation.
 
     Format as a clear, readable itinerary with time slots and detailed descriptions.
+    Write the whole itinerary in {language}.
     """
 
     messages = [
@@ -304,12 +2358,14 @@ def day_planner_tool(mood: str, time_slot: str, specific_interests: str, locatio
         HumanMessage(content=prompt)
     ]
 
-    response = llm.invoke(messages)
+    response = invoke_llm(messages, "day_planner")
 
     user_manager.update_user_data('current_plan', {
         "itinerary": response.content,
         "mood": mood,
         "location": location,
+        "city_id": location_id(location),
+        "route": [visit['stop']['name'] for visit in route['visits']] if route else [],
         "date": datetime.datetime.now().isoformat(),
         "preferences": {
             "time_slot": time_slot,
@@ -322,13 +2378,10 @@ def day_planner_tool(mood: str, time_slot: str, specific_interests: str, locatio
 def bookmark_tool(place: str, note: str, category: str, location: str) -> str:
     """Save a place to user's bookmarks with personal notes."""
 
-    user_data = user_manager.get_user_data()
-    bookmarks = user_data.get('bookmarks', [])
-    existing = [b for b in bookmarks if
-                b.get('place', '').lower() == place.lower() and b.get('location', '').lower() == location.lower()]
+    existing = user_manager.get_bookmark(place, location)
 
     if existing:
-        return f"'{place}' in {location} is already bookmarked with note: '{existing[0].note}'"
+        return f"'{place}' in {location} is already bookmarked with note: '{existing.get('note', '')}'"
 
     bookmark_data = {
         'place': place,
@@ -360,26 +2413,18 @@ def bookmark_tool(place: str, note: str, category: str, location: str) -> str:
         HumanMessage(content=prompt)
     ]
 
-    enhancement = llm.invoke(messages).content
+    enhancement = invoke_llm(messages, "bookmark_enhance").content
 
-    return f" '{place}' bookmarked successfully in {location}!\n\n Your note: {note}\n\n Local insights:\n{enhancement}\n\n Total bookmarks: {len(user_data['bookmarks'])}"
+    return f" '{place}' bookmarked successfully in {location}!\n\n Your note: {note}\n\n Local insights:\n{enhancement}\n\n Total bookmarks: {user_manager.count_bookmarks()}"
 
 
 def get_bookmarks_tool(location: str = "") -> str:
     """Retrieve user bookmarks, optionally filtered by location."""
 
-    user_data = user_manager.get_user_data()
-    bookmarks = user_data.get('bookmarks', [])
-
-    filtered_bookmarks = []
+    filtered_bookmarks = user_manager.find_bookmarks(location=location)
     if location:
-        for b in bookmarks:
-            bookmark_location = b.get('location')
-            if bookmark_location and location.lower() in bookmark_location.lower():
-                filtered_bookmarks.append(b)
         header = f"Your bookmarks in {location}:"
     else:
-        filtered_bookmarks = bookmarks
         header = "All your bookmarks:"
 
     if not filtered_bookmarks:
@@ -414,6 +2459,17 @@ def poi_tool(interest_type: str, location: str, hidden_gems_only: bool = False)
     user_budget_range = user_interests.get('budget_range', 'not specified')
 
     gem_instruction = "Focus ONLY on hidden gems, local secrets, and off-the-beaten-path places" if hidden_gems_only else "Include both popular attractions and hidden gems"
+    # Send the likes, dislikes and places most relevant to this request instead of everything
+    profile_vectors = user_manager.get_profile_vectors()
+    user_likes = relevant_interests(profile_vectors, interest_type, 'like') or user_likes[:RECOMMEND_TOP_K]
+    user_dislikes = relevant_interests(profile_vectors, interest_type, 'dislike') or user_dislikes[:RECOMMEND_TOP_K]
+    saved = saved_matches(profile_vectors, interest_type, location)
+    candidates = rank_places(profile_vectors, interest_type, local_places(interest_type, location, limit=40), k=12)
+    candidate_lines = '\n'.join(f"    - {p['name']} ({p['category'].replace('_', ' ')}, {p['distance_m'] / 1000:.1f} km)" for p in candidates)
+    candidate_section = f"""
+    Places from local map data (prefer these when they fit, and keep their names exact):
+{candidate_lines}
+""" if candidates else ""
 
     prompt = f"""Recommend places in {location} for someone interested in {interest_type}:
 
@@ -424,11 +2480,12 @@ def poi_tool(interest_type: str, location: str, hidden_gems_only: bool = False)
    User Profile:
     - Likes: {', '.join(user_likes)}
     - Dislikes: {', '.join(user_dislikes)}
-    - Already visited in {location}: {', '.join([p for p in user_visited_places if location.lower() in p.lower()])}
+    - Already visited in {location}: {', '.join([p for p in user_visited_places if in_location(p, location)])}
+    - Saved places here that match: {', '.join(saved) or 'none'}
     - Budget preference: {user_budget_range}
 
     Instructions: {gem_instruction}
-
+{candidate_section}
     Provide 3-4 recommendations with:
     1. Place name and location within {location}
     2. Brief description and why it's special
@@ -446,11 +2503,23 @@ def poi_tool(interest_type: str, location: str, hidden_gems_only: bool = False)
         HumanMessage(content=prompt)
     ]
 
-    response = llm.invoke(messages)
+    response = invoke_llm(messages, "poi")
 
     return f" {interest_type.title()} recommendations in {location}:\n\n{response.content}"
 
 
+def reply_format_tool(mode: str) -> str:
+    """Choose whether replies arrive as text, voice notes or both."""
+
+    user_manager.update_user_data('delivery_mode', mode)
+    described = {
+        "text": "text messages only",
+        "audio": "voice notes only",
+        "both": "a text message followed by a voice note",
+    }[mode]
+    return f"Got it! From now on I'll reply with {described}."
+
+
 def interest_tool(interest: str, action: str, location: str) -> str:
     """Manage user interests and preferences."""
 
@@ -464,28 +2533,24 @@ def interest_tool(interest: str, action: str, location: str) -> str:
 
     if action == "add_like":
         if interest not in user_interests['likes']:
-            user_interests['likes'].append(interest)
-            user_manager.update_interests(user_interests)
+            user_manager.add_interest('likes', interest)
             message = f" Added '{interest}' to your likes"
         else:
             message = f"'{interest}' is already in your likes"
 
     elif action == "add_dislike":
         if interest not in user_interests['dislikes']:
-            user_interests['dislikes'].append(interest)
-            user_manager.update_interests(user_interests)
+            user_manager.add_interest('dislikes', interest)
             message = f" Added '{interest}' to your dislikes"
         else:
             message = f"'{interest}' is already in your dislikes"
 
     elif action == "remove":
         if interest in user_interests['likes']:
-            user_interests['likes'].remove(interest)
-            user_manager.update_interests(user_interests)
+            user_manager.remove_interest('likes', interest)
             message = f" Removed '{interest}' from your likes"
         elif interest in user_interests['dislikes']:
-            user_interests['dislikes'].remove(interest)
-            user_manager.update_interests(user_interests)
+            user_manager.remove_interest('dislikes', interest)
             message = f" Removed '{interest}' from your dislikes"
         else:
             message = f"'{interest}' not found in your preferences"
@@ -493,10 +2558,14 @@ def interest_tool(interest: str, action: str, location: str) -> str:
     else:
         return " Invalid action. Use 'add_like', 'add_dislike', or 'remove'"
 
+    profile_vectors = user_manager.get_profile_vectors()
+    related_likes = relevant_interests(profile_vectors, interest, 'like') or user_interests['likes'][:RECOMMEND_TOP_K]
+    related_dislikes = relevant_interests(profile_vectors, interest, 'dislike') or user_interests['dislikes'][:RECOMMEND_TOP_K]
+
     prompt = f"""Based on the user's interest in '{interest}', suggest 3-5 related interests they might enjoy in {location}.
 
-    Current likes: {', '.join(user_interests['likes'])}
-    Current dislikes: {', '.join(user_interests['dislikes'])}
+    Current likes (most related): {', '.join(related_likes)}
+    Current dislikes (most related): {', '.join(related_dislikes)}
     Location: {location}
 
     Provide brief explanations for each suggestion, focusing on what's available in {location}.
@@ -508,7 +2577,7 @@ def interest_tool(interest: str, action: str, location: str) -> str:
         HumanMessage(content=prompt)
     ]
 
-    suggestions = llm.invoke(messages).content
+    suggestions = invoke_llm(messages, "interest_suggestions").content
 
     return f"{message}\n\n Related interests you might enjoy in {location}:\n{suggestions}"
 
@@ -516,6 +2585,18 @@ def interest_tool(interest: str, action: str, location: str) -> str:
 def story_mode_tool(locations: List[str], theme: str, perspective: str, location: str) -> str:
     """Generate an engaging narrative story about visiting locations in any city."""
 
+    if DEFERRED_GENERATION:
+        generation_jobs.submit('story', {
+            'locations': list(locations), 'theme': theme, 'perspective': perspective, 'location': location,
+            'language': reply_language()
+        })
+        return DeferredReply(f"I'm writing your {theme} story about {location} now. "
+                             f"It'll arrive here in a minute or two!")
+    return write_story(locations, theme, perspective, location)
+
+
+def write_story(locations, theme, perspective, location, language="English"):
+    """Write the story (in language, for deferred jobs) and add it to the user's story history"""
     user_data = user_manager.get_user_data()
     user_interests = user_data.get('interests', {})
     locations_str = ', '.join(locations)
@@ -542,6 +2623,7 @@ def story_mode_tool(locations: List[str], theme: str, perspective: str, location
 
     Length: 600-800 words
     Style: Engaging, descriptive, with local insights and cultural authenticity
+    Language: write the whole story in {language}
     """
 
     messages = [
@@ -550,7 +2632,7 @@ def story_mode_tool(locations: List[str], theme: str, perspective: str, location
         HumanMessage(content=prompt)
     ]
 
-    story = llm.invoke(messages).content
+    story = invoke_llm(messages, "story").content
 
     story_entry = {
         "story": story,
@@ -565,15 +2647,32 @@ def story_mode_tool(locations: List[str], theme: str, perspective: str, location
 
     return f" Your {theme} story in {location}:\n\n{story}"
 
+# SerpAPI requests behind the live-data tools. The prefetcher sends the same ones, so its
+# results land under the cache keys the tools look up.
+def events_search(city):
+    return {"engine": "google_events", "q": f"events in {city} this weekend"}
+
+
+def weather_search(city):
+    return {"engine": "google", "q": f"weather in {city}"}
+
+
+def news_search(location, topic=""):
+    # If no topic specified, get general local news
+    if not topic or topic.lower() in ['news', 'latest', 'top news', 'current']:
+        return {"engine": "google_news", "q": f"top news {location} today"}
+    return {"engine": "google_news", "q": f"{topic} {location} news"}
+
+
+def places_search(query, location):
+    return {"engine": "google", "q": f"{query} in {location}"}
+
+
 def get_live_events_tool(city: str) -> str:
     """Get live events happening in a specific city this weekend."""
+    city = location_normalizer.city_name(city)
     try:
-        search = GoogleSearch({
-            "engine": "google_events",
-            "q": f"events in {city} this weekend",
-            "api_key": os.getenv("SERP_API_KEY")  # Add your SerpAPI key to .env file
-        })
-        results = search.get_dict()
+        results = serp_search(events_search(city), cache_kind='events')
         events = results.get("events_results", [])
 
         if not events:
@@ -595,13 +2694,9 @@ def get_live_events_tool(city: str) -> str:
 
 def get_weather_tool(city: str) -> str:
     """Get current weather information for a specific city."""
+    city = location_normalizer.city_name(city)
     try:
-        search = GoogleSearch({
-            "engine": "google",
-            "q": f"weather in {city}",
-            "api_key": os.getenv("SERP_API_KEY")
-        })
-        results = search.get_dict()
+        results = serp_search(weather_search(city), cache_kind='weather')
         weather_box = results.get("answer_box", {})
 
         if not weather_box:
@@ -628,19 +2723,9 @@ Perfect for planning your day out! Let me know if you need activity recommendati
 
 def get_news_tool(location: str, topic: str = "") -> str:
     """Get top current news for a specific location, optionally filtered by topic."""
+    location = location_normalizer.city_name(location)
     try:
-        # If no topic specified, get general local news
-        if not topic or topic.lower() in ['news', 'latest', 'top news', 'current']:
-            query = f"top news {location} today"
-        else:
-            query = f"{topic} {location} news"
-
-        search = GoogleSearch({
-            "engine": "google_news",
-            "q": query,
-            "api_key": os.getenv("SERP_API_KEY")
-        })
-        results = search.get_dict()
+        results = serp_search(news_search(location, topic), cache_kind='news')
         news = results.get("news_results", [])
 
         if not news:
@@ -669,13 +2754,21 @@ def get_news_tool(location: str, topic: str = "") -> str:
 
 def get_places_tool(query: str, location: str) -> str:
     """Find specific types of places (restaurants, hospitals, shops, etc.) in a given location."""
+    location = location_normalizer.canonical_location(location)
+    local = local_places(query, location)
+    if local:
+        metrics.inc("places_lookups_total", {"source": "local"})
+        places_list = [f" Places for '{query}' in {location}:\n"]
+        for place in local:
+            places_list.append(f"• {place['name']}")
+            if place['address']:
+                places_list.append(f"   {place['address']}")
+            places_list.append(f"   {place['distance_m'] / 1000:.1f} km away")
+            places_list.append("")
+        return "\n".join(places_list)
+    metrics.inc("places_lookups_total", {"source": "serpapi"})
     try:
-        search = GoogleSearch({
-            "engine": "google",
-            "q": f"{query} in {location}",
-            "api_key": os.getenv("SERP_API_KEY")
-        })
-        results = search.get_dict()
+        results = serp_search(places_search(query, location), cache_kind='places')
         places = results.get("local_results", {}).get("places", [])
 
         if not places:
@@ -709,11 +2802,10 @@ def get_user_profile_tool(location: str) -> str:
 
     user_data = user_manager.get_user_data()
     user_interests = user_data.get('interests', {})
-    bookmarks = user_data.get('bookmarks', [])
-    story_history = user_data.get('story_history', [])
+    stats = user_manager.get_profile_stats()
     current_plan = user_data.get('current_plan', {})
-    location_bookmarks = [b for b in bookmarks if location.lower() in b.get('location', '').lower()]
-    location_stories = [s for s in story_history if location.lower() in s.get("location", "").lower()]
+    # Profiles aggregated before stories stopped adding cities may still list story-only cities
+    bookmark_cities = [city for city in stats.get('cities', []) if city in stats.get('bookmarks_by_city', {})]
 
     profile = f"""👤 Your Travel Profile:
 
@@ -724,29 +2816,246 @@ def get_user_profile_tool(location: str) -> str:
         Budget range:  {user_interests.get('budget_range', 'moderate')}
         Language: {user_data.get('detected_language', 'Unknown')}
 
-    In {location}:
-        Bookmarks: {len(location_bookmarks)}
-        Stories created: {len(location_stories)}
-        Current plan: {'Yes' if current_plan.get('location', '') == location.lower() else 'No'}
+    In {location or 'all cities'}:
+        Bookmarks: {count_for_location(stats.get('bookmarks_by_city', {}), location, stats.get('bookmarks_total', 0))}
+        Stories created: {count_for_location(stats.get('stories_by_city', {}), location, stats.get('stories_total', 0))}
+        Current plan: {'Yes' if current_plan and location_id(current_plan.get('location', '')) == location_id(location) else 'No'}
 
     Overall:
-        Total bookmarks: {len(user_data['bookmarks'])}
-        Total stories: {len(user_data['story_history'])}
-        Cities explored: {len(set(b.get('location', '') for b in bookmarks))}
+        Total bookmarks: {stats.get('bookmarks_total', 0)}
+        Total stories: {stats.get('stories_total', 0)}
+        Cities explored: {len(bookmark_cities)}
 """
 
     return profile
 
+class CityPrefetcher:
+    """Warms the shared SerpAPI cache for a city the user just moved to.
+
+    Sends the weather, events, news and places searches on a small background pool so the
+    user's follow-up questions are cache hits. The searches go straight to serp_search
+    rather than through the tools, which turn errors into apology text, so a failed
+    warm-up is counted as failed. Prefetching is best effort and low priority:
+    a city is warmed at most once per cooldown, the backlog is bounded, and nothing is
+    fetched while the SerpAPI circuit breaker is not closed.
+    """
+
+    def __init__(self, max_workers=2, max_pending=32, cooldown=900):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.max_pending = max_pending
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.recent = {}
+
+    def warm_tasks(self, city):
+        # Same normalization as the tools, so the requests (and cache keys) match
+        name = location_normalizer.city_name(city)
+        place = location_normalizer.canonical_location(city)
+        tasks = [
+            lambda: serp_search(weather_search(name), cache_kind='weather'),
+            lambda: serp_search(events_search(name), cache_kind='events'),
+            lambda: serp_search(news_search(name), cache_kind='news'),
+        ]
+        for query in PREFETCH_PLACE_QUERIES:
+            if local_places(query, place):
+                # Answered from the offline POI store; SerpAPI is never asked
+                continue
+            tasks.append(lambda query=query: serp_search(places_search(query, place), cache_kind='places'))
+        return tasks
+
+    def submit(self, city):
+        city_key = location_id(city)
+        if not city_key:
+            return
+        # Cooldown and backlog come first: building the tasks reads the POI store
+        with self.lock:
+            now = time.time()
+            if now - self.recent.get(city_key, 0) < self.cooldown:
+                return
+            if self.pending >= self.max_pending:
+                metrics.inc("prefetch_tasks_total", {"outcome": "dropped"})
+                return
+            # Claim the city so a concurrent submit doesn't build the same tasks
+            self.recent[city_key] = now
+        tasks = self.warm_tasks(city)
+        with self.lock:
+            if self.pending + len(tasks) > self.max_pending:
+                metrics.inc("prefetch_tasks_total", {"outcome": "dropped"}, len(tasks))
+                if self.recent.get(city_key) == now:
+                    del self.recent[city_key]
+                return
+            self.pending += len(tasks)
+        for task in tasks:
+            self.executor.submit(self._run, task)
+
+    def _run(self, task):
+        try:
+            if circuit_breakers['serpapi'].state != "closed":
+                metrics.inc("prefetch_tasks_total", {"outcome": "skipped"})
+                return
+            task()
+            metrics.inc("prefetch_tasks_total", {"outcome": "done"})
+        except Exception as e:
+            print(f"Prefetch failed: {e}")
+            metrics.inc("prefetch_tasks_total", {"outcome": "failed"})
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+
+city_prefetcher = CityPrefetcher(PREFETCH_WORKERS, PREFETCH_MAX_PENDING, PREFETCH_COOLDOWN)
+
+
+def update_current_location(location):
+    """Persist the user's current city and warm the caches for it when it changes"""
+    user_data = user_manager.get_user_data()
+    location = location_normalizer.canonical_location(location)
+    if not user_data or not location or location.lower() in LOCATION_PLACEHOLDERS:
+        return
+    if location_id(location) == location_id(user_data.get('interests', {}).get('current_location', '')):
+        return
+    user_manager.update_interest_field('current_location', location)
+    if PREFETCH_ENABLED:
+        city_prefetcher.submit(location)
+
+
+@dataclass
+class ToolArg:
+    name: str
+    kind: str = "str"
+    default: object = ""
+    required: bool = False
+    location: bool = False
+    choices: tuple = ()
+
+
+class ToolInputError(ValueError):
+    """Malformed Action Input; the message tells the agent exactly what to fix"""
+
+    def __init__(self, tool_name, problem, schema):
+        self.tool_name = tool_name
+        self.problem = problem
+        expected = "|".join(arg.name for arg in schema)
+        super().__init__(f"Invalid Action Input for {tool_name}: {problem}. Expected format: '{expected}'")
+
+
+TOOL_SCHEMAS = {
+    "DayPlannerTool": [
+        ToolArg("mood", default="neutral"),
+        ToolArg("time_slot", default="full day"),
+        ToolArg("specific_interests", default="local attractions"),
+        ToolArg("location", location=True),
+    ],
+    "BookmarkTool": [
+        ToolArg("place", required=True),
+        ToolArg("note", default="No note provided."),
+        ToolArg("category", default="general"),
+        ToolArg("location", location=True),
+    ],
+    "GetBookmarksTool": [ToolArg("location")],
+    "POITool": [
+        ToolArg("interest_type", required=True),
+        ToolArg("location", location=True),
+        ToolArg("hidden_gems_only", kind="bool", default=False),
+    ],
+    "InterestTool": [
+        ToolArg("interest", required=True),
+        ToolArg("action", default="add_like", choices=("add_like", "add_dislike", "remove")),
+        ToolArg("location", location=True),
+    ],
+    "ReplyFormatTool": [ToolArg("mode", required=True, choices=DELIVERY_MODES)],
+    "StoryModeTool": [
+        ToolArg("locations", kind="list", required=True),
+        ToolArg("theme", default="adventure"),
+        ToolArg("perspective", default="third person"),
+        ToolArg("location", location=True),
+    ],
+    "GetUserProfileTool": [ToolArg("location")],
+    "LiveEventsTool": [ToolArg("city", location=True)],
+    "WeatherTool": [ToolArg("city", location=True)],
+    "NewsTool": [
+        ToolArg("location", location=True),
+        ToolArg("topic"),
+    ],
+    "PlacesFinderTool": [
+        ToolArg("query", required=True),
+        ToolArg("location", location=True),
+    ],
+}
+
+# Values the LLM sometimes sends instead of a real city
+LOCATION_PLACEHOLDERS = {"current location", "{current_location}", "current_location", "my location", "here", "near me"}
+BOOLEAN_VALUES = {"true": True, "yes": True, "1": True, "false": False, "no": False, "0": False}
+
+
+def stored_current_location():
+    user_data = user_manager.get_user_data() or {}
+    return user_data.get('interests', {}).get('current_location', '')
+
+
+def parse_tool_input(tool_name, query, current_location=None):
+    """Parse a pipe-separated Action Input into typed keyword arguments for the tool.
+
+    The input is split once; empty fields take their defaults and location fields fall back
+    to the user's stored current_location. Raises ToolInputError for anything unusable.
+    """
+    schema = TOOL_SCHEMAS[tool_name]
+    query = (query or "").strip()
+    if len(query) >= 2 and query[0] == query[-1] and query[0] in "'\"`":
+        query = query[1:-1].strip()
+    parts = [part.strip() for part in query.split('|')] if query else []
+    while len(parts) > len(schema) and not parts[-1]:
+        parts.pop()
+    if len(parts) > len(schema):
+        raise ToolInputError(tool_name, f"got {len(parts)} fields but only {len(schema)} are accepted", schema)
+
+    kwargs = {}
+    for position, arg in enumerate(schema):
+        raw = parts[position] if position < len(parts) else ""
+        if arg.location and raw.lower() in LOCATION_PLACEHOLDERS:
+            raw = ""
+        if not raw:
+            if arg.required:
+                raise ToolInputError(tool_name, f"'{arg.name}' is required", schema)
+            if arg.location:
+                if current_location is None:
+                    current_location = stored_current_location()
+                if not current_location:
+                    raise ToolInputError(tool_name, f"'{arg.name}' is required because the user's city is unknown", schema)
+                raw = current_location
+            else:
+                kwargs[arg.name] = arg.default
+                continue
+
+        if arg.kind == "bool":
+            if raw.lower() not in BOOLEAN_VALUES:
+                raise ToolInputError(tool_name, f"'{arg.name}' must be 'true' or 'false', got '{raw}'", schema)
+            kwargs[arg.name] = BOOLEAN_VALUES[raw.lower()]
+        elif arg.kind == "list":
+            values = [value.strip() for value in raw.split(',') if value.strip()]
+            if arg.required and not values:
+                raise ToolInputError(tool_name, f"'{arg.name}' needs at least one comma-separated value", schema)
+            kwargs[arg.name] = values
+        elif arg.choices and raw.lower() not in arg.choices:
+            raise ToolInputError(tool_name, f"'{arg.name}' must be one of {', '.join(arg.choices)}, got '{raw}'", schema)
+        else:
+            kwargs[arg.name] = raw.lower() if arg.choices else raw
+    return kwargs
+
+
+def with_schema(tool_name, func):
+    """Wrap a tool function so the agent's Action Input is parsed against its schema"""
+    def run(query):
+        with tracer.span(f"tool.{tool_name}", {"tool": tool_name}):
+            return func(**parse_tool_input(tool_name, query))
+    return run
+
+
 city_explorer_tools = [
     Tool(
         name="DayPlannerTool",
-        func=lambda query: day_planner_tool(
-            mood=query.split('|')[0] if '|' in query else "neutral",
-            time_slot=query.split('|')[1] if '|' in query and len(query.split('|')) > 1 else "full day",
-            specific_interests=query.split('|')[2] if '|' in query and len(
-                query.split('|')) > 2 else "local attractions",
-            location=query.split('|')[3] if '|' in query and len(query.split('|')) > 3 else "current location"
-        ),
+        func=with_schema("DayPlannerTool", day_planner_tool),
         description=(
             "Generate a customized day itinerary for any city based on user preferences. "
             "This tool provides a structured plan with activities, time slots, and practical tips. "
@@ -761,12 +3070,7 @@ city_explorer_tools = [
     ),
     Tool(
         name="BookmarkTool",
-        func=lambda query: bookmark_tool(
-            place=query.split('|')[0],
-            note=query.split('|')[1] if '|' in query and len(query.split('|')) > 1 else "No note provided.",
-            category=query.split('|')[2] if '|' in query and len(query.split('|')) > 2 else "general",
-            location=query.split('|')[3] if '|' in query and len(query.split('|')) > 3 else "current location"
-        ),
+        func=with_schema("BookmarkTool", bookmark_tool),
         description=(
             "Save a specific place to the user's personal bookmarks with a note, category, and location. "
             "Use this when the user expresses a desire to 'save', 'bookmark', 'remember', or 'add to favorites' a place.\n"
@@ -780,7 +3084,7 @@ city_explorer_tools = [
     ),
     Tool(
         name="GetBookmarksTool",
-        func=lambda query: get_bookmarks_tool(location=query if query else ""),
+        func=with_schema("GetBookmarksTool", get_bookmarks_tool),
         description=(
             "Retrieve and list all of the user's saved bookmarks. "
             "Optionally filter bookmarks by a specific location. "
@@ -792,12 +3096,7 @@ city_explorer_tools = [
     ),
     Tool(
         name="POITool",
-        func=lambda query: poi_tool(
-            interest_type=query.split('|')[0],
-            location=query.split('|')[1] if '|' in query and len(query.split('|')) > 1 else "current location",
-            hidden_gems_only=query.split('|')[2].lower() == 'true' if '|' in query and len(
-                query.split('|')) > 2 else False
-        ),
+        func=with_schema("POITool", poi_tool),
         description=(
             "Recommend interesting points of interest (POIs), attractions, or activities in a given city, "
             "optionally focusing only on 'hidden gems' or local secrets. "
@@ -812,11 +3111,7 @@ city_explorer_tools = [
     ),
     Tool(
         name="InterestTool",
-        func=lambda query: interest_tool(
-            interest=query.split('|')[0],
-            action=query.split('|')[1] if '|' in query and len(query.split('|')) > 1 else "add_like",
-            location=query.split('|')[2] if '|' in query and len(query.split('|')) > 2 else "current location"
-        ),
+        func=with_schema("InterestTool", interest_tool),
         description=(
             "Manage the user's personal likes, dislikes, and travel preferences. "
             "This tool updates the user's profile to personalize future recommendations. "
@@ -828,14 +3123,20 @@ city_explorer_tools = [
             "location: (e.g., 'Barcelona', 'Singapore', '{current_location}') - **ALWAYS provide a specific city if relevant to the interest**"
         )
     ),
+    Tool(
+        name="ReplyFormatTool",
+        func=with_schema("ReplyFormatTool", reply_format_tool),
+        description=(
+            "Change how the user receives replies: as text, as voice notes, or both. "
+            "Use this when the user asks for 'text only', 'no voice notes', 'send audio', 'voice only' or 'both'.\n"
+            "Format: 'mode'\n"
+            "Example: 'text'\n"
+            "mode: (string, required) Must be one of: 'text', 'audio', or 'both'"
+        )
+    ),
     Tool(
         name="StoryModeTool",
-        func=lambda query: story_mode_tool(
-            locations=query.split('|')[0].split(','),
-            theme=query.split('|')[1] if '|' in query and len(query.split('|')) > 1 else "adventure",  # Default theme
-            perspective=query.split('|')[2] if '|' in query and len(query.split('|')) > 2 else "third person",
-            location=query.split('|')[3] if '|' in query and len(query.split('|')) > 3 else "current location"
-        ),
+        func=with_schema("StoryModeTool", story_mode_tool),
         description=(
             "Generate an engaging narrative story about visiting specific locations in a given city. "
             "This tool creates creative travel narratives based on user-defined locations, theme, and perspective. "
@@ -850,7 +3151,7 @@ city_explorer_tools = [
     ),
     Tool(
         name="GetUserProfileTool",
-        func=lambda query: get_user_profile_tool(location=query if query else ""),
+        func=with_schema("GetUserProfileTool", get_user_profile_tool),
         description=(
             "Retrieve and display the user's comprehensive travel profile, "
             "including their interests, saved bookmarks, story history, and current plan details. "
@@ -863,7 +3164,7 @@ city_explorer_tools = [
     ),
     Tool(
         name="LiveEventsTool",
-        func=lambda query: get_live_events_tool(city=query),
+        func=with_schema("LiveEventsTool", get_live_events_tool),
         description=(
             "Get live events happening in a specific city this weekend. "
             "Use this when the user asks about 'events', 'concerts', 'shows', 'what's happening', "
@@ -875,7 +3176,7 @@ city_explorer_tools = [
     ),
     Tool(
         name="WeatherTool",
-        func=lambda query: get_weather_tool(city=query),
+        func=with_schema("WeatherTool", get_weather_tool),
         description=(
             "Get current weather information for a specific city. "
             "Use this when the user asks about 'weather', 'temperature', 'climate', "
@@ -887,10 +3188,7 @@ city_explorer_tools = [
     ),
     Tool(
         name="NewsTool",
-        func=lambda query: get_news_tool(
-            location=query.split('|')[0],
-            topic=query.split('|')[1] if '|' in query and len(query.split('|')) > 1 else ""
-        ),
+        func=with_schema("NewsTool", get_news_tool),
         description=(
             "Get top current news for a specific location, optionally filtered by topic. "
             "Use this when the user asks about 'news', 'latest updates', 'what's happening in', "
@@ -903,10 +3201,7 @@ city_explorer_tools = [
     ),
     Tool(
         name="PlacesFinderTool",
-        func=lambda query: get_places_tool(
-            query=query.split('|')[0],
-            location=query.split('|')[1] if '|' in query and len(query.split('|')) > 1 else "current location"
-        ),
+        func=with_schema("PlacesFinderTool", get_places_tool),
         description=(
             "Find specific types of places like hospitals, restaurants, ATMs, pharmacies, etc. in a given location. "
             "Use this when the user asks to 'find', 'locate', 'where is the nearest', "
@@ -945,6 +3240,7 @@ When the user asks for:
 - Viewing saved places → Use GetBookmarksTool
 - Finding places/recommendations → Use POITool
 - Managing likes/dislikes → Use InterestTool
+- Text or voice replies → Use ReplyFormatTool
 - Creating stories → Use StoryModeTool
 - Profile info → Use GetUserProfileTool
 - Current events/shows → Use LiveEventsTool
@@ -962,6 +3258,7 @@ Action Input: [properly_formatted_input]
 -  GetBookmarksTool: Just provide location name or leave empty for all bookmarks
 -  POITool: Format 'interest_type|location|hidden_gems_only' (e.g., 'food|{location}|true')
 -  InterestTool: Format 'interest|action|location' (actions: add_like, add_dislike, remove)
+-  ReplyFormatTool: Format 'mode' (text, audio or both)
 -  StoryModeTool: Format 'location1,location2|theme|perspective|city' (themes: adventure, historical, romantic, mystery)
 -  GetUserProfileTool: Provide location for location-specific profile data
 -  LiveEventsTool: Just provide city name (e.g., '{location}')
@@ -983,6 +3280,39 @@ Now the user says:
 Analyze the request and determine if you need to use a tool. If yes, use the Action/Action Input format. If no, respond directly.
 """
 
+# Static part of the agent prompt for PROMPT_MODE=precompiled. It is rendered once at startup
+# from the tool list and, when enabled, uploaded as a Gemini context cache so only the per-turn
+# section is sent.
+tool_catalog = "\n".join([f"- {tool.name}: {tool.description}" for tool in tools])
+agent_static_prompt = f"""You are CityGuide.AI – a cheerful, multilingual, and super helpful AI city guide.
+Your job is to be the travel buddy every explorer wishes they had: informative, inspiring, occasionally funny, and always ready to uncover the hidden gems of any city.
+Each message tells you the user's current location, their mood and your chat memory with them. Guide them like a local would—with warmth, wit, and wonderful recommendations.
+
+Available Tools:
+{tool_catalog}
+
+TOOL FORMAT (use EXACTLY this format):
+Action: [exact_tool_name]
+Action Input: [properly_formatted_input]
+
+IMPORTANT INSTRUCTIONS:
+- ALWAYS use tools when the user's request matches tool capabilities
+- Use the user's current location in tool calls unless they name another city
+- Format tool inputs EXACTLY as specified in each tool's Format
+- Be proactive with tool usage - don't just answer generically when tools can help
+- Under no circumstances should you include emojis. Express tone using only words.
+- Analyze each request and determine if you need to use a tool. If yes, use the Action/Action Input format. If no, respond directly.
+"""
+
+agent_turn_prompt = """The user you're speaking with is currently in {location}. They are feeling {mood}.
+
+Chat Memory:
+{chat_history}
+
+Now the user says:
+"{input}"
+"""
+
 class AgentState(TypedDict):
     messages: Annotated[list, add_messages]
     location: str
@@ -991,38 +3321,137 @@ class AgentState(TypedDict):
     detected_language: str
 
 prompt_template = ChatPromptTemplate.from_template(prompt_string)
+agent_turn_template = ChatPromptTemplate.from_template(agent_turn_prompt)
 tool_node = ToolNode(tools)
 
+_agent_cache_lock = threading.Lock()
+# (tier, max_output_tokens) -> {'llm', 'expires_at', 'retry_at'}
+_agent_caches = {}
+
+
+def get_agent_llm(tier, call_site="agent"):
+    """Return (llm, prefix messages) for agent calls (agent, agent_final) on a model tier.
+
+    Uses an LLM bound to a Gemini context cache holding agent_static_prompt when caching
+    is enabled, one cache per tier since a cache belongs to one model; otherwise sends the
+    static prompt as a system message on every call.
+    """
+    static_messages = [SystemMessage(content=agent_static_prompt)]
+    llm = model_policy.chat_model(tier, call_site)
+    if not GEMINI_CONTEXT_CACHE:
+        return llm, static_messages
+    if len(agent_static_prompt) / 4 < GEMINI_CACHE_MIN_TOKENS:
+        # Creating the cache would fail on every retry window
+        return llm, static_messages
+
+    max_output_tokens = model_policy.output_limit(tier, call_site)
+    with _agent_cache_lock:
+        now = time.time()
+        cached = _agent_caches.setdefault((tier, max_output_tokens), {'llm': None, 'expires_at': 0, 'retry_at': 0})
+        if cached['llm'] is not None and cached['expires_at'] > now:
+            return cached['llm'], []
+        if cached['retry_at'] > now:
+            return llm, static_messages
+        try:
+            config = MODEL_TIERS[tier]
+            cache = genai.caching.CachedContent.create(
+                model=f"models/{config['model']}",
+                display_name=f"cityguide-agent-prompt-{tier}",
+                system_instruction=agent_static_prompt,
+                ttl=datetime.timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL)
+            )
+            cached['llm'] = ChatGoogleGenerativeAI(
+                model=config['model'],
+                cached_content=cache.name,
+                max_output_tokens=max_output_tokens,
+                temperature=config['temperature'],
+                timeout=UPSTREAM_TIMEOUTS['gemini'],
+                max_retries=LLM_MAX_RETRIES
+            )
+            # Recreate the cache a minute before Gemini expires it
+            cached['expires_at'] = now + GEMINI_CONTEXT_CACHE_TTL - 60
+            return cached['llm'], []
+        except Exception as e:
+            print(f"Gemini context cache for the {tier} tier unavailable, sending the static prompt inline: {e}")
+            cached['llm'] = None
+            cached['retry_at'] = now + 600
+            return llm, static_messages
+
 def agent_node(state: AgentState):
     chat_history = "\n".join([f"{msg.type}: {msg.content}" for msg in state["messages"][:-1]])
     last_message = state["messages"][-1]
     detected_language = state.get("detected_language", "English")
 
-    formatted_prompt = prompt_template.format(
-        location=state["location"],
-        mood=state["mood"],
-        chat_history=chat_history,
-        detected_language=detected_language,
-        tools="\n".join([f"- {tool.name}: {tool.description}" for tool in tools]),
-        input=last_message.content
-    )
+    tier = model_policy.choose("agent")
+    if PROMPT_MODE == "precompiled":
+        agent_llm, prefix_messages = get_agent_llm(tier)
+        formatted_prompt = agent_turn_template.format(
+            location=state["location"],
+            mood=state["mood"],
+            chat_history=chat_history,
+            input=last_message.content
+        )
+    else:
+        agent_llm, prefix_messages = model_policy.chat_model(tier, "agent"), []
+        formatted_prompt = prompt_template.format(
+            location=state["location"],
+            mood=state["mood"],
+            chat_history=chat_history,
+            detected_language=detected_language,
+            tools=tool_catalog,
+            input=last_message.content
+        )
+
+    try:
+        response = invoke_llm(prefix_messages + [HumanMessage(content=formatted_prompt)], "agent", agent_llm, tier)
+    except Overloaded:
+        # Shed the turn; process_turn tells the user we are busy
+        raise
+    except Exception as e:
+        print(f"Agent LLM call failed: {e}")
+        return {"messages": [AIMessage(content="Sorry, I'm having trouble thinking right now. Please try again in a moment.")]}
+
+    for attempt in range(TOOL_INPUT_RETRIES + 1):
+        action = parse_action(response.content)
+        if not action or action[0] not in tools_by_name:
+            break
+        tool_name, tool_input = action
+        try:
+            tool_result = tools_by_name[tool_name].func(tool_input)
+        except Overloaded:
+            raise
+        except ToolInputError as e:
+            if attempt == TOOL_INPUT_RETRIES:
+                return {"messages": [
+                    AIMessage(content=f"I encountered an error using the {tool_name} tool: {str(e)}")]}
+            # Let the agent fix its Action Input instead of running the tool with silent defaults
+            retry_prompt = f"""
+                        {formatted_prompt}
 
-    response = llm.invoke([HumanMessage(content=formatted_prompt)])
+                        Action: {tool_name}
+                        Action Input: {tool_input}
+                        Observation: {str(e)}
 
-    if "Action:" in response.content and "Action Input:" in response.content:
-        lines = response.content.split('\n')
-        action_line = next((line for line in lines if line.startswith("Action:")), None)
-        action_input_line = next((line for line in lines if line.startswith("Action Input:")), None)
+                        Reply again with only the corrected Action and Action Input.
+                        """
+            try:
+                response = invoke_llm(prefix_messages + [HumanMessage(content=retry_prompt)], "agent_retry", agent_llm, tier)
+            except Overloaded:
+                raise
+            except Exception:
+                return {"messages": [
+                    AIMessage(content=f"I encountered an error using the {tool_name} tool: {str(e)}")]}
+            continue
+        except Exception as e:
+            return {"messages": [
+                AIMessage(content=f"I encountered an error using the {tool_name} tool: {str(e)}")]}
 
-        if action_line and action_input_line:
-            tool_name = action_line.split("Action:")[1].strip()
-            tool_input = action_input_line.split("Action Input:")[1].strip()
+        if isinstance(tool_result, DeferredReply):
+            # The real answer is pushed when the background job finishes; acknowledge right away,
+            # in the user's language since the final agent pass is skipped
+            return {"messages": [AIMessage(content=in_language(str(tool_result), detected_language))]}
 
-            for tool in tools:
-                if tool.name == tool_name:
-                    try:
-                        tool_result = tool.func(tool_input)
-                        final_prompt = f"""
+        final_prompt = f"""
                         {formatted_prompt}
 
                         Action: {tool_name}
@@ -1037,21 +3466,181 @@ def agent_node(state: AgentState):
                         - You are CityGuide.AI – speak in your usual cheerful tone, but make sure the full itinerary is visible to the user.
                         """
 
-                        final_response = llm.invoke([HumanMessage(content=final_prompt)])
-                        return {"messages": [AIMessage(content=final_response.content)]}
-                    except Exception as e:
-                        return {"messages": [
-                            AIMessage(content=f"I encountered an error using the {tool_name} tool: {str(e)}")]}
+        # Restating the tool output runs on its own (usually cheaper) tier
+        final_tier = model_policy.choose("agent_final")
+        if PROMPT_MODE == "precompiled":
+            final_llm, final_prefix = get_agent_llm(final_tier, "agent_final")
+        else:
+            final_llm, final_prefix = model_policy.chat_model(final_tier, "agent_final"), []
+        try:
+            final_response = invoke_llm(final_prefix + [HumanMessage(content=final_prompt)], "agent_final", final_llm, final_tier)
+        except Overloaded:
+            raise
+        except Exception as e:
+            # Out of time or Gemini unavailable: the tool output is still a useful answer
+            print(f"Final agent LLM call failed, replying with the raw tool output: {e}")
+            return {"messages": [AIMessage(content=tool_result)]}
+        return {"messages": [AIMessage(content=final_response.content)]}
 
     return {"messages": [AIMessage(content=response.content)]}
 
+
+def parse_action(text):
+    """Extract (tool_name, tool_input) from an Action/Action Input reply, or None"""
+    if "Action:" not in text or "Action Input:" not in text:
+        return None
+    lines = text.split('\n')
+    action_line = next((line for line in lines if line.startswith("Action:")), None)
+    action_input_line = next((line for line in lines if line.startswith("Action Input:")), None)
+    if not action_line or not action_input_line:
+        return None
+    return action_line.split("Action:")[1].strip(), action_input_line.split("Action Input:")[1].strip()
+
+
+class IntentRouter:
+    """Local classifier for requests that map straight onto a single tool.
+
+    Anchored rules catch the common phrasings ("weather in Pune", "show my bookmarks",
+    "what time is it") with full confidence; a named city must be a gazetteer city or alias,
+    so anything more specific ("weather in pune tomorrow") goes to the agent. A keyword model scores the rest by how much
+    of the message the intent's keywords explain, so "tell me the weather please" still
+    routes while "weather in Pune and plan my day" goes to the LLM agent.
+    """
+
+    CITY = r"(?P<city>[a-z][a-z .'-]{1,40}?)"
+    RULES = [
+        ("Time", r"(?:what(?: is|'s) the )?(?:current )?time(?: is it)?(?: now| right now)?"),
+        ("Time", r"what time is it(?: now| right now)?"),
+        ("WeatherTool", r"(?:(?:how|what)(?: is|'s) the )?(?:current )?weather(?: like)?(?: today| now| right now)?"),
+        ("WeatherTool", r"(?:(?:how|what)(?: is|'s) the )?(?:current )?weather(?: like)?(?: today| now| right now)? (?:in|at|for) " + CITY + r"(?: today| now| right now)?"),
+        ("WeatherTool", CITY + r" weather(?: today| now| right now)?"),
+        ("GetBookmarksTool", r"(?:(?:show|list|see|view|display|get)(?: me)?(?: all)? )?my (?:bookmarks|saved places|saved spots)"),
+        ("GetBookmarksTool", r"(?:(?:show|list|see|view|display|get)(?: me)?(?: all)? )?my (?:bookmarks|saved places|saved spots) (?:in|for) " + CITY),
+        ("GetUserProfileTool", r"(?:(?:show|see|view|display|get)(?: me)? )?my (?:travel )?profile"),
+        ("NewsTool", r"(?:(?:show|get|tell)(?: me)? )?(?:the )?(?:latest |top |today's )?news(?: today)?"),
+        ("NewsTool", r"(?:(?:show|get|tell)(?: me)? )?(?:the )?(?:latest |top |today's )?news (?:in|from|for) " + CITY + r"(?: today)?"),
+        ("LiveEventsTool", r"(?:(?:what|which|any) )?(?:live )?events(?: are there| are happening)?(?: this weekend| today| tonight)?"),
+        ("LiveEventsTool", r"(?:(?:what|which|any) )?(?:live )?events(?: are there| are happening)? (?:in|around) " + CITY + r"(?: this weekend| today| tonight)?"),
+    ]
+    KEYWORDS = {
+        "Time": {"time": 1.0, "clock": 1.0},
+        "WeatherTool": {"weather": 1.0, "temperature": 1.0, "umbrella": 0.8, "raining": 0.8, "humid": 0.8},
+        "GetBookmarksTool": {"bookmarks": 1.0, "bookmarked": 1.0, "saved": 0.6, "places": 0.4},
+        "GetUserProfileTool": {"profile": 1.0, "preferences": 0.8},
+        "NewsTool": {"news": 1.0, "headlines": 1.0},
+        "LiveEventsTool": {"events": 1.0, "concerts": 1.0, "shows": 0.8, "weekend": 0.3},
+    }
+    FILLER = {
+        "a", "an", "the", "is", "it", "its", "what", "whats", "how", "hows", "me", "my", "show", "tell",
+        "please", "pls", "can", "you", "could", "i", "see", "list", "get", "give", "current", "now",
+        "today", "right", "like", "all", "are", "there", "any", "latest", "top", "hey", "hi", "this",
+        "do", "have", "in", "at", "for", "of", "to", "need", "should", "bring"
+    }
+    # Words that never appear in a city name captured by the patterns above
+    NOT_CITY = FILLER | {"and", "or", "then", "also", "but", "with", "plan", "weather", "news", "events"}
+    # Intents that fall back to the user's current location when no city is named
+    LOCATION_DEFAULTS = {"WeatherTool", "NewsTool", "LiveEventsTool"}
+
+    def __init__(self):
+        self.rules = [(tool_name, re.compile(pattern)) for tool_name, pattern in self.RULES]
+
+    @staticmethod
+    def normalize(text):
+        text = (text or "").lower().strip()
+        text = re.sub(r"[?!.,]+", " ", text)
+        text = re.sub(r"^(?:hey|hi|hello|ok|okay)\s+", "", text)
+        text = re.sub(r"\s+please$|^please\s+", "", text.strip())
+        return re.sub(r"\s+", " ", text).strip()
+
+    def classify(self, text, current_location=""):
+        """Return (tool_name, tool_input, confidence); tool_name is None when nothing fits"""
+        normalized = self.normalize(text)
+        if not normalized or len(normalized) > 120:
+            return None, None, 0.0
+
+        for tool_name, pattern in self.rules:
+            match = pattern.fullmatch(normalized)
+            if match:
+                city = (match.groupdict().get("city") or "").strip()
+                if not self._is_city(city):
+                    # "tell me the weather" is not a city called "tell me the"
+                    continue
+                if city and not location_normalizer.exact(city):
+                    # "pune tomorrow", "pune vs mumbai" or a city outside the gazetteer: let the agent read it
+                    return None, None, 0.0
+                return self._with_location(tool_name, city, current_location, 1.0)
+
+        return self._keyword_score(normalized, current_location)
+
+    def _keyword_score(self, normalized, current_location):
+        city = ""
+        city_match = re.search(r"\b(?:in|at|for) (?P<city>[a-z][a-z .'-]{1,40})$", normalized)
+        words = normalized.split()
+        if city_match:
+            city = city_match.group("city").strip()
+            if not self._is_city(city) or not location_normalizer.exact(city):
+                return None, None, 0.0
+            words = normalized[:city_match.start()].split()
+        content = [w.replace("'", "") for w in words if w.replace("'", "") not in self.FILLER]
+        if not content:
+            return None, None, 0.0
+
+        best_tool, best_score = None, 0.0
+        for tool_name, keywords in self.KEYWORDS.items():
+            score = sum(keywords.get(word, 0.0) for word in content) / len(content)
+            if score > best_score:
+                best_tool, best_score = tool_name, score
+        if best_tool is None:
+            return None, None, 0.0
+        return self._with_location(best_tool, city, current_location, min(best_score, 1.0))
+
+    def _is_city(self, city):
+        return not any(word in self.NOT_CITY for word in city.split())
+
+    def _with_location(self, tool_name, city, current_location, confidence):
+        if tool_name in self.LOCATION_DEFAULTS and not city:
+            if not current_location:
+                return None, None, 0.0
+            city = current_location
+        if tool_name == "Time" and city:
+            # The Time tool only knows the server's clock, so "time in Tokyo" goes to the agent
+            return None, None, 0.0
+        return tool_name, city.title() if city else "", confidence
+
+
+intent_router = IntentRouter()
+tools_by_name = {tool.name: tool for tool in tools}
+
+
+def router_node(state: AgentState):
+    """Dispatch high-confidence simple intents straight to their tool, skipping both LLM calls"""
+    if not INTENT_ROUTER:
+        return {"messages": []}
+    tool_name, tool_input, confidence = intent_router.classify(state["messages"][-1].content, state["location"])
+    if tool_name is None or confidence < INTENT_ROUTER_THRESHOLD:
+        return {"messages": []}
+    try:
+        tool_result = tools_by_name[tool_name].func(tool_input)
+    except Exception as e:
+        print(f"Routed {tool_name} call failed, falling back to the agent: {e}")
+        return {"messages": []}
+    print(f"Intent router answered with {tool_name} ({confidence:.2f})")
+    return {"messages": [AIMessage(content=tool_result)]}
+
+
+def route_after_router(state: AgentState):
+    return END if isinstance(state["messages"][-1], AIMessage) else "agent"
+
+
 def should_continue(state: AgentState):
     last_message = state["messages"][-1]
     return END
 
 workflow = StateGraph(AgentState)
+workflow.add_node("router", router_node)
 workflow.add_node("agent", agent_node)
-workflow.set_entry_point("agent")
+workflow.set_entry_point("router")
+workflow.add_conditional_edges("router", route_after_router)
 workflow.add_conditional_edges("agent", should_continue)
 
 app_langgraph = workflow.compile()
@@ -1072,7 +3661,7 @@ Start each conversation warmly, adapt to the user's mood and location, and alway
 """
 
 
-def generate_unique_file_paths(user_phone, file_type="audio"):
+def generate_unique_file_paths(user_phone, file_type="audio", extension="mp3"):
     """Generate unique file paths for each user and request"""
     sanitized_phone = re.sub(r'\D', '', user_phone)  # Remove non-digits
     timestamp = int(time.time())
@@ -1083,8 +3672,7 @@ def generate_unique_file_paths(user_phone, file_type="audio"):
         mp3_path = f"incoming_{sanitized_phone}_{timestamp}_{unique_id}.mp3"
         return ogg_path, mp3_path
     elif file_type == "outgoing":
-        mp3_path = f"output_{sanitized_phone}_{timestamp}_{unique_id}.mp3"
-        return mp3_path
+        return f"output_{sanitized_phone}_{timestamp}_{unique_id}.{extension}"
 
 
 def cleanup_incoming_files(ogg_path, mp3_path):
@@ -1104,24 +3692,195 @@ def cleanup_incoming_files(ogg_path, mp3_path):
     except Exception as e:
         print(f"Error deleting incoming MP3 file {mp3_path}: {e}")
 
-@app.route("/incoming", methods=["POST"])
-def incoming():
-    from_number = request.form.get("From")
-    message_body = request.form.get("Body", "")
-    media_url = request.form.get("MediaUrl0")
-    resp = MessagingResponse()
+class ConversationScheduler:
+    """Runs turns for the same user strictly in order while different users run concurrently.
 
-    # Ensure user exists and get their data
-    user_manager.ensure_user_exists(from_number)
-    user_data = user_manager.get_user_data()
-    current_location = user_data.get('interests', {}).get('current_location', 'Delhi')
-    stored_language = user_data.get('detected_language', 'English')
+    Every phone number gets its own FIFO queue and at most one runner drains it at a time,
+    so two quick messages never load the same chat history in parallel. Across gunicorn
+    workers a lease document in turn_leases/<phone> keeps a user on one worker at a time.
+    The lease also records the worker that ran the user's last turn; when that was another
+    worker, the turn is marked reload_profile so the profile (and chat history) is read from
+    Firestore instead of this worker's possibly stale cached copy.
+    Text messages that queue up while a turn is running can be merged into one agent turn.
+    """
 
-    # Create user-specific memory instance
-    user_memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+    def __init__(self, handler, db_instance, max_workers=8, merge_messages=True, merge_window=0.0,
+                 lease_seconds=120):
+        self.handler = handler
+        self.db = db_instance
+        self.merge_messages = merge_messages
+        self.merge_window = merge_window
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="turn")
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.active = set()
+
+    def backlog(self):
+        """Messages queued and not yet picked up, across all users"""
+        with self.lock:
+            return sum(len(pending) for pending in self.queues.values())
+
+    def submit(self, key, message):
+        """Queue a message for its user and start a runner if none is active"""
+        with self.lock:
+            self.queues.setdefault(key, deque()).append(message)
+            if key in self.active:
+                return
+            self.active.add(key)
+        self.executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        if self.merge_window:
+            # Give back-to-back messages a moment to arrive before the first turn
+            time.sleep(self.merge_window)
+        while True:
+            with self.lock:
+                pending = self.queues.get(key)
+                if not pending:
+                    self.queues.pop(key, None)
+                    self.active.discard(key)
+                    return
+                batch = self._take_batch(pending)
+            self._run_with_lease(key, batch)
+
+    def _take_batch(self, pending):
+        """Pop the next message, folding consecutive text-only messages into it"""
+        first = pending.popleft()
+        if not self.merge_messages or first.get('media_url'):
+            return first
+        bodies = [first.get('body', '')]
+        while pending and not pending[0].get('media_url'):
+            bodies.append(pending.popleft().get('body', ''))
+        if len(bodies) > 1:
+            print(f"Merged {len(bodies)} queued messages into one turn for {first.get('from')}")
+        return dict(first, body="\n".join(b for b in bodies if b))
+
+    def _run_with_lease(self, key, message):
+        lease = self._acquire_lease(key)
+        if lease is None:
+            # Running without the lease could interleave two turns on the same chat history
+            print(f"Dropping turn for {message.get('from')}: could not acquire the turn lease")
+            metrics.inc("turn_lease_failures_total")
+            return
+        if lease['previous_holder'] != self.worker_id:
+            message = dict(message, reload_profile=True)
+        stop_renewing = threading.Event()
+        threading.Thread(target=self._renew_lease, args=(key, stop_renewing), daemon=True).start()
+        try:
+            self.handler(message)
+        except Exception as e:
+            print(f"Error processing turn for {message.get('from')}: {e}")
+        finally:
+            stop_renewing.set()
+            self._release_lease(key)
+
+    def _claim(self, key, renew=False):
+        """Take or extend the user's lease in a transaction; renew only extends a lease this worker holds.
+
+        Returns None if the lease is held elsewhere, else {'previous_holder': the worker that
+        ran the user's last turn, or None if unknown}.
+        """
+        lease_ref = self.db.collection('turn_leases').document(key)
+
+        @firestore.transactional
+        def claim(transaction):
+            snapshot = lease_ref.get(transaction=transaction)
+            now = time.time()
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            if lease.get('holder') != self.worker_id and (renew or lease.get('expires_at', 0) > now):
+                return None
+            transaction.set(lease_ref, {'holder': self.worker_id, 'expires_at': now + self.lease_seconds})
+            return {'previous_holder': lease.get('holder')}
+
+        return claim(self.db.transaction())
+
+    def _acquire_lease(self, key):
+        """Block until this worker holds the user's lease (an expired lease is taken over).
+
+        Firestore errors are retried like contention; returns the claim (see _claim), or None
+        if the lease could not be taken within lease_seconds.
+        """
+        deadline = time.time() + self.lease_seconds
+        delay = 0.1
+        while True:
+            try:
+                lease = self._claim(key)
+                if lease is not None:
+                    return lease
+            except Exception as e:
+                print(f"Error acquiring turn lease for {key}: {e}")
+                metrics.inc("turn_lease_errors_total", {"operation": "acquire"})
+            if time.time() >= deadline:
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+
+    def _renew_lease(self, key, stop):
+        """Extend the lease every third of its lifetime until the turn finishes"""
+        while not stop.wait(self.lease_seconds / 3):
+            try:
+                if self._claim(key, renew=True) is None:
+                    print(f"Turn lease for {key} was taken over while the turn was running")
+                    metrics.inc("turn_lease_lost_total")
+                    return
+            except Exception as e:
+                print(f"Error renewing turn lease for {key}: {e}")
+                metrics.inc("turn_lease_errors_total", {"operation": "renew"})
+
+    def _release_lease(self, key):
+        try:
+            lease_ref = self.db.collection('turn_leases').document(key)
+            snapshot = lease_ref.get()
+            if snapshot.exists and snapshot.to_dict().get('holder') == self.worker_id:
+                # Expire rather than delete, so the next turn knows which worker ran this one
+                lease_ref.update({'expires_at': 0})
+        except Exception as e:
+            print(f"Error releasing turn lease for {key}: {e}")
+
+
+def process_turn(message):
+    """Run one queued WhatsApp message as a traced turn, keyed by the trace ID set in /incoming"""
+    if message.get('received_at'):
+        metrics.observe("stage_duration_seconds", time.time() - message['received_at'], {"stage": "queue_wait"})
+    trace_id = message.get('trace_id') or tracer.new_trace_id()
+    with tracer.span("turn", {"media": bool(message.get('media_url'))}, trace_id=trace_id):
+        try:
+            run_turn(message)
+        except Overloaded as e:
+            metrics.inc("turns_shed_total", {"stage": e.stage})
+            send_text(message['from'], BUSY_MESSAGE, key=f"busy:{message.get('message_sid') or trace_id}")
+
+
+def run_turn(message):
+    """Run one agent turn for a queued WhatsApp message"""
+    set_turn_deadline(TURN_DEADLINE_SECONDS)
+    from_number = message['from']
+    message_body = message.get('body', '')
+    # Twilio redelivers a webhook it saw no answer for with the same MessageSid; keying the
+    # replies on it keeps the outbound queue from sending them twice
+    reply_key = message.get('message_sid') or tracer.current_trace_id()
+    media_url = message.get('media_url')
+
+    with tracer.span("load_profile"):
+        # Ensure user exists and get their data; re-read it if another worker ran the last turn
+        user_manager.ensure_user_exists(from_number, reload=message.get('reload_profile', False))
+        user_data = user_manager.get_user_data()
+        current_location = user_data.get('interests', {}).get('current_location', 'Delhi')
+        stored_language = user_data.get('detected_language', 'English')
+
+        # Create user-specific memory instance
+        user_memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+
+        # Load user's chat history into this memory instance
+        loaded_chat_messages = user_manager.load_chat_history()
+
+    if usage_ledger.over_budget(user_manager.current_user_id):
+        metrics.inc("turns_over_budget_total")
+        send_text(from_number, BUDGET_EXCEEDED_MESSAGE, key=f"budget:{reply_key}")
+        return
 
-    # Load user's chat history into this memory instance
-    loaded_chat_messages = user_manager.load_chat_history()
     user_memory.chat_memory.add_message(SystemMessage(content=initial_message))
     for msg in loaded_chat_messages:
         user_memory.chat_memory.add_message(msg)
@@ -1140,22 +3899,35 @@ def incoming():
         ogg_path, mp3_path = generate_unique_file_paths(from_number, "incoming")
 
         try:
-            response = requests.get(media_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
+            with tracer.span("media_download"):
+                response = call_upstream('twilio_media', lambda timeout: requests.get(
+                    media_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN), timeout=timeout))
+                response.raise_for_status()
 
-            with open(ogg_path, "wb") as f:
-                f.write(response.content)
+                with open(ogg_path, "wb") as f:
+                    f.write(response.content)
 
-            audio = AudioSegment.from_ogg(ogg_path)
-            audio.export(mp3_path, format="mp3",bitrate = "64k")
+            with tracer.span("audio_transcode"):
+                audio = AudioSegment.from_ogg(ogg_path)
+                audio.export(mp3_path, format="mp3",bitrate = "64k")
 
-            detected_language, transcribed_text = transcribe_and_identify_language(mp3_path)
+            with stage_limiter.slot('transcription'), tracer.span("transcribe"):
+                detected_language, transcribed_text = transcribe_and_identify_language(mp3_path)
 
             if detected_language != "Unknown" and detected_language != stored_language:
                 user_manager.update_detected_language(detected_language)
                 stored_language = detected_language
 
-            detected_mood = detect_mood(transcribed_text)
-
+            try:
+                with stage_limiter.slot('mood'), tracer.span("detect_mood"):
+                    detected_mood = detect_mood(transcribed_text)
+            except Overloaded:
+                # The mood only tints the reply; answer with a neutral one rather than shed the turn
+                metrics.inc("stage_skipped_total", {"stage": "mood"})
+
+        except Overloaded:
+            threading.Thread(target=cleanup_incoming_files, args=(ogg_path, mp3_path)).start()
+            raise
         except Exception as e:
             print(f"Error processing audio for {from_number}: {e}")
             transcribed_text = "Sorry, I couldn't process your audio message."
@@ -1174,7 +3946,8 @@ def incoming():
     )
 
     # Get AI response
-    result = app_langgraph.invoke(state)
+    with tracer.span("agent"):
+        result = app_langgraph.invoke(state)
     ai_response = result["messages"][-1].content
 
     # Add AI response to user's memory
@@ -1184,84 +3957,548 @@ def incoming():
     # Save this user's updated chat history
     user_manager.save_chat_history(user_memory.chat_memory.messages)
 
-    # Send text response immediately
-    #resp.message(ai_response)
-
-    # Start asynchronous audio response with user-specific data
-    def delayed_audio():
-        time.sleep(2)
-        send_audio(from_number, ai_response)
-
-    threading.Thread(target=delayed_audio).start()
+    # Text goes out first; the outbound workers synthesize and send the audio alongside it
+    delivery_mode = user_data.get('delivery_mode', DEFAULT_DELIVERY_MODE)
+    if delivery_mode not in DELIVERY_MODES:
+        delivery_mode = DEFAULT_DELIVERY_MODE
+    if delivery_mode in ("text", "both"):
+        send_text(from_number, ai_response, key=f"reply:{reply_key}:text")
+    if delivery_mode in ("audio", "both"):
+        queue_audio(from_number, ai_response, key=f"reply:{reply_key}")
+    metrics.inc("replies_total", {"delivery_mode": delivery_mode})
     if ogg_path or mp3_path:
         threading.Thread(target=cleanup_incoming_files, args=(ogg_path, mp3_path)).start()
 
-    return str(resp)
+
+turn_scheduler = ConversationScheduler(
+    process_turn,
+    db,
+    max_workers=TURN_WORKERS,
+    merge_messages=TURN_MERGE_MESSAGES,
+    merge_window=TURN_MERGE_WINDOW,
+    lease_seconds=TURN_LEASE_SECONDS
+)
+
+
+class DeferredReply(str):
+    """Tool output that only acknowledges a request; the result follows from a GenerationJobs worker"""
+
+
+def reply_language(user_data=None):
+    """The language replies are written in: the user's detected language, English until one is known"""
+    user_data = user_data if user_data is not None else (user_manager.get_user_data() or {})
+    language = (user_data.get('detected_language') or "").strip()
+    return language if language and language.lower() != "unknown" else "English"
+
+
+def in_language(text, language):
+    """A short fixed message (acknowledgement, apology) translated into language, or the original text.
+
+    Used where the agent's final pass, which answers in the user's language, does not run.
+    It never raises: the caller has already committed to sending something.
+    """
+    if not language or language.lower() in ("english", "unknown"):
+        return text
+    try:
+        translated = invoke_llm([HumanMessage(content=(
+            f"Translate this WhatsApp message into {language}. Keep names, numbers and emoji as they are. "
+            f"Reply with the translation only.\n\n{text}"
+        ))], "translate").content.strip()
+        return translated or text
+    except Exception as e:
+        print(f"Could not translate a message into {language}: {e}")
+        return text
+
+
+class GenerationJobs:
+    """Runs long generations (stories, day plans) in the background and pushes the result.
+
+    Each job is a document in generation_jobs/<id> that moves from queued to running (under a
+    lease, so only one worker runs it), generated (result stored) and done (delivered), or
+    failed after max_attempts. Every worker sweeps for unfinished jobs at startup and then
+    periodically, taking over jobs whose lease has expired (their worker died or gave up)
+    and jobs left queued, so a restart resumes or re-delivers work instead of losing it.
+    """
+
+    RESUMABLE = ('queued', 'running', 'generated')
+
+    def __init__(self, handlers, db_instance, max_workers=4, lease_seconds=300, max_attempts=2,
+                 deadline_seconds=180, send_audio_copy=False):
+        self.handlers = handlers
+        self.db = db_instance
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.deadline_seconds = deadline_seconds
+        self.send_audio_copy = send_audio_copy
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generation")
+        self.lock = threading.Lock()
+        self.active = 0
+        # Jobs scheduled or running in this worker; a sweep must not start a second copy
+        self.local = set()
+
+    def _ref(self, job_id):
+        return self.db.collection('generation_jobs').document(job_id)
+
+    def submit(self, kind, args):
+        """Persist a job for the current user and queue it; returns the job ID"""
+        job_id = uuid.uuid4().hex
+        self._ref(job_id).set({
+            'kind': kind,
+            'args': args,
+            'user_id': user_manager.current_user_id,
+            'status': 'queued',
+            'attempts': 0,
+            'trace_id': tracer.current_trace_id(),
+            'submitted_at': time.time(),
+            'queued_at': time.time(),
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        })
+        metrics.inc("generation_jobs_total", {"kind": kind, "outcome": "queued"})
+        self._schedule(job_id)
+        return job_id
+
+    def _schedule(self, job_id, delay=0):
+        with self.lock:
+            if job_id in self.local:
+                return
+            self.local.add(job_id)
+            self.active += 1
+        self.executor.submit(self._run, job_id, delay)
+
+    def recover(self):
+        """Schedule unfinished jobs that no live worker is handling"""
+        now = time.time()
+        try:
+            for status in self.RESUMABLE:
+                for doc in self.db.collection('generation_jobs').where('status', '==', status).stream():
+                    job = doc.to_dict()
+                    if status == 'queued':
+                        # A fresh job is already scheduled by the worker that queued it
+                        stale = job.get('queued_at', 0) + self.lease_seconds <= now
+                    else:
+                        stale = job.get('lease_expires_at', 0) <= now
+                    if stale:
+                        self._schedule(doc.id)
+        except Exception as e:
+            print(f"Error recovering generation jobs: {e}")
+
+    def sweep(self, interval):
+        """Run recover every interval seconds, forever; started on a daemon thread"""
+        while True:
+            self.recover()
+            time.sleep(interval)
+
+    def _claim(self, job_id):
+        """Take the job's lease; returns the job data, or None if it is finished or held elsewhere"""
+        job_ref = self._ref(job_id)
+
+        @firestore.transactional
+        def claim(transaction):
+            snapshot = job_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return None
+            job = snapshot.to_dict()
+            now = time.time()
+            if job.get('status') not in self.RESUMABLE:
+                return None
+            if job.get('status') != 'queued' and job.get('holder') != self.worker_id and job.get('lease_expires_at', 0) > now:
+                return None
+            updates = {'holder': self.worker_id, 'lease_expires_at': now + self.lease_seconds,
+                       'updated_at': firestore.SERVER_TIMESTAMP}
+            if job.get('status') != 'generated':
+                updates['status'] = 'running'
+                updates['attempts'] = job.get('attempts', 0) + 1
+            transaction.update(job_ref, updates)
+            job.update(updates)
+            return job
+
+        return claim(self.db.transaction())
+
+    def _run(self, job_id, delay=0):
+        retry_delay = None
+        try:
+            if delay:
+                time.sleep(delay)
+            job = self._claim(job_id)
+            if job is None:
+                return
+            with tracer.span(f"generation.{job['kind']}", {"job_id": job_id, "attempt": job['attempts']},
+                             trace_id=job.get('trace_id') or tracer.new_trace_id()):
+                retry_delay = self._process(job_id, job)
+        except Exception as e:
+            print(f"Error running generation job {job_id}: {e}")
+        finally:
+            with self.lock:
+                self.local.discard(job_id)
+                self.active -= 1
+        if retry_delay is not None:
+            self._schedule(job_id, delay=retry_delay)
+
+    def _process(self, job_id, job):
+        """Generate and deliver a claimed job; returns a delay in seconds when it should be retried"""
+        to_number = f"whatsapp:+{job['user_id']}"
+        if job['status'] != 'generated':
+            # Tools read and update the profile of the selected user on this thread
+            user_manager.ensure_user_exists(job['user_id'])
+            set_turn_deadline(self.deadline_seconds)
+            try:
+                result = self.handlers[job['kind']](**job['args'])
+            except Exception as e:
+                print(f"Generation job {job_id} ({job['kind']}) failed: {e}")
+                if job['attempts'] < self.max_attempts:
+                    self._ref(job_id).update({'status': 'queued', 'queued_at': time.time(), 'error': str(e),
+                                              'updated_at': firestore.SERVER_TIMESTAMP})
+                    metrics.inc("generation_jobs_total", {"kind": job['kind'], "outcome": "retried"})
+                    return 5 * job['attempts']
+                self._ref(job_id).update({'status': 'failed', 'error': str(e), 'updated_at': firestore.SERVER_TIMESTAMP})
+                metrics.inc("generation_jobs_total", {"kind": job['kind'], "outcome": "failed"})
+                apology = "Sorry, I couldn't finish that for you this time. Please ask me again in a little while."
+                send_text(to_number, in_language(apology, job['args'].get('language')),
+                          key=f"generation:{job_id}:failed")
+                return None
+            finally:
+                set_turn_deadline(None)
+            job['result'] = result
+            self._ref(job_id).update({'status': 'generated', 'result': result, 'updated_at': firestore.SERVER_TIMESTAMP})
+
+        if not send_text(to_number, job['result'], key=f"generation:{job_id}:text"):
+            # Stays 'generated' with its lease released, so the next sweep (in any worker) retries it
+            self._ref(job_id).update({'lease_expires_at': 0, 'updated_at': firestore.SERVER_TIMESTAMP})
+            metrics.inc("generation_jobs_total", {"kind": job['kind'], "outcome": "undelivered"})
+            return None
+        if self.send_audio_copy:
+            queue_audio(to_number, job['result'], key=f"generation:{job_id}:audio")
+        self._ref(job_id).update({'status': 'done', 'updated_at': firestore.SERVER_TIMESTAMP})
+        metrics.inc("generation_jobs_total", {"kind": job['kind'], "outcome": "done"})
+        if job.get('submitted_at'):
+            metrics.observe("generation_job_seconds", time.time() - job['submitted_at'], {"kind": job['kind']})
+
+
+generation_jobs = GenerationJobs(
+    {'story': write_story, 'day_planner': write_day_plan},
+    db,
+    max_workers=GENERATION_WORKERS,
+    lease_seconds=GENERATION_LEASE_SECONDS,
+    max_attempts=GENERATION_MAX_ATTEMPTS,
+    deadline_seconds=GENERATION_DEADLINE_SECONDS,
+    send_audio_copy=GENERATION_AUDIO
+)
+
+
+@app.route("/incoming", methods=["POST"])
+def incoming():
+    from_number = request.form.get("From")
+    message_body = request.form.get("Body", "")
+    media_url = request.form.get("MediaUrl0")
+    resp = MessagingResponse()
+
+    user_key = user_manager.validate_phone_number(from_number or "")
+    if not user_key:
+        return str(resp), 400
+
+    # The reply is delivered asynchronously, so acknowledge the webhook right away
+    trace_id = tracer.new_trace_id()
+    allowed, first_refusal = rate_limiter.allow(user_key, RATE_LIMIT_VOICE_COST if media_url else 1)
+    if not allowed:
+        metrics.inc("rate_limited_total", {"media": "true" if media_url else "false"})
+        if first_refusal:
+            # Answer in the webhook response: no worker, no queue, and only once per burst
+            resp.message(RATE_LIMITED_MESSAGE)
+        return str(resp), 200, {"X-Trace-Id": trace_id}
+    if TURN_MAX_BACKLOG and turn_scheduler.backlog() >= TURN_MAX_BACKLOG:
+        metrics.inc("turns_shed_total", {"stage": "backlog"})
+        resp.message(BUSY_MESSAGE)
+        return str(resp), 200, {"X-Trace-Id": trace_id}
+    turn_scheduler.submit(user_key, {
+        'from': from_number,
+        'body': message_body,
+        'media_url': media_url,
+        'message_sid': request.form.get("MessageSid"),
+        'trace_id': trace_id,
+        'received_at': time.time()
+    })
+    return str(resp), 200, {"X-Trace-Id": trace_id}
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    for status, count in outbound_queue.counts().items():
+        metrics.set("outbound_queue_messages", count, {"status": status})
+    for stage, state in stage_limiter.state().items():
+        for field, value in state.items():
+            metrics.set(f"stage_{field}", value, {"stage": stage})
+    limiter_state = rate_limiter.state()
+    metrics.set("rate_limiter_tracked_users", limiter_state['tracked'])
+    metrics.set("rate_limiter_limited_users", limiter_state['limited'])
+    metrics.set("turn_backlog", turn_scheduler.backlog())
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+@app.route("/model-tiers", methods=["GET"])
+def model_tiers_endpoint():
+    return json.dumps(model_policy.report(), indent=2), 200, {"Content-Type": "application/json"}
+
+
+# Outgoing voice notes not yet fetched by Twilio: filename -> format and delivery timestamps.
+# Per process, so a fetch served by another gunicorn worker goes untimed.
+audio_files = {}
 
 
 @app.route('/audio/<filename>')
 def serve_audio(filename):
+    sent = audio_files.pop(filename, None)
+    if sent:
+        now = time.time()
+        metrics.observe("audio_fetch_delay_seconds", now - sent['sent_at'], {"format": sent['format']})
+        if sent.get('queued_at'):
+            # Reply queued -> media fetched by Twilio, the last step we can observe
+            metrics.observe("audio_end_to_end_seconds", now - sent['queued_at'], {"format": sent['format']})
     return send_from_directory('.', filename)
 
 
+def split_message(text, limit=WHATSAPP_TEXT_LIMIT):
+    """Split text into WhatsApp-sized parts, preferring paragraph, then line, then word breaks"""
+    parts = []
+    text = text.strip()
+    while len(text) > limit:
+        cut = max(text.rfind("\n\n", 0, limit), text.rfind("\n", 0, limit))
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].strip())
+        text = text[cut:].strip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+def whatsapp_address(number):
+    return number if number.startswith("whatsapp:") else f"whatsapp:{number}"
+
+
+def send_text(to_number, body, key=None):
+    """Queue a WhatsApp text message; key makes the send idempotent. Returns False if it could not be queued"""
+    try:
+        outbound_queue.enqueue('text', {
+            'to': whatsapp_address(to_number), 'body': body, 'trace_id': tracer.current_trace_id()
+        }, key)
+        return True
+    except Exception as e:
+        print(f"Error queueing text for {to_number}: {e}")
+        return False
+
+
+def queue_audio(to_number, text_to_speak, key=None):
+    """Queue a spoken reply; the outbound workers synthesize and send it"""
+    try:
+        outbound_queue.enqueue('audio', {
+            'to': whatsapp_address(to_number), 'text': text_to_speak, 'trace_id': tracer.current_trace_id(),
+            'queued_at': time.time()
+        }, key)
+        return True
+    except Exception as e:
+        print(f"Error queueing audio for {to_number}: {e}")
+        return False
+
+
+def deliver_text(payload):
+    """Outbound queue handler: send a text in WhatsApp-sized parts, resuming after the parts already sent"""
+    with tracer.span("send_text", trace_id=payload.get('trace_id') or tracer.new_trace_id()):
+        parts = split_message(payload['body'])
+        for number in range(payload.get('sent_parts', 0), len(parts)):
+            with tracer.span("twilio_send"):
+                call_upstream('twilio', lambda timeout: client.messages.create(
+                    from_=f"whatsapp:{TWILIO_NUMBER}",
+                    to=payload['to'],
+                    body=parts[number]
+                ))
+            payload['sent_parts'] = number + 1
+
+
+def deliver_audio(payload):
+    """Outbound queue handler: synthesize and send a spoken reply"""
+    with tracer.span("send_audio", trace_id=payload.get('trace_id') or tracer.new_trace_id()):
+        synthesize_and_send(payload['to'], payload['text'], payload.get('queued_at'))
+
+
 @app.route("/send-audio", methods=["GET"])
 def send_audio(to_number, text_to_speak):
     """Send audio message to specific user with specific text"""
+    try:
+        synthesize_and_send(to_number, text_to_speak)
+        return "Audio sent", 200
+    except Exception as e:
+        print(f"Error sending audio to {to_number}: {e}")
+        return str(e), 500
 
-    # Ensure proper WhatsApp format
-    if not to_number.startswith("whatsapp:"):
-        to_number = f"whatsapp:{to_number}"
 
-    # Generate unique output file path for this user/request
-    mp3_path = generate_unique_file_paths(to_number, "outgoing")
+tts_executor = ThreadPoolExecutor(max_workers=TTS_CONCURRENCY, thread_name_prefix="tts")
+
 
+def spoken_summary(text):
+    """Condense a long reply into a short script for the voice note; the full text is sent as text"""
+    messages = [
+        SystemMessage(content="You turn chat replies into short voice notes. Write plain sentences for speaking aloud, "
+                              "with no lists, headings or emojis, in the language of the reply."),
+        HumanMessage(content=f"Summarize this reply as a friendly voice note of at most {TTS_SUMMARY_CHARS // 6} words, "
+                             f"keeping names, times and the key recommendations:\n\n{text}")
+    ]
     try:
-        # Generate audio
-        elevenlabs = ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
-
-        audio = elevenlabs.text_to_speech.convert(
-            text=text_to_speak,
-            voice_id="JBFqnCBsd6RMkjVDRZzb",
-            model_id="eleven_turbo_v2_5",
-            output_format="mp3_44100_128",
+        return strip_markdown(invoke_llm(messages, "tts_summary").content)
+    except Exception as e:
+        print(f"Spoken summary failed, reading the full reply: {e}")
+        return text
+
+
+def synthesize_chunk(elevenlabs, tts_params, chunks, index):
+    """Audio for one chunk; the neighbouring chunks are passed as context so the joins sound natural"""
+    context = {
+        'previous_text': chunks[index - 1] if index > 0 else None,
+        'next_text': chunks[index + 1] if index + 1 < len(chunks) else None,
+    }
+    context = {key: value for key, value in context.items() if value}
+    with tracer.span("tts_chunk", {"index": index, "chars": len(chunks[index])}):
+        return shared_cache.get_or_compute(
+            SharedCache.make_key("tts", tts_params, chunks[index], context),
+            TTS_CACHE_TTL,
+            lambda: call_upstream('elevenlabs', lambda timeout: b"".join(elevenlabs.text_to_speech.convert(
+                text=chunks[index],
+                request_options={"timeout_in_seconds": max(1, int(timeout))},
+                **context,
+                **tts_params
+            )))
         )
 
-        # Save to unique file
-        with open(mp3_path, "wb") as f:
-            f.write(b"".join(audio))
 
-        print(f"Audio saved as: {mp3_path} for user: {to_number}")
+def synthesize_speech(text, elevenlabs, tts_params):
+    """Speech for a reply: strip formatting, optionally condense, synthesize sentence chunks concurrently, join in order"""
+    spoken = strip_markdown(text)
+    if TTS_SUMMARY_CHARS and len(spoken) > TTS_SUMMARY_CHARS:
+        spoken = spoken_summary(spoken)
+    chunks = chunk_text(spoken, TTS_CHUNK_CHARS)
+    with tracer.span("tts", {"chars": len(text), "spoken_chars": len(spoken), "chunks": len(chunks)}):
+        futures = [
+            tts_executor.submit(contextvars.copy_context().run, synthesize_chunk, elevenlabs, tts_params, chunks, index)
+            for index in range(len(chunks))
+        ]
+        # MP3 frames are self-contained and PCM is headerless, so the chunks' bytes can simply be joined
+        return b"".join(future.result() for future in futures)
 
-        # Send via Twilio
-        media_ngrok = os.getenv("MEDIA_URL_AUDIO")
-        media_url = f'{media_ngrok}/audio/{mp3_path}'
 
-        message = client.messages.create(
-            from_=f"whatsapp:{TWILIO_NUMBER}",
-            to=to_number,
-            #body='🎵 Audio response:',
-            media_url=[media_url]
-        )
+def audio_format_for(to_number):
+    """Name of the voice note format for the recipient's channel (the address prefix, e.g. "whatsapp:")"""
+    channel = to_number.split(":", 1)[0] if ":" in to_number else "default"
+    name = AUDIO_CHANNEL_FORMATS.get(channel, AUDIO_CHANNEL_FORMATS['default'])
+    return name if name in AUDIO_FORMATS else "mp3"
+
+
+def encode_opus(pcm, sample_rate, bitrate):
+    """Ogg/Opus voice note from 16-bit mono PCM"""
+    segment = AudioSegment(data=pcm, sample_width=2, frame_rate=sample_rate, channels=1)
+    buffer = io.BytesIO()
+    segment.export(buffer, format="ogg", codec="libopus", bitrate=bitrate, parameters=["-application", "voip"])
+    return buffer.getvalue()
+
+
+def synthesize_and_send(to_number, text_to_speak, queued_at=None):
+    """Synthesize text_to_speak and send it as a WhatsApp audio message; errors propagate for retry.
+
+    Returns the name of the audio format that was sent, or None if there was nothing to say.
+    """
+
+    # Ensure proper WhatsApp format
+    to_number = whatsapp_address(to_number)
+    format_name = audio_format_for(to_number)
+    audio_format = AUDIO_FORMATS[format_name]
 
-        print(f"Audio message sent! SID: {message.sid} to {to_number}")
+    # Generate audio
+    elevenlabs = ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
 
-        # Schedule cleanup of this specific file
-        def cleanup_outgoing_file():
-            time.sleep(300)
+    tts_params = {
+        'voice_id': "JBFqnCBsd6RMkjVDRZzb",
+        'model_id': "eleven_turbo_v2_5",
+        'output_format': audio_format['tts_format'],
+    }
+    # With every TTS slot taken this raises Overloaded and the outbound queue retries with backoff
+    with stage_limiter.slot('tts'):
+        audio_bytes = synthesize_speech(text_to_speak, elevenlabs, tts_params)
+    if not audio_bytes:
+        print(f"Nothing to say aloud for {to_number}, skipping the voice note")
+        return None
+
+    extension = audio_format['extension']
+    if 'sample_rate' in audio_format:
+        with tracer.span("audio_encode", {"format": format_name, "pcm_bytes": len(audio_bytes)}):
             try:
-                if os.path.exists(mp3_path):
-                    os.remove(mp3_path)
-                    print(f"Deleted outgoing file: {mp3_path}")
+                audio_bytes = encode_opus(audio_bytes, audio_format['sample_rate'], audio_format['bitrate'])
             except Exception as e:
-                print(f"Error deleting outgoing file {mp3_path}: {e}")
+                # ffmpeg without libopus: a low-rate MP3 of the same PCM still beats 128 kbps
+                print(f"Opus encoding failed, sending MP3: {e}")
+                segment = AudioSegment(data=audio_bytes, sample_width=2, frame_rate=audio_format['sample_rate'], channels=1)
+                buffer = io.BytesIO()
+                segment.export(buffer, format="mp3", bitrate="32k")
+                audio_bytes, format_name, extension = buffer.getvalue(), "mp3_low", "mp3"
+    metrics.inc("tts_audio_files_total", {"format": format_name})
+    metrics.inc("tts_audio_bytes_total", {"format": format_name}, len(audio_bytes))
+
+    # Save to unique file
+    audio_path = generate_unique_file_paths(to_number, "outgoing", extension)
+    with open(audio_path, "wb") as f:
+        f.write(audio_bytes)
+
+    print(f"Audio saved as: {audio_path} ({format_name}, {len(audio_bytes)} bytes) for user: {to_number}")
+
+    # Schedule cleanup of this specific file (Twilio fetches it within minutes)
+    def cleanup_outgoing_file():
+        time.sleep(300)
+        audio_files.pop(audio_path, None)
+        try:
+            if os.path.exists(audio_path):
+                os.remove(audio_path)
+                print(f"Deleted outgoing file: {audio_path}")
+        except Exception as e:
+            print(f"Error deleting outgoing file {audio_path}: {e}")
 
-        threading.Thread(target=cleanup_outgoing_file).start()
+    threading.Thread(target=cleanup_outgoing_file).start()
 
-        return "Audio sent", 200
+    # Send via Twilio
+    media_ngrok = os.getenv("MEDIA_URL_AUDIO")
+    media_url = f'{media_ngrok}/audio/{audio_path}'
 
-    except Exception as e:
-        print(f"Error sending audio to {to_number}: {e}")
-        return str(e), 500
+    audio_files[audio_path] = {'format': format_name, 'queued_at': queued_at, 'sent_at': time.time()}
+    with tracer.span("twilio_send", {"format": format_name, "bytes": len(audio_bytes)}):
+        message = call_upstream('twilio', lambda timeout: client.messages.create(
+            from_=f"whatsapp:{TWILIO_NUMBER}",
+            to=to_number,
+            #body='🎵 Audio response:',
+            media_url=[media_url]
+        ))
+    if queued_at:
+        metrics.observe("audio_delivery_seconds", time.time() - queued_at, {"format": format_name})
+
+    print(f"Audio message sent! SID: {message.sid} to {to_number}")
+    return format_name
+
+
+outbound_queue = OutboundQueue(
+    OUTBOUND_QUEUE_PATH,
+    {'text': deliver_text, 'audio': deliver_audio},
+    workers=OUTBOUND_WORKERS,
+    max_attempts=OUTBOUND_MAX_ATTEMPTS,
+    base_delay=OUTBOUND_RETRY_BASE,
+    metrics=metrics
+)
+outbound_queue.start()
+# Send what is already due before the worker exits (gunicorn restarts, deploys)
+atexit.register(outbound_queue.drain, OUTBOUND_DRAIN_SECONDS)
+if DEFERRED_GENERATION:
+    threading.Thread(target=generation_jobs.sweep, args=(GENERATION_SWEEP_SECONDS,), name="generation-sweep",
+                     daemon=True).start()
+if EMBEDDING_MODEL != "hashing":
+    threading.Thread(target=warm_embedder, name="embedder-warmup", daemon=True).start()
 
 if __name__ == "__main__":
     def run_flask():
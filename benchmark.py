@@ -0,0 +1,658 @@
+"""Benchmarks for CityGuide.AI.
+
+Run from the project root with the same environment as the app (.env):
+
+    python benchmark.py <benchmark> [options]
+
+Most benchmarks import app.py, so they need the app's dependencies installed;
+`route`, `vectors`, `tts` and `poi` only need route_planner.py / vector_index.py / speech_text.py /
+poi_store.py (`tts --tts-live` calls ElevenLabs through app.py). `replay` runs the
+whole webhook pipeline offline against local fakes (see replay.py); `cache` checks the shared cache
+backends, with Redis replaced by the local stand-in in replay.py.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import time
+
+
+def load_app():
+    import app
+    return app
+
+
+def payload_size(value):
+    """Approximate the wire size of a Firestore update, expanding transforms into their values"""
+    def encode(obj):
+        if hasattr(obj, 'values'):
+            return list(obj.values)
+        if hasattr(obj, 'value'):
+            return obj.value
+        return str(obj)
+
+    return len(json.dumps(value, default=encode).encode("utf-8"))
+
+
+class RecordingDocument:
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def update(self, updates):
+        self.recorder.append(updates)
+
+    def set(self, data):
+        self.recorder.append(data)
+
+
+class RecordingDB:
+    """Stands in for the Firestore client and records every update payload"""
+
+    def __init__(self):
+        self.updates = []
+
+    def collection(self, name):
+        return self
+
+    def document(self, name):
+        return RecordingDocument(self.updates)
+
+
+def datetime_stamp(i):
+    return f"2025-01-{(i % 28) + 1:02d}T10:00:00"
+
+
+def sample_bookmarks(count):
+    cities = ["Delhi", "Mumbai", "Jaipur", "Pune", "Kolkata", "Chennai", "Goa", "Agra"]
+    categories = ["attraction", "restaurant", "park", "museum", "shop"]
+    return [{
+        'place': f"Place {i}",
+        'note': "Great spot for an evening walk",
+        'category': categories[i % len(categories)],
+        'location': cities[i % len(cities)],
+        'timestamp': datetime_stamp(i)
+    } for i in range(count)]
+
+
+def bench_payload(args):
+    """Write payload size of add_story against story history length"""
+    app = load_app()
+    recorder = RecordingDB()
+    manager = app.FirebaseUserManager(recorder)
+    manager.profile_cache.use_listeners = False
+
+    print(f"{'items':>8} {'full rewrite (B)':>18} {'incremental (B)':>16} {'write time (ms)':>16}")
+    for length in args.lengths:
+        stories = [{
+            'story': "A short walk through the old city. " * 40,
+            'locations': ["Red Fort", "Chandni Chowk"],
+            'theme': "historical",
+            'perspective': "first person",
+            'location': "Delhi",
+            'timestamp': datetime_stamp(i)
+        } for i in range(length)]
+        manager.current_user_id = "910000000000"
+        manager.current_user_data = {'story_history': list(stories)}
+        new_story = dict(stories[0], theme="romantic") if stories else {'story': "New story"}
+
+        full_rewrite = payload_size({'story_history': stories + [new_story]})
+        start = time.perf_counter()
+        manager.add_story(new_story)
+        elapsed = (time.perf_counter() - start) * 1000
+        incremental = payload_size(recorder.updates[-1])
+        print(f"{length:>8} {full_rewrite:>18} {incremental:>16} {elapsed:>16.3f}")
+
+
+def bench_bookmarks(args):
+    """Bookmark lookups through BookmarkIndex against a linear scan of the old bookmarks array"""
+    app = load_app()
+
+    print(f"{'bookmarks':>10} {'linear (us)':>12} {'indexed (us)':>13} {'dup check linear':>17} {'dup check indexed':>18}")
+    for length in args.lengths:
+        bookmarks = sample_bookmarks(length)
+        index = app.BookmarkIndex(app.make_bookmark_record(b) for b in bookmarks)
+        runs = 200
+
+        start = time.perf_counter()
+        for _ in range(runs):
+            [b for b in bookmarks if "delhi" in b.get('location', '').lower()]
+        linear = (time.perf_counter() - start) / runs * 1e6
+
+        start = time.perf_counter()
+        for _ in range(runs):
+            index.find(location="Delhi")
+        indexed = (time.perf_counter() - start) / runs * 1e6
+
+        start = time.perf_counter()
+        for _ in range(runs):
+            [b for b in bookmarks if b['place'].lower() == "place 1" and b['location'].lower() == "mumbai"]
+        dup_linear = (time.perf_counter() - start) / runs * 1e6
+
+        start = time.perf_counter()
+        for _ in range(runs):
+            index.get(app.make_bookmark_record({'place': "Place 1", 'location': "Mumbai"})['key'])
+        dup_indexed = (time.perf_counter() - start) / runs * 1e6
+
+        print(f"{length:>10} {linear:>12.1f} {indexed:>13.1f} {dup_linear:>17.1f} {dup_indexed:>18.1f}")
+
+
+# (message, expected tool or None for "needs the agent", expected Action Input) with the user in Delhi
+ROUTER_LABELLED_SET = [
+    ("weather in Pune", "WeatherTool", "Pune"),
+    ("What's the weather like in New Delhi today?", "WeatherTool", "New Delhi"),
+    ("how is the weather", "WeatherTool", "Delhi"),
+    ("tell me the weather please", "WeatherTool", "Delhi"),
+    ("Mumbai weather", "WeatherTool", "Mumbai"),
+    ("temperature in Jaipur", "WeatherTool", "Jaipur"),
+    ("is it raining in Pune", "WeatherTool", "Pune"),
+    ("show my bookmarks", "GetBookmarksTool", ""),
+    ("my saved places", "GetBookmarksTool", ""),
+    ("show me my bookmarks in Goa", "GetBookmarksTool", "Goa"),
+    ("list all my bookmarks", "GetBookmarksTool", ""),
+    ("what time is it?", "Time", ""),
+    ("current time", "Time", ""),
+    ("time now", "Time", ""),
+    ("show my profile", "GetUserProfileTool", ""),
+    ("latest news", "NewsTool", "Delhi"),
+    ("news from Mumbai", "NewsTool", "Mumbai"),
+    ("top news in Chennai today", "NewsTool", "Chennai"),
+    ("events this weekend", "LiveEventsTool", "Delhi"),
+    ("any events in Goa tonight", "LiveEventsTool", "Goa"),
+    ("concerts in Bangalore", "LiveEventsTool", "Bangalore"),
+    ("what is the time in London", None, None),
+    ("weather in Pune and plan my day", None, None),
+    ("weather in pune tomorrow", None, None),
+    ("pune vs mumbai weather", None, None),
+    ("plan a relaxing day in Delhi", None, None),
+    ("bookmark Red Fort, great for photos", None, None),
+    ("recommend hidden food gems in Delhi", None, None),
+    ("what are the best museums in Paris", None, None),
+    ("tell me a romantic story about Agra", None, None),
+    ("I love street food", None, None),
+    ("find ATMs near Connaught Place", None, None),
+    ("time to go to the market in delhi", None, None),
+    ("is the weather good for a picnic at Lodhi Garden tomorrow", None, None),
+    ("why is Delhi so polluted", None, None),
+    ("hi!", None, None),
+    ("remove museums from my likes", None, None),
+]
+
+
+def bench_router(args):
+    """Precision, coverage and latency of the local intent router on ROUTER_LABELLED_SET"""
+    app = load_app()
+    router = app.IntentRouter()
+    threshold = app.INTENT_ROUTER_THRESHOLD
+
+    dispatched = correct = routable = routed_routable = 0
+    timings = []
+    for text, expected_tool, expected_input in ROUTER_LABELLED_SET:
+        start = time.perf_counter()
+        tool_name, tool_input, confidence = router.classify(text, "Delhi")
+        timings.append((time.perf_counter() - start) * 1e6)
+        if expected_tool:
+            routable += 1
+        if tool_name is None or confidence < threshold:
+            if args.verbose and expected_tool:
+                print(f"missed: {text!r} -> {tool_name} ({confidence:.2f})")
+            continue
+        dispatched += 1
+        ok = tool_name == expected_tool and (tool_input or "").lower() == (expected_input or "").lower()
+        correct += ok
+        routed_routable += bool(expected_tool)
+        if args.verbose and not ok:
+            print(f"wrong: {text!r} -> {tool_name}({tool_input!r}), expected {expected_tool}({expected_input!r})")
+
+    timings.sort()
+    print(f"examples: {len(ROUTER_LABELLED_SET)}  threshold: {threshold}")
+    print(f"precision: {correct / dispatched if dispatched else 0:.3f} ({correct}/{dispatched} dispatched)")
+    print(f"coverage:  {routed_routable / routable if routable else 0:.3f} ({routed_routable}/{routable} routable)")
+    print(f"latency:   p50 {timings[len(timings) // 2]:.1f} us, max {timings[-1]:.1f} us")
+
+
+# Action Inputs as produced by the agent, including the malformed ones seen in practice
+RECORDED_ACTION_INPUTS = [
+    ("DayPlannerTool", "relaxing|10am-6pm|museums and cafes|Delhi"),
+    ("DayPlannerTool", "'energetic|morning to evening|history and art museums|London'"),
+    ("DayPlannerTool", "adventurous|full day|street food"),
+    ("DayPlannerTool", "neutral|full day|local attractions|current location"),
+    ("DayPlannerTool", "chill | evening | rooftop bars | Mumbai "),
+    ("BookmarkTool", "Red Fort|Great for photos|landmark|Delhi"),
+    ("BookmarkTool", "Cafe Lota"),
+    ("BookmarkTool", "|no place given|restaurant|Delhi"),
+    ("BookmarkTool", "India Gate|Evening walk|monument|Delhi|extra"),
+    ("GetBookmarksTool", "Delhi"),
+    ("GetBookmarksTool", ""),
+    ("POITool", "food|Tokyo|true"),
+    ("POITool", "museums|Paris|maybe"),
+    ("POITool", "nightlife|{current_location}|false"),
+    ("InterestTool", "art galleries|add_like|Paris"),
+    ("InterestTool", "street food|like|Delhi"),
+    ("InterestTool", "museums|REMOVE"),
+    ("StoryModeTool", "Eiffel Tower,Louvre Museum|romantic|first person|Paris"),
+    ("StoryModeTool", "Red Fort, Chandni Chowk ,|historical"),
+    ("StoryModeTool", ",,|mystery|third person|Delhi"),
+    ("GetUserProfileTool", "Delhi"),
+    ("LiveEventsTool", "Mumbai"),
+    ("LiveEventsTool", "current location"),
+    ("WeatherTool", "Pune"),
+    ("WeatherTool", "`Bangalore`"),
+    ("NewsTool", "Mumbai|transportation"),
+    ("NewsTool", "Delhi"),
+    ("PlacesFinderTool", "ATMs|Connaught Place Delhi"),
+    ("PlacesFinderTool", "hospitals near me"),
+]
+
+
+def fuzz_inputs(seed, count):
+    """Random mutations of the recorded inputs: stray pipes, quotes, whitespace and junk"""
+    import random
+
+    rng = random.Random(seed)
+    junk = ["|", "||", "'", '"', "`", " ", ",", "\n", "true", "current location", "\u00e9", "🙂", ""]
+    for _ in range(count):
+        tool_name, action_input = rng.choice(RECORDED_ACTION_INPUTS)
+        chars = list(action_input)
+        for _ in range(rng.randint(1, 4)):
+            position = rng.randint(0, len(chars))
+            if chars and rng.random() < 0.3:
+                del chars[min(position, len(chars) - 1)]
+            else:
+                chars.insert(position, rng.choice(junk))
+        yield tool_name, "".join(chars)
+
+
+def bench_tool_args(args):
+    """Parse recorded and fuzzed Action Inputs with parse_tool_input; fails on any non-ToolInputError"""
+    app = load_app()
+
+    def run(cases):
+        ok = errors = 0
+        start = time.perf_counter()
+        for tool_name, action_input in cases:
+            try:
+                app.parse_tool_input(tool_name, action_input, current_location="Delhi")
+                ok += 1
+            except app.ToolInputError as e:
+                errors += 1
+                if args.verbose:
+                    print(f"{tool_name} {action_input!r}: {e}")
+        return ok, errors, (time.perf_counter() - start) / max(len(cases), 1) * 1e6
+
+    ok, errors, per_call = run(RECORDED_ACTION_INPUTS)
+    print(f"recorded: {ok} parsed, {errors} structured errors, {per_call:.1f} us per input")
+    fuzzed = list(fuzz_inputs(args.seed, args.fuzz))
+    ok, errors, per_call = run(fuzzed)
+    print(f"fuzzed:   {ok} parsed, {errors} structured errors, {per_call:.1f} us per input")
+
+
+def bench_route(args):
+    """Stop ordering quality and time for 10-50 random stops spread over a city centre"""
+    import random
+    import route_planner
+
+    rng = random.Random(args.seed)
+    categories = list(route_planner.CATEGORY_DEFAULTS)
+    start, end = route_planner.time_window("full day")
+    print(f"{'stops':>5} {'matrix ms':>9} {'nn ms':>7} {'2-opt ms':>8} "
+          f"{'random':>14} {'nearest':>14} {'2-opt':>14}   (stops fitted / travel min)")
+    for count in args.stops:
+        stops = [
+            route_planner.make_stop(f"stop {i}", 28.58 + rng.random() * 0.08, 77.17 + rng.random() * 0.08,
+                                    rng.choice(categories))
+            for i in range(count)
+        ]
+        t0 = time.perf_counter()
+        matrix = route_planner.build_matrix(stops)
+        t1 = time.perf_counter()
+        greedy = route_planner.nearest_neighbour(stops, matrix, start, end)
+        t2 = time.perf_counter()
+        improved = route_planner.two_opt(greedy, stops, matrix, start, end, t2 + args.budget)
+        t3 = time.perf_counter()
+        shuffled = list(range(count))
+        rng.shuffle(shuffled)
+
+        def summary(order):
+            visits = route_planner.schedule(order, stops, matrix, start, end)[1]
+            return f"{len(visits):>3} / {sum(v['travel'] for v in visits):>7.0f}"
+
+        print(f"{count:>5} {(t1 - t0) * 1000:>9.2f} {(t2 - t1) * 1000:>7.2f} {(t3 - t2) * 1000:>8.1f} "
+              f"{summary(shuffled):>14} {summary(greedy):>14} {summary(improved):>14}")
+
+
+def bench_poi(args):
+    """POI import and lookups on a generated .osm.bz2 extract: correctness checks, peak memory and import rate"""
+    import bz2
+    import tempfile
+    import tracemalloc
+    import poi_store
+
+    directory = tempfile.mkdtemp(prefix="cityguide-poi-")
+    path = os.path.join(directory, "extract.osm.bz2")
+    # Two cities with a 'Station Road' area each, an ATM near each, a named park way, and
+    # args.osm_nodes untagged nodes (road geometry) that no POI way references
+    with bz2.open(path, 'wt', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for node_id, lat, lon, tags in [
+            (1, 28.6330, 77.2190, {'name': 'Station Road', 'place': 'suburb'}),
+            (2, 28.6331, 77.2191, {'name': 'Delhi ATM', 'amenity': 'atm'}),
+            (3, 19.0760, 72.8777, {'name': 'Station Road', 'place': 'suburb'}),
+            (4, 19.0761, 72.8778, {'name': 'Mumbai ATM', 'amenity': 'atm'}),
+            (5, 28.6000, 77.2000, {}),
+            (6, 28.6020, 77.2020, {}),
+        ]:
+            children = ''.join(f'<tag k="{k}" v="{v}"/>' for k, v in tags.items())
+            f.write(f'<node id="{node_id}" lat="{lat}" lon="{lon}">{children}</node>\n')
+        for i in range(args.osm_nodes):
+            f.write(f'<node id="{100 + i}" lat="{28.5 + (i % 1000) / 5000}" lon="{77.1 + (i // 1000) / 5000}"/>\n')
+        f.write('<way id="7"><nd ref="5"/><nd ref="6"/><tag k="name" v="Lodhi Garden"/><tag k="leisure" v="park"/></way>\n')
+        f.write('<way id="8"><nd ref="100"/><nd ref="101"/><tag k="highway" v="residential"/></way>\n')
+        f.write('</osm>\n')
+
+    store = poi_store.POIStore(os.path.join(directory, "pois.sqlite3"))
+    tracemalloc.start()
+    start = time.perf_counter()
+    pois = list(poi_store.read_osm_xml(path))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    store.add_many(pois)
+
+    park = next((poi for poi in pois if poi['name'] == 'Lodhi Garden'), None)
+    delhi = store.find_place("station road", 28.6139, 77.2090, 40000)
+    mumbai = store.find_place("Station Road", 19.0760, 72.8777, 40000)
+    nearby = store.nearby(19.0760, 72.8777, ['atm'], 1500)
+    checks = {
+        'imports tagged nodes and ways': sorted(poi['osm_id'] for poi in pois) == ['node/1', 'node/2', 'node/3', 'node/4', 'way/7'],
+        'way placed at its centre': park is not None and abs(park['lat'] - 28.601) < 1e-9 and abs(park['lon'] - 77.201) < 1e-9,
+        'area found in the given city': bool(delhi and mumbai) and delhi['lat'] < 29 and mumbai['lat'] < 20,
+        'area outside the city ignored': store.find_place("Station Road", 12.9716, 77.5946, 40000) is None,
+        'nearby stays in the city': [poi['name'] for poi in nearby] == ['Mumbai ATM'],
+    }
+    for check, passed in checks.items():
+        print(f"{check:<32} {'ok' if passed else 'FAILED'}")
+    print(f"{'nodes':<32} {args.osm_nodes + 6}")
+    print(f"{'import':<32} {elapsed:.2f} s ({(args.osm_nodes + 8) / elapsed:,.0f} elements/s, both passes)")
+    print(f"{'peak memory while reading':<32} {peak / 1e6:.1f} MB")
+
+
+def bench_vectors(args):
+    """Memory and query latency of the vector index per backend, plus embedding throughput"""
+    import numpy as np
+    import vector_index
+
+    embedder = vector_index.create_embedder(args.model)
+    texts = [f"{kind} place number {i} near the old market" for i, kind in
+             enumerate(["rooftop cafe", "street food", "history museum", "quiet park"] * 64)]
+    start = time.perf_counter()
+    embedder.embedder.embed(texts)
+    elapsed = time.perf_counter() - start
+    print(f"embedder: {embedder.name} (dim {embedder.dim}), {len(texts) / elapsed:.0f} texts/s on CPU")
+
+    rng = np.random.default_rng(args.seed)
+    backends = ["numpy"]
+    if importlib.util.find_spec("hnswlib"):
+        backends.append("hnsw")
+    else:
+        print("hnswlib not installed; skipping the ANN backend")
+    print(f"{'backend':<7} {'vectors':>8} {'build s':>8} {'MB':>8} {'MB/10k':>7} "
+          f"{'p50 ms':>7} {'p95 ms':>7} {'filtered p50':>12}")
+    for count in args.vectors:
+        vectors = vector_index.normalize_rows(rng.standard_normal((count, args.dim)).astype(np.float32))
+        items = [{'kind': ('like', 'bookmark', 'story')[i % 3]} for i in range(count)]
+        queries = vector_index.normalize_rows(rng.standard_normal((args.queries, args.dim)).astype(np.float32))
+        for backend in backends:
+            index = vector_index.VectorIndex(args.dim, backend)
+            start = time.perf_counter()
+            for offset in range(0, count, 1000):
+                index.add(vectors[offset:offset + 1000], items[offset:offset + 1000])
+            build = time.perf_counter() - start
+            timings, filtered = [], []
+            for query in queries:
+                start = time.perf_counter()
+                index.search(query, 10)
+                timings.append((time.perf_counter() - start) * 1000)
+                start = time.perf_counter()
+                index.search(query, 10, where=lambda item: item['kind'] == 'bookmark')
+                filtered.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            filtered.sort()
+            mb = index.nbytes / 1e6
+            print(f"{backend:<7} {count:>8} {build:>8.2f} {mb:>8.1f} {mb / count * 10000:>7.2f} "
+                  f"{timings[len(timings) // 2]:>7.2f} {timings[int(len(timings) * 0.95)]:>7.2f} "
+                  f"{filtered[len(filtered) // 2]:>12.2f}")
+
+
+# One block of a typical itinerary reply, repeated to the requested length
+SAMPLE_REPLY_BLOCK = """### Morning (9:00-11:30)
+1. **Red Fort** – explore the *Mughal* palaces and the Meena Bazaar. Entry is about 500 rupees.
+2. Walk through [Chandni Chowk](https://maps.example.com/chandni-chowk) to Jama Masjid; try `parathe wali gali` on the way.
+- Tip: take the metro (Yellow Line) to Chandni Chowk station to skip the traffic.
+
+"""
+
+
+def sample_reply(chars):
+    return (SAMPLE_REPLY_BLOCK * (chars // len(SAMPLE_REPLY_BLOCK) + 1))[:chars]
+
+
+def bench_tts(args):
+    """Time to audio against reply length: one TTS call for the spoken text vs chunked, concurrent calls.
+
+    Both sides synthesize the same stripped text, so the difference is the chunking alone.
+    With --tts-live the calls go to ElevenLabs through the app (ELEVENLABS_API_KEY needed), as in
+    audio_formats. Otherwise synthesis is SIMULATED as --tts-base-ms plus --tts-ms-per-char per
+    character: the output shows the shape of the speedup for those constants, not measured times.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import speech_text
+
+    if args.tts_live:
+        os.environ.update({"CACHE_BACKEND": "none", "TTS_SUMMARY_CHARS": "0",
+                           "TTS_CHUNK_CHARS": str(args.chunk_chars), "TTS_CONCURRENCY": str(args.tts_workers)})
+        app = load_app()
+        elevenlabs = app.ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
+        tts_params = {'voice_id': "JBFqnCBsd6RMkjVDRZzb", 'model_id': "eleven_turbo_v2_5", 'output_format': "mp3_44100_128"}
+
+        def synthesize_one(text):
+            return app.synthesize_chunk(elevenlabs, tts_params, [text], 0)
+
+        def synthesize_chunked(text):
+            return app.synthesize_speech(text, elevenlabs, tts_params)
+
+        print(f"ElevenLabs {tts_params['model_id']}, chunks of <= {args.chunk_chars} chars, {args.tts_workers} concurrent calls")
+    else:
+        executor = ThreadPoolExecutor(max_workers=args.tts_workers)
+
+        def synthesize_one(text):
+            time.sleep((args.tts_base_ms + args.tts_ms_per_char * len(text)) / 1000)
+            return text.encode("utf-8")
+
+        def synthesize_chunked(text):
+            chunks = speech_text.chunk_text(text, args.chunk_chars)
+            return b"".join(future.result() for future in [executor.submit(synthesize_one, chunk) for chunk in chunks])
+
+        print(f"SIMULATED synthesis ({args.tts_base_ms:.0f} ms + {args.tts_ms_per_char} ms/char per call; "
+              f"use --tts-live to measure), chunks of <= {args.chunk_chars} chars, {args.tts_workers} concurrent calls")
+    print(f"{'reply chars':>11} {'spoken':>7} {'chunks':>6} {'prepare ms':>10} {'one call s':>10} {'chunked s':>9} {'speedup':>8}")
+    for length in args.reply_lengths:
+        reply = sample_reply(length)
+        start = time.perf_counter()
+        spoken = speech_text.strip_markdown(reply)
+        chunks = speech_text.chunk_text(spoken, args.chunk_chars)
+        prepared = time.perf_counter()
+        synthesize_one(spoken)
+        single = time.perf_counter() - prepared
+        start_chunked = time.perf_counter()
+        synthesize_chunked(spoken)
+        chunked = time.perf_counter() - start_chunked
+        print(f"{length:>11} {len(spoken):>7} {len(chunks):>6} {(prepared - start) * 1000:>10.2f} "
+              f"{single:>10.2f} {chunked:>9.2f} {single / chunked:>7.1f}x")
+    if not args.tts_live:
+        executor.shutdown()
+
+
+def bench_audio_formats(args):
+    """Voice note size and time per output format (AUDIO_FORMATS) for replies of each length.
+
+    Calls ElevenLabs, so it needs ELEVENLABS_API_KEY and ffmpeg. Fetch time is the file size over
+    --link-mbps; the real end-to-end time is audio_end_to_end_seconds{format} on /metrics.
+    """
+    import io
+    os.environ["CACHE_BACKEND"] = "none"
+    app = load_app()
+    elevenlabs = app.ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
+    print(f"{'reply chars':>11} {'format':>8} {'synth s':>8} {'encode s':>9} {'audio s':>8} {'KB':>8} {'kbps':>6} {'fetch s':>8}")
+    for length in args.reply_lengths:
+        reply = sample_reply(length)
+        for name, audio_format in app.AUDIO_FORMATS.items():
+            tts_params = {'voice_id': "JBFqnCBsd6RMkjVDRZzb", 'model_id': "eleven_turbo_v2_5",
+                          'output_format': audio_format['tts_format']}
+            start = time.perf_counter()
+            audio = app.synthesize_speech(reply, elevenlabs, tts_params)
+            synthesized = time.perf_counter()
+            if 'sample_rate' in audio_format:
+                duration = len(audio) / 2 / audio_format['sample_rate']
+                audio = app.encode_opus(audio, audio_format['sample_rate'], audio_format['bitrate'])
+            else:
+                duration = app.AudioSegment.from_file(io.BytesIO(audio), format="mp3").duration_seconds
+            encoded = time.perf_counter()
+            fetch = len(audio) * 8 / (args.link_mbps * 1e6)
+            print(f"{length:>11} {name:>8} {synthesized - start:>8.2f} {encoded - synthesized:>9.3f} {duration:>8.1f} "
+                  f"{len(audio) / 1024:>8.1f} {len(audio) * 8 / 1000 / max(duration, 0.001):>6.0f} {fetch:>8.2f}")
+
+
+def bench_cache(args):
+    """Correctness checks and latency for the shared cache backends; Redis runs against replay's local stand-in"""
+    import datetime
+    import tempfile
+    import threading
+    import replay
+
+    app = load_app()
+    server = replay.FakeRedisServer().start()
+    sqlite_path = os.path.join(tempfile.mkdtemp(prefix="cityguide-cache-"), "cache.sqlite3")
+    backends = {
+        'sqlite': lambda: app.SQLiteCache(sqlite_path),
+        'redis': lambda: app.RedisCache(server.url),
+    }
+    value = {'place': "लाल किला", 'audio': b"\x00\xff" * 8, 'list': [1, 2.5, None],
+             'at': datetime.datetime(2024, 5, 1, 9, 30, tzinfo=datetime.timezone.utc)}
+    for name, create in backends.items():
+        cache = create()
+        checks = {}
+        cache.set("roundtrip", value, 60)
+        checks['round trip'] = cache.get("roundtrip") == value
+        checks['add if absent'] = cache._add_raw("nx", "1", 60) and not cache._add_raw("nx", "1", 60)
+        cache.set("short", "x", 1)
+        time.sleep(1.1)
+        checks['expiry'] = cache.get("short") is None
+
+        # Four "workers" with four threads each race for the same missing key
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.3)
+            return "computed"
+
+        workers = [create() for _ in range(4)]
+        threads = [threading.Thread(target=worker.get_or_compute, args=("stampede", 60, compute))
+                   for worker in workers for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        checks['one compute per stampede'] = len(calls) == 1
+
+        other = create()
+        other._add_raw("lock:held", "1", 60)
+        cache.get_or_compute("held", 60, lambda: "value", lock_seconds=0.3)
+        checks["other worker's lock kept"] = cache._get_raw("lock:held") is not None
+
+        timings = {'set': [], 'get': []}
+        for i in range(args.queries):
+            start = time.perf_counter()
+            cache.set(f"bench:{i}", value, 60)
+            timings['set'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            cache.get(f"bench:{i}")
+            timings['get'].append(time.perf_counter() - start)
+        for check, passed in checks.items():
+            print(f"{name:>7} {check:<26} {'ok' if passed else 'FAILED'}")
+        print(f"{name:>7} {'latency p50':<26} set {sorted(timings['set'])[len(timings['set']) // 2] * 1e6:.0f} us, "
+              f"get {sorted(timings['get'])[len(timings['get']) // 2] * 1e6:.0f} us")
+    server.stop()
+
+
+def bench_replay(args):
+    """End-to-end replay of recorded webhooks against local fakes (see replay.py)"""
+    import replay
+
+    args.payloads = os.path.abspath(args.payloads)
+    replay.run(args)
+    # The app's file cleanup threads sleep for minutes; don't wait for them
+    os._exit(0)
+
+
+def latency_override(value):
+    name, _, ms = value.partition("=")
+    return name, float(ms)
+
+
+BENCHMARKS = {
+    'payload': bench_payload,
+    'bookmarks': bench_bookmarks,
+    'router': bench_router,
+    'tool_args': bench_tool_args,
+    'route': bench_route,
+    'vectors': bench_vectors,
+    'replay': bench_replay,
+    'tts': bench_tts,
+    'audio_formats': bench_audio_formats,
+    'cache': bench_cache,
+    'poi': bench_poi,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CityGuide.AI benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--lengths", type=int, nargs="+", default=[0, 10, 100, 1000, 5000],
+                        help="list lengths for the payload and bookmarks benchmarks")
+    parser.add_argument("--verbose", action="store_true", help="print misclassified examples and input errors")
+    parser.add_argument("--fuzz", type=int, default=10000, help="number of fuzzed Action Inputs")
+    parser.add_argument("--seed", type=int, default=7, help="random seed for fuzzing and generated stops")
+    parser.add_argument("--stops", type=int, nargs="+", default=[10, 20, 30, 40, 50],
+                        help="stop counts for the route benchmark")
+    parser.add_argument("--budget", type=float, default=0.3, help="2-opt time budget in seconds (ROUTE_TIME_BUDGET)")
+    parser.add_argument("--osm-nodes", type=int, default=200000, help="untagged nodes in the poi benchmark's extract")
+    parser.add_argument("--vectors", type=int, nargs="+", default=[10000, 50000, 100000],
+                        help="index sizes for the vectors benchmark")
+    parser.add_argument("--dim", type=int, default=384, help="vector dimension (all-MiniLM-L6-v2 is 384)")
+    parser.add_argument("--queries", type=int, default=200, help="queries per index size (vectors), operations per backend (cache)")
+    parser.add_argument("--model", default="hashing", help="embedding model for the throughput line")
+    parser.add_argument("--payloads", default="replay_payloads.jsonl", help="recorded webhook payloads (JSON lines)")
+    parser.add_argument("--users", type=int, default=10, help="synthetic users each replaying the payloads")
+    parser.add_argument("--repeat", type=int, default=1, help="times each user replays the payloads")
+    parser.add_argument("--rate", type=float, default=0, help="messages per second (0 = as fast as possible)")
+    parser.add_argument("--latency", type=latency_override, nargs="*", default=[],
+                        help="fake service latencies in ms, e.g. gemini=900 serpapi=600 (see replay.DEFAULT_LATENCIES)")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiply every injected latency")
+    parser.add_argument("--reply-chars", type=int, default=1200, help="length of fake Gemini replies")
+    parser.add_argument("--cache", default="none", help="CACHE_BACKEND for the replay (none, sqlite, redis)")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for queued turns to finish")
+    parser.add_argument("--reply-lengths", type=int, nargs="+", default=[300, 800, 1500, 3000, 6000],
+                        help="reply lengths in characters for the tts benchmark")
+    parser.add_argument("--chunk-chars", type=int, default=400, help="TTS chunk size (TTS_CHUNK_CHARS)")
+    parser.add_argument("--tts-workers", type=int, default=4, help="concurrent TTS calls (TTS_CONCURRENCY)")
+    parser.add_argument("--tts-live", action="store_true", help="measure the tts benchmark against ElevenLabs")
+    parser.add_argument("--tts-base-ms", type=float, default=350, help="simulated fixed cost of one TTS call")
+    parser.add_argument("--tts-ms-per-char", type=float, default=0.6, help="simulated TTS cost per character")
+    parser.add_argument("--link-mbps", type=float, default=10, help="bandwidth for the estimated media fetch time")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
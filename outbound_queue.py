@@ -0,0 +1,299 @@
+"""Durable queue for outbound WhatsApp messages.
+
+Messages are rows in a local SQLite file, so a reply survives a worker being recycled,
+redeployed or crashing, and every gunicorn worker on the node shares the same queue:
+
+    python outbound_queue.py stats --db outbox.sqlite3
+    python outbound_queue.py retry-dead --db outbox.sqlite3
+
+Worker threads claim due rows under a lease and run the handler registered for the row's
+kind. A failure that may pass (HTTP 429 or 5xx, timeouts, connection errors) is retried with
+exponential backoff and jitter; any other error, or running out of attempts, moves the row to
+the dead-letter state. Each message carries an idempotency key and enqueueing a key that is
+already queued or sent does nothing. A row whose lease expires (its process died mid-send) is
+claimed again, so delivery is at least once. Handlers may record progress in the payload dict
+(e.g. parts already sent); it is saved with the retry.
+This module has no dependency on app.py.
+"""
+import argparse
+import json
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+
+def error_status(error):
+    """HTTP status carried by a Twilio / ElevenLabs / requests error, if any"""
+    for attribute in ('status', 'status_code'):
+        status = getattr(error, attribute, None)
+        if isinstance(status, int):
+            return status
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+# Exception classes that mean a call may succeed later: timeouts and connection failures from
+# the standard library, requests, httpx and the Google API clients. They are matched by name
+# anywhere in the class hierarchy so that no client library has to be imported here.
+TRANSIENT_ERRORS = {
+    "TimeoutError", "Timeout", "ReadTimeout", "ConnectTimeout", "TimeoutException", "ConnectionError",
+    "ConnectError", "NetworkError", "RemoteDisconnected", "ServiceUnavailable", "DeadlineExceeded",
+    "TooManyRequests", "ResourceExhausted", "InternalServerError", "GatewayTimeout",
+}
+# Raised by the app itself while an upstream's circuit breaker is open or a stage is shedding load
+BACKPRESSURE_ERRORS = {"CircuitOpenError", "Overloaded"}
+
+
+def _error_names(error):
+    return {cls.__name__ for cls in type(error).__mro__}
+
+
+def is_transient(error):
+    """Whether an upstream call failed in a way that may pass: HTTP 408/425/429/5xx, a timeout or a connection failure"""
+    status = error_status(error)
+    if status is not None:
+        return status in (408, 425, 429) or status >= 500
+    return bool(_error_names(error) & TRANSIENT_ERRORS)
+
+
+def is_retryable(error):
+    """Whether a failed delivery is retried; anything else (a 4xx, a bug in the handler) is dead-lettered"""
+    if _error_names(error) & BACKPRESSURE_ERRORS:
+        return True
+    return is_transient(error) or error_status(error) == 409
+
+
+class OutboundQueue:
+    """SQLite-backed outbound queue with worker threads, backoff and dead-lettering"""
+
+    def __init__(self, path, handlers, workers=4, max_attempts=6, base_delay=2.0, max_delay=300.0,
+                 lease_seconds=120, keep_seconds=86400, metrics=None):
+        self.path = path
+        self.handlers = handlers
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease_seconds = lease_seconds
+        self.keep_seconds = keep_seconds
+        self.metrics = metrics
+        self.worker_id = uuid.uuid4().hex[:12]
+        self.connections = threading.local()
+        self.wake = threading.Condition()
+        self.threads = []
+        self.stopping = False
+        self.busy = 0
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                lease_holder TEXT,
+                lease_until REAL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+
+    def _connection(self):
+        conn = getattr(self.connections, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.connections.conn = conn
+        return conn
+
+    def _inc(self, name, labels=None, amount=1):
+        if self.metrics:
+            self.metrics.inc(name, labels, amount)
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"outbound-{number}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def enqueue(self, kind, payload, key=None):
+        """Queue a message; returns False if a message with this idempotency key already exists"""
+        now = time.time()
+        conn = self._connection()
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO outbox (idempotency_key, kind, payload, status, next_attempt_at, created_at, updated_at)"
+            " VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+            (key or uuid.uuid4().hex, kind, json.dumps(payload), now, now, now)
+        )
+        if cursor.rowcount != 1:
+            self._inc("outbound_messages_total", {"kind": kind, "outcome": "duplicate"})
+            return False
+        self._inc("outbound_messages_total", {"kind": kind, "outcome": "queued"})
+        with self.wake:
+            self.wake.notify()
+        return True
+
+    def _claim(self):
+        """Lease the next due message: pending, or sending with an expired lease"""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, idempotency_key, kind, payload, attempts, created_at FROM outbox"
+                " WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND lease_until < ?)"
+                " ORDER BY next_attempt_at LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE outbox SET status = 'sending', attempts = attempts + 1, lease_holder = ?, lease_until = ?,"
+                    " updated_at = ? WHERE id = ?",
+                    (self.worker_id, now + self.lease_seconds, now, row[0])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if not row:
+            return None
+        return {'id': row[0], 'key': row[1], 'kind': row[2], 'payload': json.loads(row[3]),
+                'attempts': row[4] + 1, 'created_at': row[5]}
+
+    def _work(self):
+        while True:
+            try:
+                message = self._claim()
+            except sqlite3.Error as e:
+                print(f"Outbound queue claim failed: {e}")
+                message = None
+            if message is None:
+                if self.stopping:
+                    return
+                with self.wake:
+                    self.wake.wait(1.0)
+                continue
+            with self.wake:
+                self.busy += 1
+            try:
+                self._deliver(message)
+            finally:
+                with self.wake:
+                    self.busy -= 1
+                    self.wake.notify_all()
+
+    def _deliver(self, message):
+        kind = message['kind']
+        started = time.time()
+        try:
+            handler = self.handlers[kind]
+            handler(message['payload'])
+        except Exception as error:
+            self._failed(message, error)
+            return
+        finally:
+            if self.metrics:
+                self.metrics.observe("outbound_send_seconds", time.time() - started, {"kind": kind})
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute("UPDATE outbox SET status = 'sent', lease_holder = NULL, payload = ?, updated_at = ? WHERE id = ?",
+                         (json.dumps(message['payload']), now, message['id']))
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM outbox WHERE status = 'sent' AND updated_at <= ?", (now - self.keep_seconds,))
+        self._inc("outbound_messages_total", {"kind": kind, "outcome": "sent"})
+        if self.metrics:
+            self.metrics.observe("outbound_delivery_seconds", now - message['created_at'], {"kind": kind})
+
+    def _failed(self, message, error):
+        kind = message['kind']
+        retry = is_retryable(error) and message['attempts'] < self.max_attempts and kind in self.handlers
+        now = time.time()
+        with self._connection() as conn:
+            if retry:
+                delay = min(self.max_delay, self.base_delay * 2 ** (message['attempts'] - 1))
+                delay *= random.uniform(0.5, 1.0)
+                conn.execute(
+                    "UPDATE outbox SET status = 'pending', next_attempt_at = ?, lease_holder = NULL, payload = ?,"
+                    " last_error = ?, updated_at = ? WHERE id = ?",
+                    (now + delay, json.dumps(message['payload']), repr(error)[:500], now, message['id'])
+                )
+            else:
+                conn.execute(
+                    "UPDATE outbox SET status = 'dead', lease_holder = NULL, payload = ?, last_error = ?, updated_at = ?"
+                    " WHERE id = ?",
+                    (json.dumps(message['payload']), repr(error)[:500], now, message['id'])
+                )
+        outcome = "retried" if retry else "dead"
+        print(f"Outbound {kind} message {message['key']} failed (attempt {message['attempts']}, {outcome}): {error}")
+        self._inc("outbound_messages_total", {"kind": kind, "outcome": outcome})
+
+    def counts(self):
+        """Messages per status"""
+        return dict(self._connection().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+    def due(self):
+        now = time.time()
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM outbox WHERE (status = 'pending' AND next_attempt_at <= ?)"
+            " OR (status = 'sending' AND lease_holder = ?)",
+            (now, self.worker_id)
+        ).fetchone()[0]
+
+    def dead_letters(self, limit=50):
+        rows = self._connection().execute(
+            "SELECT idempotency_key, kind, attempts, last_error, updated_at FROM outbox WHERE status = 'dead'"
+            " ORDER BY updated_at DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [dict(zip(('key', 'kind', 'attempts', 'last_error', 'updated_at'), row)) for row in rows]
+
+    def retry_dead(self):
+        """Move every dead-lettered message back to pending; returns how many"""
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? WHERE status = 'dead'",
+                (time.time(), time.time())
+            )
+        with self.wake:
+            self.wake.notify_all()
+        return cursor.rowcount
+
+    def drain(self, timeout=20.0):
+        """On shutdown: keep sending what is due until nothing is left or timeout passes.
+
+        Messages still waiting for a backoff stay in the file for the next process.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.wake:
+                busy = self.busy
+            if not busy and not self.due():
+                break
+            with self.wake:
+                self.wake.wait(0.2)
+        self.stopping = True
+        with self.wake:
+            self.wake.notify_all()
+        return self.due()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the outbound WhatsApp queue")
+    parser.add_argument("command", choices=["stats", "retry-dead"])
+    parser.add_argument("--db", default="outbox.sqlite3")
+    args = parser.parse_args()
+
+    queue = OutboundQueue(args.db, {})
+    if args.command == "stats":
+        print(json.dumps(queue.counts(), indent=2))
+        for dead in queue.dead_letters(10):
+            print(f"dead: {dead['kind']} {dead['key']} after {dead['attempts']} attempts: {dead['last_error']}")
+    else:
+        print(f"requeued {queue.retry_dead()} messages")
+
+
+if __name__ == "__main__":
+    main()
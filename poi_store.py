@@ -0,0 +1,360 @@
+"""Offline point-of-interest store for CityGuide.AI.
+
+POIs are imported from OpenStreetMap extracts into a SQLite file with an R-tree index and
+queried by category and radius without touching the network:
+
+    python poi_store.py import delhi.osm.bz2 mumbai.geojson --db pois.sqlite3
+    python poi_store.py query --lat 28.6315 --lon 77.2167 --category atm --radius 1000
+
+.osm / .osm.bz2 (XML) and GeoJSON (e.g. an Overpass or osmtogeojson export) are read with
+the standard library; .osm.pbf needs the optional `osmium` package.
+This module has no dependency on app.py so extracts can be imported without the app's credentials.
+"""
+import argparse
+import bz2
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+
+# Category -> OSM tags that map to it and the words users ask for it with
+POI_CATEGORIES = {
+    'atm': {'tags': [('amenity', 'atm')], 'keywords': ['atm', 'atms', 'cash machine', 'cash point']},
+    'bank': {'tags': [('amenity', 'bank')], 'keywords': ['bank', 'banks']},
+    'restaurant': {'tags': [('amenity', 'restaurant'), ('amenity', 'fast_food'), ('amenity', 'food_court')],
+                   'keywords': ['restaurant', 'restaurants', 'food', 'eat', 'dinner', 'lunch', 'dhaba', 'street food']},
+    'cafe': {'tags': [('amenity', 'cafe')], 'keywords': ['cafe', 'cafes', 'coffee', 'tea']},
+    'bar': {'tags': [('amenity', 'bar'), ('amenity', 'pub'), ('amenity', 'nightclub')],
+            'keywords': ['bar', 'bars', 'pub', 'pubs', 'nightlife', 'club', 'clubs', 'drinks']},
+    'hospital': {'tags': [('amenity', 'hospital'), ('amenity', 'clinic'), ('amenity', 'doctors')],
+                 'keywords': ['hospital', 'hospitals', 'clinic', 'clinics', 'doctor', 'doctors', 'emergency']},
+    'pharmacy': {'tags': [('amenity', 'pharmacy')], 'keywords': ['pharmacy', 'pharmacies', 'chemist', 'medical store', 'medicine']},
+    'fuel': {'tags': [('amenity', 'fuel')], 'keywords': ['petrol', 'petrol pump', 'gas station', 'fuel']},
+    'toilets': {'tags': [('amenity', 'toilets')], 'keywords': ['toilet', 'toilets', 'restroom', 'washroom']},
+    'police': {'tags': [('amenity', 'police')], 'keywords': ['police', 'police station']},
+    'hotel': {'tags': [('tourism', 'hotel'), ('tourism', 'guest_house'), ('tourism', 'hostel')],
+              'keywords': ['hotel', 'hotels', 'hostel', 'hostels', 'guest house', 'stay', 'accommodation']},
+    'museum': {'tags': [('tourism', 'museum'), ('tourism', 'gallery')], 'keywords': ['museum', 'museums', 'gallery', 'art']},
+    'attraction': {'tags': [('tourism', 'attraction'), ('tourism', 'viewpoint')],
+                   'keywords': ['attraction', 'attractions', 'sightseeing', 'tourist', 'viewpoint', 'landmark', 'landmarks']},
+    'historic': {'tags': [('historic', '*')], 'keywords': ['historic', 'history', 'heritage', 'monument', 'monuments', 'fort', 'forts']},
+    'park': {'tags': [('leisure', 'park'), ('leisure', 'garden'), ('leisure', 'nature_reserve')],
+             'keywords': ['park', 'parks', 'garden', 'gardens', 'nature', 'green']},
+    'place_of_worship': {'tags': [('amenity', 'place_of_worship')],
+                         'keywords': ['temple', 'temples', 'mosque', 'church', 'gurudwara', 'spiritual', 'worship']},
+    'shop': {'tags': [('shop', '*'), ('amenity', 'marketplace')],
+             'keywords': ['shop', 'shops', 'shopping', 'mall', 'market', 'markets', 'store', 'bazaar']},
+    'transit': {'tags': [('railway', 'station'), ('amenity', 'bus_station'), ('station', 'subway')],
+                'keywords': ['metro', 'station', 'railway', 'train', 'bus stand', 'bus station']},
+    # Neighbourhoods are only used to find the centre of a search like 'ATMs near Connaught Place'
+    'area': {'tags': [('place', 'suburb'), ('place', 'neighbourhood'), ('place', 'quarter'), ('place', 'locality')],
+             'keywords': []},
+}
+
+EARTH_RADIUS_M = 6371000
+
+
+def category_for_tags(tags):
+    for category, spec in POI_CATEGORIES.items():
+        for key, value in spec['tags']:
+            if key in tags and (value == '*' or tags[key] == value):
+                return category
+    return None
+
+
+def categories_for_query(text):
+    """Categories a free-text request refers to, e.g. 'ATMs near Connaught Place' -> ['atm']"""
+    words = ' ' + re.sub(r'[^a-z0-9]+', ' ', (text or "").lower()) + ' '
+    return [category for category, spec in POI_CATEGORIES.items()
+            if any(f' {keyword} ' in words for keyword in spec['keywords'])]
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def format_address(tags):
+    street = ' '.join(part for part in (tags.get('addr:housenumber'), tags.get('addr:street')) if part)
+    parts = [street, tags.get('addr:suburb'), tags.get('addr:city')]
+    return ', '.join(part for part in parts if part)
+
+
+class POIStore:
+    """SQLite POI table with an R-tree over coordinates (plain lat/lon index if R-tree is unavailable)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.connections = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pois (id INTEGER PRIMARY KEY, osm_id TEXT UNIQUE, name TEXT NOT NULL, "
+                "category TEXT NOT NULL, lat REAL NOT NULL, lon REAL NOT NULL, address TEXT, tags TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS pois_category ON pois (category)")
+            conn.execute("CREATE INDEX IF NOT EXISTS pois_name ON pois (name COLLATE NOCASE)")
+            try:
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS pois_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+                self.rtree = True
+            except sqlite3.OperationalError:
+                conn.execute("CREATE INDEX IF NOT EXISTS pois_lat_lon ON pois (lat, lon)")
+                self.rtree = False
+
+    def _connection(self):
+        conn = getattr(self.connections, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.row_factory = sqlite3.Row
+            self.connections.conn = conn
+        return conn
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM pois").fetchone()[0]
+
+    def add_many(self, pois):
+        """Insert or replace POIs given as dicts with osm_id, name, category, lat, lon, address, tags"""
+        count = 0
+        with self._connection() as conn:
+            for poi in pois:
+                conn.execute(
+                    "INSERT INTO pois (osm_id, name, category, lat, lon, address, tags) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (osm_id) DO UPDATE SET name = excluded.name, category = excluded.category, "
+                    "lat = excluded.lat, lon = excluded.lon, address = excluded.address, tags = excluded.tags",
+                    (poi['osm_id'], poi['name'], poi['category'], poi['lat'], poi['lon'],
+                     poi.get('address', ''), json.dumps(poi.get('tags', {})))
+                )
+                poi_id = conn.execute("SELECT id FROM pois WHERE osm_id = ?", (poi['osm_id'],)).fetchone()[0]
+                if self.rtree:
+                    conn.execute("INSERT OR REPLACE INTO pois_rtree VALUES (?, ?, ?, ?, ?)",
+                                 (poi_id, poi['lat'], poi['lat'], poi['lon'], poi['lon']))
+                count += 1
+        return count
+
+    def nearby(self, lat, lon, categories=(), radius_m=1500, limit=10):
+        """POIs within radius_m of a point, nearest first, each with a 'distance_m'"""
+        d_lat = math.degrees(radius_m / EARTH_RADIUS_M)
+        d_lon = d_lat / max(math.cos(math.radians(lat)), 0.01)
+        box = (lat - d_lat, lat + d_lat, lon - d_lon, lon + d_lon)
+        if self.rtree:
+            sql = ("SELECT p.* FROM pois_rtree r JOIN pois p ON p.id = r.id "
+                   "WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lon >= ? AND r.max_lon <= ?")
+        else:
+            sql = "SELECT p.* FROM pois p WHERE p.lat BETWEEN ? AND ? AND p.lon BETWEEN ? AND ?"
+        params = list(box)
+        if categories:
+            sql += f" AND p.category IN ({', '.join('?' * len(categories))})"
+            params.extend(categories)
+        results = []
+        for row in self._connection().execute(sql, params):
+            distance = haversine_m(lat, lon, row['lat'], row['lon'])
+            if distance <= radius_m:
+                poi = dict(row)
+                poi['distance_m'] = distance
+                results.append(poi)
+        results.sort(key=lambda poi: poi['distance_m'])
+        return results[:limit]
+
+    def find_place(self, name, lat=None, lon=None, radius_m=None):
+        """Best match for a named place ('Connaught Place'), preferring neighbourhoods, or None.
+
+        With a centre and radius (the city the user means), only places within radius_m count,
+        nearest first, so a 'Station Road' in another city is never picked.
+        """
+        name = (name or "").strip()
+        if not name:
+            return None
+        rows = self._connection().execute(
+            "SELECT * FROM pois WHERE name = ? COLLATE NOCASE ORDER BY category != 'area'", (name,)
+        ).fetchall()
+        if lat is None or lon is None:
+            return dict(rows[0]) if rows else None
+        best = None
+        for row in rows:
+            distance = haversine_m(lat, lon, row['lat'], row['lon'])
+            if radius_m is not None and distance > radius_m:
+                continue
+            rank = (row['category'] != 'area', distance)
+            if best is None or rank < best[0]:
+                best = (rank, row)
+        return dict(best[1]) if best else None
+
+
+def poi_from_element(osm_id, tags, lat, lon):
+    name = tags.get('name:en') or tags.get('name')
+    if not name or lat is None or lon is None:
+        return None
+    category = category_for_tags(tags)
+    if not category:
+        return None
+    return {'osm_id': osm_id, 'name': name, 'category': category, 'lat': lat, 'lon': lon,
+            'address': format_address(tags), 'tags': tags}
+
+
+def iter_osm_elements(path):
+    """Top-level node/way/relation elements of an .osm or .osm.bz2 file, cleared once consumed.
+
+    The root is cleared after each element as well, so memory stays flat however large the
+    extract is; callers must copy what they need before asking for the next element.
+    """
+    opener = bz2.open if path.endswith('.bz2') else open
+    with opener(path, 'rb') as f:
+        root = None
+        depth = 0
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                yield elem
+                elem.clear()
+                root.clear()
+
+
+def element_tags(elem):
+    return {tag.get('k'): tag.get('v') for tag in elem.findall('tag')}
+
+
+def way_poi_tags(tags):
+    """Whether a way's tags would make a POI, so its nodes' coordinates are worth keeping"""
+    return bool(tags.get('name:en') or tags.get('name')) and category_for_tags(tags) is not None
+
+
+def read_osm_xml(path):
+    """Tagged nodes from an .osm or .osm.bz2 extract, plus ways placed at the centre of their nodes.
+
+    Ways come after the nodes they reference, so a first pass collects the node IDs used by
+    POI ways and the second pass keeps coordinates for those nodes only, not every node in
+    the extract.
+    """
+    needed = set()
+    for elem in iter_osm_elements(path):
+        if elem.tag == 'way' and way_poi_tags(element_tags(elem)):
+            needed.update(int(nd.get('ref')) for nd in elem.findall('nd'))
+    coords = {}
+    for elem in iter_osm_elements(path):
+        if elem.tag == 'node':
+            node_id = int(elem.get('id'))
+            lat, lon = float(elem.get('lat')), float(elem.get('lon'))
+            if node_id in needed:
+                coords[node_id] = (lat, lon)
+            tags = element_tags(elem)
+            if tags:
+                poi = poi_from_element(f"node/{node_id}", tags, lat, lon)
+                if poi:
+                    yield poi
+        elif elem.tag == 'way':
+            tags = element_tags(elem)
+            if not way_poi_tags(tags):
+                continue
+            points = [coords[int(nd.get('ref'))] for nd in elem.findall('nd') if int(nd.get('ref')) in coords]
+            if points:
+                lat = sum(p[0] for p in points) / len(points)
+                lon = sum(p[1] for p in points) / len(points)
+                poi = poi_from_element(f"way/{elem.get('id')}", tags, lat, lon)
+                if poi:
+                    yield poi
+
+
+def read_geojson(path):
+    with open(path, encoding='utf-8') as f:
+        collection = json.load(f)
+    for index, feature in enumerate(collection.get('features', [])):
+        tags = dict(feature.get('properties') or {})
+        tags.update(tags.pop('tags', None) or {})
+        points = list(geometry_points(feature.get('geometry') or {}))
+        if not points:
+            continue
+        lon = sum(p[0] for p in points) / len(points)
+        lat = sum(p[1] for p in points) / len(points)
+        osm_id = str(feature.get('id') or tags.get('@id') or f"{os.path.basename(path)}/{index}")
+        poi = poi_from_element(osm_id, tags, lat, lon)
+        if poi:
+            yield poi
+
+
+def geometry_points(geometry):
+    coordinates = geometry.get('coordinates')
+    if geometry.get('type') == 'Point':
+        yield coordinates[:2]
+        return
+
+    def walk(value):
+        if value and isinstance(value[0], (int, float)):
+            yield value[:2]
+        else:
+            for item in value or []:
+                yield from walk(item)
+
+    yield from walk(coordinates)
+
+
+def read_pbf(path):
+    import osmium
+
+    pois = []
+
+    class Handler(osmium.SimpleHandler):
+        def node(self, n):
+            tags = {tag.k: tag.v for tag in n.tags}
+            if tags and n.location.valid():
+                poi = poi_from_element(f"node/{n.id}", tags, n.location.lat, n.location.lon)
+                if poi:
+                    pois.append(poi)
+
+        def way(self, w):
+            tags = {tag.k: tag.v for tag in w.tags}
+            points = [(nd.location.lat, nd.location.lon) for nd in w.nodes if nd.location.valid()]
+            if tags and points:
+                lat = sum(p[0] for p in points) / len(points)
+                lon = sum(p[1] for p in points) / len(points)
+                poi = poi_from_element(f"way/{w.id}", tags, lat, lon)
+                if poi:
+                    pois.append(poi)
+
+    Handler().apply_file(path, locations=True)
+    return pois
+
+
+def read_extract(path):
+    if path.endswith('.pbf'):
+        return read_pbf(path)
+    if path.endswith(('.geojson', '.json')):
+        return read_geojson(path)
+    return read_osm_xml(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=os.getenv("POI_DB_PATH", "pois.sqlite3"))
+    commands = parser.add_subparsers(dest='command', required=True)
+    importer = commands.add_parser('import', help="import OSM extracts")
+    importer.add_argument('paths', nargs='+')
+    query = commands.add_parser('query', help="list POIs around a point")
+    query.add_argument('--lat', type=float, required=True)
+    query.add_argument('--lon', type=float, required=True)
+    query.add_argument('--category', action='append', default=[])
+    query.add_argument('--radius', type=float, default=1500)
+    query.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    store = POIStore(args.db)
+    if args.command == 'import':
+        for path in args.paths:
+            print(f"{path}: {store.add_many(read_extract(path))} POIs")
+        print(f"{args.db}: {len(store)} POIs total")
+    else:
+        for poi in store.nearby(args.lat, args.lon, args.category, args.radius, args.limit):
+            print(f"{poi['distance_m']:7.0f} m  {poi['category']:<12} {poi['name']}  {poi['address'] or ''}")
+
+
+if __name__ == '__main__':
+    main()
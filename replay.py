@@ -0,0 +1,652 @@
+"""Offline replay harness for CityGuide.AI.
+
+Drives the real /incoming webhook with recorded Twilio payloads while every external
+service is replaced by a local fake with injected latency: Twilio (sends and media
+downloads), Gemini (chat and transcription), SerpAPI, ElevenLabs, the emotion model,
+pydub transcoding and Firestore (in memory, or the emulator when FIRESTORE_EMULATOR_HOST
+is set). Nothing touches the network. Per-message latency and the per-stage breakdown come
+from the app's own trace spans.
+
+Run through benchmark.py:
+
+    python benchmark.py replay [--payloads replay_payloads.jsonl] [--users 20] [--rate 5]
+                               [--latency gemini=900 serpapi=600] [--latency-scale 0.1]
+
+Payload lines are Twilio webhook form fields (From, Body, MediaUrl0) plus optional keys
+for the fakes: "transcript" (what the fake transcriber hears in the voice note) and
+"agent" (the agent's first reply, e.g. an Action / Action Input pair).
+"""
+import copy
+import json
+import os
+import random
+import re
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+
+# Injected latency per fake, in milliseconds; each call sleeps base * uniform(0.7, 1.4)
+DEFAULT_LATENCIES = {
+    'gemini': 900,
+    'gemini_per_1k_chars': 400,
+    'transcribe': 1500,
+    'serpapi': 600,
+    'elevenlabs': 700,
+    'elevenlabs_per_1k_chars': 900,
+    'twilio': 250,
+    'twilio_media': 200,
+    'firestore': 30,
+    'transcode': 150,
+    'mood': 60,
+}
+
+
+class Latency:
+    def __init__(self, overrides=None, scale=1.0, seed=7):
+        self.values = dict(DEFAULT_LATENCIES, **(overrides or {}))
+        self.scale = scale
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sleep(self, name, units=0.0):
+        base = self.values.get(name, 0)
+        if units:
+            base += self.values.get(f"{name}_per_1k_chars", 0) * units / 1000
+        with self.lock:
+            jitter = self.rng.uniform(0.7, 1.4)
+        if base > 0:
+            time.sleep(base * jitter * self.scale / 1000)
+
+
+# --- Firestore -------------------------------------------------------------------------
+
+def split_field_path(path):
+    """'stats.`bookmarks_by_city`.delhi' -> ['stats', 'bookmarks_by_city', 'delhi']"""
+    return [part.strip('`').replace('\\`', '`') for part in re.findall(r'`(?:[^`\\]|\\.)*`|[^.]+', path)]
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        value = self._data
+        for part in split_field_path(field):
+            value = (value or {}).get(part)
+        return copy.deepcopy(value)
+
+
+class FakeDocument:
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.store, f"{self.path}/{name}")
+
+    def get(self, transaction=None, **kwargs):
+        self.store.latency.sleep('firestore')
+        with self.store.lock:
+            return FakeSnapshot(self, copy.deepcopy(self.store.docs.get(self.path)))
+
+    def set(self, data, merge=False):
+        self.store.latency.sleep('firestore')
+        with self.store.lock:
+            current = self.store.docs.get(self.path) if merge else None
+            document = copy.deepcopy(current) if current is not None else {}
+            for key, value in data.items():
+                self.store.apply(document, [key], value)
+            self.store.docs[self.path] = document
+
+    def update(self, updates):
+        self.store.latency.sleep('firestore')
+        with self.store.lock:
+            if self.path not in self.store.docs:
+                raise KeyError(f"No document to update: {self.path}")
+            document = self.store.docs[self.path]
+            for key, value in updates.items():
+                self.store.apply(document, split_field_path(key), value)
+
+    def delete(self):
+        self.store.latency.sleep('firestore')
+        with self.store.lock:
+            self.store.docs.pop(self.path, None)
+
+    def on_snapshot(self, callback):
+        return types.SimpleNamespace(unsubscribe=lambda: None)
+
+
+class FakeQuery:
+    def __init__(self, store, path, filters=(), order=None, limit=None):
+        self.store = store
+        self.path = path
+        self.filters = list(filters)
+        self.order = order
+        self.limit_count = limit
+
+    def where(self, field, op, value):
+        if op != '==':
+            raise NotImplementedError(f"fake Firestore only supports '==' filters, got {op!r}")
+        return FakeQuery(self.store, self.path, self.filters + [(field, value)], self.order, self.limit_count)
+
+    def order_by(self, field, **kwargs):
+        return FakeQuery(self.store, self.path, self.filters, field, self.limit_count)
+
+    def limit(self, count):
+        return FakeQuery(self.store, self.path, self.filters, self.order, count)
+
+    def stream(self):
+        self.store.latency.sleep('firestore')
+        prefix = self.path + '/'
+        with self.store.lock:
+            rows = [(path, copy.deepcopy(data)) for path, data in self.store.docs.items()
+                    if path.startswith(prefix) and '/' not in path[len(prefix):]]
+        rows = [(path, data) for path, data in rows if all(data.get(f) == v for f, v in self.filters)]
+        if self.order:
+            rows.sort(key=lambda row: str(row[1].get(self.order, '')))
+        if self.limit_count is not None:
+            rows = rows[:self.limit_count]
+        return iter([FakeSnapshot(FakeDocument(self.store, path), data) for path, data in rows])
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, store, path):
+        super().__init__(store, path)
+
+    def document(self, document_id=None):
+        return FakeDocument(self.store, f"{self.path}/{document_id or uuid.uuid4().hex[:20]}")
+
+
+class FakeBatch:
+    def __init__(self):
+        self.operations = []
+
+    def set(self, reference, data, merge=False):
+        self.operations.append(lambda: reference.set(data, merge=merge))
+
+    def update(self, reference, updates):
+        self.operations.append(lambda: reference.update(updates))
+
+    def delete(self, reference):
+        self.operations.append(reference.delete)
+
+    def commit(self):
+        for operation in self.operations:
+            operation()
+
+
+class FakeTransaction:
+    """Writes apply immediately; the app's transactional functions run once without retries"""
+
+    def set(self, reference, data, merge=False):
+        reference.set(data, merge=merge)
+
+    def update(self, reference, updates):
+        reference.update(updates)
+
+    def delete(self, reference):
+        reference.delete()
+
+
+class FakeFirestore:
+    """In-memory Firestore covering the calls the app makes, including field transforms"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.docs = {}
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch()
+
+    def transaction(self):
+        return FakeTransaction()
+
+    def apply(self, document, parts, value):
+        from firebase_admin import firestore
+
+        parent = document
+        for part in parts[:-1]:
+            parent = parent.setdefault(part, {})
+        key = parts[-1]
+        if value is firestore.DELETE_FIELD:
+            parent.pop(key, None)
+        elif value is firestore.SERVER_TIMESTAMP:
+            parent[key] = time.time()
+        elif isinstance(value, type(firestore.ArrayUnion([]))):
+            current = parent.setdefault(key, [])
+            current.extend(copy.deepcopy(v) for v in value.values if v not in current)
+        elif isinstance(value, type(firestore.ArrayRemove([]))):
+            parent[key] = [v for v in parent.get(key, []) if v not in value.values]
+        elif isinstance(value, type(firestore.Increment(1))):
+            parent[key] = parent.get(key, 0) + value.value
+        elif isinstance(value, dict):
+            parent[key] = {}
+            for child_key, child_value in value.items():
+                self.apply(parent[key], [child_key], child_value)
+        else:
+            parent[key] = copy.deepcopy(value)
+
+
+# --- Redis -----------------------------------------------------------------------------
+
+class FakeRedisServer:
+    """Local stand-in for a Redis server: the RESP commands RedisCache uses (GET, SET with NX/EX,
+    DEL, AUTH, SELECT, PING), keys expiring on a monotonic clock"""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.data = {}
+        self.lock = threading.Lock()
+        store = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        command = store.read_command(self.rfile)
+                    except (ValueError, OSError):
+                        return
+                    if command is None:
+                        return
+                    self.wfile.write(store.execute(command))
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"redis://{host}:{self.server.server_address[1]}/0"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def read_command(rfile):
+        line = rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            raise ValueError(f"expected a RESP array, got {line!r}")
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(rfile.readline()[1:-2])
+            args.append(rfile.read(length + 2)[:-2])
+        return args
+
+    @staticmethod
+    def bulk(value):
+        if value is None:
+            return b"$-1\r\n"
+        return b"$" + str(len(value)).encode() + b"\r\n" + value + b"\r\n"
+
+    def execute(self, args):
+        name = args[0].decode().upper()
+        now = time.monotonic()
+        with self.lock:
+            if name in ("AUTH", "SELECT", "PING"):
+                return b"+OK\r\n" if name != "PING" else b"+PONG\r\n"
+            if name == "GET":
+                value, expires_at = self.data.get(args[1], (None, None))
+                if expires_at is not None and expires_at <= now:
+                    self.data.pop(args[1], None)
+                    value = None
+                return self.bulk(value)
+            if name == "SET":
+                options = [arg.decode().upper() for arg in args[3:]]
+                expires_at = now + int(options[options.index("EX") + 1]) if "EX" in options else None
+                current = self.data.get(args[1])
+                if "NX" in options and current and (current[1] is None or current[1] > now):
+                    return self.bulk(None)
+                self.data[args[1]] = (args[2], expires_at)
+                return b"+OK\r\n"
+            if name == "DEL":
+                removed = sum(1 for key in args[1:] if self.data.pop(key, None) is not None)
+                return b":" + str(removed).encode() + b"\r\n"
+        return b"-ERR unknown command '" + args[0] + b"'\r\n"
+
+
+# --- Gemini ----------------------------------------------------------------------------
+
+class FakeChatModel:
+    """Stands in for ChatGoogleGenerativeAI; scripted agent replies, filler text for tools"""
+
+    model = "gemini-2.5-flash"
+
+    def __init__(self, latency, reply_chars=1200, scripts=None):
+        self.latency = latency
+        self.reply_chars = reply_chars
+        self.scripts = scripts if scripts is not None else {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def invoke(self, messages, *args, **kwargs):
+        from langchain_core.messages import AIMessage
+
+        prompt = "\n".join(str(getattr(message, 'content', message)) for message in messages)
+        content = self.reply(prompt)
+        self.latency.sleep('gemini', len(content))
+        with self.lock:
+            self.calls += 1
+        input_tokens, output_tokens = len(prompt) // 4, len(content) // 4
+        return AIMessage(content=content, usage_metadata={
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': input_tokens + output_tokens,
+        })
+
+    def reply(self, prompt):
+        said = re.findall(r'Now the user says:\s*"(.*?)"', prompt, re.S)
+        if "Observation:" in prompt:
+            observation = prompt.rsplit("Observation:", 1)[1].split("Now provide your final response", 1)[0]
+            return "Here is what I found for you!\n" + observation.strip()[:self.reply_chars]
+        if said:
+            text = said[-1].strip()
+            if text in self.scripts:
+                return self.scripts[text]
+            return "Final Answer: " + self.filler(text)
+        return self.filler(prompt[-200:])
+
+    def filler(self, seed):
+        sentence = "Wander the old lanes early, stop for chai at a corner stall and keep an eye out for the street art. "
+        text = f"Sure! ({seed[:40].strip()}) "
+        while len(text) < self.reply_chars:
+            text += sentence
+        return text[:self.reply_chars]
+
+
+class FakeGenAI:
+    """Stands in for the google.generativeai upload + generate_content transcription calls"""
+
+    def __init__(self, latency, transcripts):
+        self.latency = latency
+        self.transcripts = transcripts
+
+    def upload_file(self, path):
+        return path
+
+    def generate_content(self, model=None, contents=None, **kwargs):
+        path = contents[-1]
+        with open(path, 'rb') as f:
+            key = f.read().decode('utf-8', 'ignore').strip()
+        self.latency.sleep('transcribe')
+        return types.SimpleNamespace(text=f"Language: English\nTranscription: {self.transcripts.get(key, 'Hello')}")
+
+
+# --- SerpAPI, ElevenLabs, Twilio, media ------------------------------------------------
+
+def make_fake_search(latency):
+    class FakeGoogleSearch:
+        def __init__(self, params):
+            self.params = params
+            self.timeout = None
+
+        def get_dict(self):
+            latency.sleep('serpapi')
+            query = self.params.get('q', '')
+            engine = self.params.get('engine')
+            if engine == 'google_events':
+                return {'events_results': [{'title': f"{query} #{i}", 'venue': {'name': "Town Hall"},
+                                            'date': {'start_date': "Sat"}} for i in range(5)]}
+            if engine == 'google_news':
+                return {'news_results': [{'title': f"Headline {i} for {query}", 'source': "Daily",
+                                          'date': "today", 'snippet': "Short summary."} for i in range(5)]}
+            if query.startswith("weather"):
+                return {'answer_box': {'temperature': "31", 'weather': "Sunny", 'humidity': "40%", 'wind': "8 km/h"}}
+            return {'local_results': {'places': [{'title': f"Place {i}", 'address': "Main Road",
+                                                  'rating': 4.2} for i in range(5)]}}
+
+    return FakeGoogleSearch
+
+
+def make_fake_elevenlabs(latency):
+    class FakeTextToSpeech:
+        def convert(self, text="", **kwargs):
+            latency.sleep('elevenlabs', len(text))
+            # Roughly 1 KB of 128 kbps MP3 per 8 characters of speech
+            yield b"\xff\xfb" * (len(text) * 64)
+
+    class FakeElevenLabs:
+        def __init__(self, *args, **kwargs):
+            self.text_to_speech = FakeTextToSpeech()
+
+    return FakeElevenLabs
+
+
+class FakeTwilio:
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.sent = []
+        self.messages = self
+
+    def create(self, **kwargs):
+        self.latency.sleep('twilio')
+        with self.lock:
+            self.sent.append(dict(kwargs, sent_at=time.time()))
+        return types.SimpleNamespace(sid="SM" + uuid.uuid4().hex)
+
+
+class FakeAudioSegment:
+    def __init__(self, data=b"", **kwargs):
+        self.data = data
+
+    @classmethod
+    def from_ogg(cls, path):
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    @classmethod
+    def from_file(cls, path, *args, **kwargs):
+        return cls.from_ogg(path)
+
+    def export(self, path, *args, **kwargs):
+        FakeAudioSegment.latency.sleep('transcode')
+        if hasattr(path, 'write'):
+            path.write(self.data)
+            return
+        with open(path, 'wb') as f:
+            f.write(self.data)
+
+
+def make_fake_get(latency):
+    def fake_get(url, *args, **kwargs):
+        latency.sleep('twilio_media')
+        # The media URL stands in for the voice note; the fake transcriber maps it to text
+        return types.SimpleNamespace(content=url.encode('utf-8'), status_code=200, raise_for_status=lambda: None)
+
+    return fake_get
+
+
+# --- Harness ---------------------------------------------------------------------------
+
+def load_payloads(path, users, repeat):
+    """Recorded payloads, fanned out over `users` synthetic phone numbers"""
+    with open(path, encoding='utf-8') as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    payloads = []
+    for _ in range(repeat):
+        for user in range(users):
+            for payload in recorded:
+                payload = dict(payload)
+                payload['From'] = f"whatsapp:+9190000{user:05d}"
+                payloads.append(payload)
+    return payloads
+
+
+def install_fakes(latency, args, scripts, transcripts):
+    """Configure the environment and patch client libraries so importing app.py stays offline"""
+    os.environ.setdefault("PROFILE_CACHE_LISTENERS", "false")
+    os.environ.setdefault("GEMINI_CONTEXT_CACHE", "false")
+    os.environ.setdefault("CACHE_BACKEND", args.cache)
+    if args.cache == "redis" and not os.getenv("CACHE_REDIS_URL"):
+        os.environ["CACHE_REDIS_URL"] = FakeRedisServer().start().url
+    os.environ.setdefault("EMBEDDING_MODEL", "hashing")
+    os.environ.setdefault("PREFETCH_ENABLED", "false")
+    # Each synthetic user posts its payloads back to back; measure the pipeline, not the rate limiter
+    os.environ.setdefault("RATE_LIMIT_PER_MINUTE", "0")
+    os.environ.setdefault("TRACING_MAX_SPANS", "1000000")
+    os.environ.setdefault("POI_DB_PATH", os.path.join(tempfile.gettempdir(), "cityguide-replay-no-pois.sqlite3"))
+    os.environ.setdefault("MEDIA_URL_AUDIO", "http://localhost")
+
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    fake_db = None
+    if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        fake_db = FakeFirestore(latency)
+        os.environ.setdefault("FIREBASE_CREDENTIALS_JSON", "{}")
+        firebase_admin.initialize_app = lambda *a, **k: None
+        credentials.Certificate = lambda *a, **k: None
+        firestore.client = lambda *a, **k: fake_db
+        # The fake transaction applies writes directly, so run transactional functions as-is
+        firestore.transactional = lambda fn: fn
+
+    import langchain_google_genai
+    import serpapi
+    import elevenlabs.client
+    import twilio.rest
+    import pydub
+    import transformers
+
+    chat_model = FakeChatModel(latency, args.reply_chars, scripts)
+    twilio_client = FakeTwilio(latency)
+    langchain_google_genai.ChatGoogleGenerativeAI = lambda *a, **k: chat_model
+    serpapi.GoogleSearch = make_fake_search(latency)
+    elevenlabs.client.ElevenLabs = make_fake_elevenlabs(latency)
+    twilio.rest.Client = lambda *a, **k: twilio_client
+    FakeAudioSegment.latency = latency
+    pydub.AudioSegment = FakeAudioSegment
+
+    def fake_pipeline(*args, **kwargs):
+        def classify(text):
+            latency.sleep('mood')
+            return [{'label': 'joy', 'score': 0.9}]
+        return classify
+
+    transformers.pipeline = fake_pipeline
+
+    import requests
+    requests.get = make_fake_get(latency)
+
+    import app
+    app.google_client = FakeGenAI(latency, transcripts)
+    return app, chat_model, twilio_client, fake_db
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(args):
+    latency = Latency(dict(args.latency), args.latency_scale, args.seed)
+    payloads = load_payloads(args.payloads, args.users, args.repeat)
+    scripts = {p['Body'].strip(): p['agent'] for p in payloads if p.get('agent') and p.get('Body')}
+    scripts.update({p['transcript'].strip(): p['agent'] for p in payloads if p.get('agent') and p.get('transcript')})
+    transcripts = {p['MediaUrl0']: p['transcript'] for p in payloads if p.get('MediaUrl0') and p.get('transcript')}
+
+    workdir = tempfile.mkdtemp(prefix="cityguide-replay-")
+    os.chdir(workdir)
+    app, chat_model, twilio_client, fake_db = install_fakes(latency, args, scripts, transcripts)
+    client = app.app.test_client()
+
+    print(f"replaying {len(payloads)} messages from {args.users} users "
+          f"({'emulator' if fake_db is None else 'in-memory'} Firestore, latency x{args.latency_scale})")
+    posted = {}
+    started = time.time()
+    for index, payload in enumerate(payloads):
+        if args.rate:
+            delay = started + index / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        form = {key: payload[key] for key in ('From', 'Body', 'MediaUrl0') if payload.get(key)}
+        response = client.post('/incoming', data=form)
+        trace_id = response.headers.get('X-Trace-Id')
+        if trace_id:
+            posted[trace_id] = time.time()
+
+    # Merged messages share the first message's turn, so wait until the scheduler and the
+    # background generation jobs are idle and every successful turn has sent its reply
+    # (audio when the delivery mode includes it)
+    deadline = time.time() + args.timeout
+    while time.time() < deadline:
+        spans = app.span_exporter.get_finished_spans()
+        turns = {s.trace_id for s in spans if s.name == 'turn' and s.status == "OK"}
+        audio_mode = os.environ.get("DEFAULT_DELIVERY_MODE", "both") != "text"
+        sent = {s.trace_id for s in spans if s.name == ('send_audio' if audio_mode else 'send_text')}
+        if not app.turn_scheduler.active and not app.generation_jobs.active and turns <= sent:
+            break
+        time.sleep(0.2)
+    elapsed = time.time() - started
+    report(app, posted, elapsed, chat_model, twilio_client)
+
+
+def report(app, posted, elapsed, chat_model, twilio_client):
+    spans = app.span_exporter.get_finished_spans()
+    by_trace = {}
+    for span in spans:
+        by_trace.setdefault(span.trace_id, []).append(span)
+    turn_latency, text_latency, delivery_latency = [], [], []
+    for trace_id, received in posted.items():
+        trace = by_trace.get(trace_id, [])
+        turn = next((s for s in trace if s.name == 'turn'), None)
+        if turn:
+            turn_latency.append(turn.end_time_unix_nano / 1e9 - received)
+        texts = [s for s in trace if s.name == 'send_text']
+        if texts:
+            text_latency.append(min(s.end_time_unix_nano for s in texts) / 1e9 - received)
+        sends = [s for s in trace if s.name == 'send_audio']
+        if sends:
+            delivery_latency.append(max(s.end_time_unix_nano for s in sends) / 1e9 - received)
+
+    print(f"completed turns: {len(turn_latency)}/{len(posted)} in {elapsed:.1f}s "
+          f"({len(turn_latency) / elapsed if elapsed else 0:.2f} turns/s); "
+          f"LLM calls: {chat_model.calls}; WhatsApp sends: {len(twilio_client.sent)}")
+    for label, values in (("reply ready", turn_latency), ("text delivered", text_latency),
+                          ("audio delivered", delivery_latency)):
+        print(f"{label:<16} p50 {percentile(values, 0.5):6.2f}s  p95 {percentile(values, 0.95):6.2f}s  "
+              f"p99 {percentile(values, 0.99):6.2f}s  max {max(values, default=0):6.2f}s")
+
+    stages = {}
+    for span in spans:
+        stages.setdefault(span.name, []).append(span.duration_seconds)
+    total = sum(stages.get('turn', [])) or 1.0
+    print(f"\n{'stage':<28} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'total s':>8} {'% of turn time':>15}")
+    for name, values in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        print(f"{name:<28} {len(values):>6} {percentile(values, 0.5) * 1000:>8.1f} "
+              f"{percentile(values, 0.95) * 1000:>8.1f} {sum(values):>8.2f} {sum(values) / total * 100:>14.1f}%")
+
+    usage = {}
+    for (name, labels), value in app.metrics.counters.items():
+        labels = dict(labels)
+        if name == 'llm_tokens_total':
+            usage.setdefault(labels['call_site'], {})[labels['kind']] = value
+        elif name == 'llm_calls_total':
+            site = usage.setdefault(labels['call_site'], {})
+            site['calls'] = site.get('calls', 0) + value
+    print(f"\n{'LLM call site':<28} {'calls':>6} {'input tok':>10} {'output tok':>10}")
+    for call_site, site in sorted(usage.items(), key=lambda item: -item[1].get('input', 0)):
+        print(f"{call_site:<28} {site.get('calls', 0):>6} {site.get('input', 0):>10} {site.get('output', 0):>10}")
+
+    print(f"\n{'model tier':<12} {'model':<24} {'calls':>6} {'p50 s':>7} {'p95 s':>7} {'SLO s':>6} {'downgraded to':>14}")
+    for tier, stats in app.model_policy.report().items():
+        print(f"{tier:<12} {stats['model']:<24} {stats['calls']:>6} {stats['p50_seconds'] or 0:>7.2f} "
+              f"{stats['p95_seconds'] or 0:>7.2f} {stats['slo_seconds']:>6.1f} {stats['downgraded_to']:>14}")
+    sys.stdout.flush()
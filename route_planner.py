@@ -0,0 +1,238 @@
+"""Stop ordering for day itineraries.
+
+Candidate stops with coordinates, opening windows and visit lengths are ordered against a
+precomputed travel-time matrix: a nearest-neighbour tour is built first and then improved
+with 2-opt. A schedule visits stops in tour order and skips any stop it cannot reach while
+it is open, so the cost of a tour is the number of stops it fits, then travel and waiting
+time. The LLM only narrates the resulting order.
+"""
+import math
+import re
+import time
+
+WALKING_KMH = 4.5
+CITY_KMH = 18
+WALK_LIMIT_KM = 1.5
+# Street distance is longer than the straight line; getting a cab or train costs a few minutes
+DETOUR_FACTOR = 1.3
+TRANSFER_MINUTES = 8
+MISSED_STOP_COST = 10000
+
+# Default opening window (minutes after midnight) and visit length in minutes by POI category
+CATEGORY_DEFAULTS = {
+    'museum': (600, 1050, 90),
+    'historic': (540, 1080, 75),
+    'attraction': (540, 1140, 60),
+    'park': (360, 1140, 45),
+    'place_of_worship': (360, 1200, 30),
+    'restaurant': (720, 1380, 60),
+    'cafe': (480, 1320, 40),
+    'bar': (1080, 1560, 90),
+    'shop': (660, 1260, 45),
+}
+DEFAULT_WINDOW = (540, 1260, 45)
+
+TIME_SLOTS = {
+    'morning': (540, 780),
+    'afternoon': (780, 1080),
+    'evening': (1020, 1350),
+    'night': (1140, 1500),
+}
+FULL_DAY = (540, 1260)
+
+
+def parse_clock(hours, minutes, meridiem):
+    value = int(hours) % 24 * 60 + int(minutes or 0)
+    if meridiem == 'pm' and int(hours) < 12:
+        value += 720
+    elif meridiem == 'am' and int(hours) == 12:
+        value -= 720
+    return value
+
+
+def time_window(time_slot):
+    """(start, end) minutes for a slot like 'morning', 'full day' or '10am to 4pm'"""
+    text = (time_slot or "").lower()
+    match = re.search(r'(\d{1,2})(?::(\d{2}))?\s*(am|pm)?\s*(?:-|to|until|till)\s*(\d{1,2})(?::(\d{2}))?\s*(am|pm)?', text)
+    if match:
+        start_meridiem = match.group(3)
+        if not start_meridiem and match.group(6):
+            # '2 to 6pm' shares the meridiem, '10 to 4pm' starts in the morning
+            same = int(match.group(1)) % 12 <= int(match.group(4)) % 12
+            start_meridiem = match.group(6) if same else {'am': 'pm', 'pm': 'am'}[match.group(6)]
+        start = parse_clock(match.group(1), match.group(2), start_meridiem)
+        end_meridiem = match.group(6)
+        if not end_meridiem and start < 13 * 60 and int(match.group(4)) < 12 \
+                and parse_clock(match.group(4), match.group(5), None) < start:
+            # '9-5', '10am-2' and '12-3' (noon) end in the afternoon, not early the next morning
+            end_meridiem = 'pm'
+        end = parse_clock(match.group(4), match.group(5), end_meridiem)
+        return start, end if end > start else end + 1440
+    slots = [window for name, window in TIME_SLOTS.items() if name in text]
+    if slots:
+        return min(s for s, _ in slots), max(e for _, e in slots)
+    return FULL_DAY
+
+
+def opening_window(opening_hours, category=""):
+    """Opening window from a simple OSM opening_hours value ('09:00-17:30', '24/7'), else the category default"""
+    default = CATEGORY_DEFAULTS.get(category, DEFAULT_WINDOW)
+    if opening_hours:
+        if opening_hours.strip() == '24/7':
+            return 0, 1440 * 2
+        match = re.search(r'(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})', opening_hours)
+        if match:
+            start = int(match.group(1)) * 60 + int(match.group(2))
+            end = int(match.group(3)) * 60 + int(match.group(4))
+            return start, end if end > start else end + 1440
+    return default[0], default[1]
+
+
+def make_stop(name, lat, lon, category="", opening_hours=None, dwell=None, source=""):
+    opens, closes = opening_window(opening_hours, category)
+    return {
+        'name': name,
+        'lat': lat,
+        'lon': lon,
+        'category': category,
+        'opens': opens,
+        'closes': closes,
+        'dwell': dwell or CATEGORY_DEFAULTS.get(category, DEFAULT_WINDOW)[2],
+        'source': source,
+    }
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * 6371 * math.asin(math.sqrt(a))
+
+
+def travel_minutes(a, b):
+    km = haversine_km(a['lat'], a['lon'], b['lat'], b['lon']) * DETOUR_FACTOR
+    if km <= WALK_LIMIT_KM:
+        return km / WALKING_KMH * 60
+    return km / CITY_KMH * 60 + TRANSFER_MINUTES
+
+
+def build_matrix(stops):
+    """Travel minutes between every pair of stops"""
+    n = len(stops)
+    matrix = [[0.0] * n for _ in range(n)]
+    for i in range(n):
+        for j in range(i + 1, n):
+            matrix[i][j] = matrix[j][i] = travel_minutes(stops[i], stops[j])
+    return matrix
+
+
+def schedule(order, stops, matrix, start, end):
+    """Visit stops in order, skipping those that cannot be fitted; returns (cost, visits)"""
+    clock = start
+    previous = None
+    visits = []
+    cost = 0.0
+    for index in order:
+        stop = stops[index]
+        travel = matrix[previous][index] if previous is not None else 0.0
+        arrive = clock + travel
+        begin = max(arrive, stop['opens'])
+        leave = begin + stop['dwell']
+        if leave > min(stop['closes'], end):
+            cost += MISSED_STOP_COST
+            continue
+        visits.append({'index': index, 'arrive': arrive, 'begin': begin, 'leave': leave, 'travel': travel})
+        cost += travel + (begin - arrive)
+        clock = leave
+        previous = index
+    return cost, visits
+
+
+def nearest_neighbour(stops, matrix, start, end):
+    """Greedy tour: always go to the stop that can be started soonest"""
+    remaining = set(range(len(stops)))
+    order = []
+    clock = start
+    previous = None
+    while remaining:
+        best, best_begin = None, None
+        for index in remaining:
+            stop = stops[index]
+            arrive = clock + (matrix[previous][index] if previous is not None else 0.0)
+            begin = max(arrive, stop['opens'])
+            if begin + stop['dwell'] > min(stop['closes'], end):
+                continue
+            if best is None or begin < best_begin:
+                best, best_begin = index, begin
+        if best is None:
+            break
+        order.append(best)
+        remaining.discard(best)
+        clock = best_begin + stops[best]['dwell']
+        previous = best
+    # Stops that never fit still go at the end so 2-opt may find them a place
+    return order + sorted(remaining, key=lambda index: stops[index]['opens'])
+
+
+def two_opt(order, stops, matrix, start, end, deadline=None):
+    """Reverse segments while that lowers the schedule cost, until no move helps or time runs out"""
+    best_cost = schedule(order, stops, matrix, start, end)[0]
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(order) - 1):
+            for j in range(i + 1, len(order)):
+                candidate = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+                cost = schedule(candidate, stops, matrix, start, end)[0]
+                if cost < best_cost - 1e-9:
+                    order, best_cost = candidate, cost
+                    improved = True
+            if deadline and time.perf_counter() > deadline:
+                return order
+    return order
+
+
+def plan_route(stops, time_slot="", max_seconds=0.5, matrix=None):
+    """Order candidate stops for a time slot.
+
+    Returns the visits in order (stop, arrival, start and end minutes, travel minutes from
+    the previous stop), the names of stops that did not fit, and the total travel time.
+    """
+    start, end = time_window(time_slot)
+    if matrix is None:
+        matrix = build_matrix(stops)
+    order = nearest_neighbour(stops, matrix, start, end)
+    order = two_opt(order, stops, matrix, start, end, time.perf_counter() + max_seconds)
+    _, visits = schedule(order, stops, matrix, start, end)
+    visited = {visit['index'] for visit in visits}
+    for visit in visits:
+        visit['stop'] = stops[visit['index']]
+    return {
+        'start': start,
+        'end': end,
+        'visits': visits,
+        'dropped': [stop['name'] for index, stop in enumerate(stops) if index not in visited],
+        'travel_minutes': sum(visit['travel'] for visit in visits),
+    }
+
+
+def format_clock(minutes):
+    minutes = int(round(minutes)) % 1440
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def describe_route(route):
+    """One line per visit, for the itinerary prompt"""
+    lines = []
+    for number, visit in enumerate(route['visits'], 1):
+        stop = visit['stop']
+        line = f"{number}. {format_clock(visit['begin'])}-{format_clock(visit['leave'])} {stop['name']}"
+        details = [stop['category'].replace('_', ' ')] if stop['category'] else []
+        if stop['source'] == 'bookmark':
+            details.append("bookmarked")
+        if number > 1:
+            details.append(f"{visit['travel']:.0f} min from the previous stop")
+        if details:
+            line += f" ({', '.join(details)})"
+        lines.append(line)
+    return lines
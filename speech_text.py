@@ -0,0 +1,138 @@
+"""Text preparation for text-to-speech.
+
+Replies are written for the chat window, with markdown emphasis, headings, bullet lists,
+links, tables and the odd emoji. strip_markdown() turns them into plain sentences that read
+well aloud, and chunk_text() splits the result at sentence boundaries into pieces that can be
+synthesized concurrently and joined in order, so the time to audio follows the longest chunk
+rather than the whole reply.
+This module has no dependency on app.py.
+"""
+import re
+
+# Abbreviations whose full stop does not end a sentence
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "st", "mt", "ft", "jr", "sr", "vs", "etc", "eg", "ie", "approx", "no", "rd", "ave"}
+
+EMOJI = re.compile(
+    "[\U0001F000-\U0001FAFF\U00002600-\U000027BF\U0001F1E6-\U0001F1FF\U00002B00-\U00002BFF\uFE0F\u200D]"
+)
+TERMINAL = ".!?:;।。！？"
+# "09:00-10:30", "10am-2pm", "9-5pm"; a clock needs a colon or am/pm on at least one side, so
+# dates ("2024-05-01") and phone numbers ("98-76543210") are left alone
+TIME_RANGE = re.compile(
+    r"(?<![\d:.\-–])(\d{1,2}(?::\d{2})?(?:\s?[ap]m\b)?)\s*[-–]\s*(\d{1,2}(?::\d{2})?(?:\s?[ap]m\b)?)(?![\d:\-–])",
+    re.I
+)
+# Sentence ends: Latin and Devanagari (।) marks are followed by a space; CJK marks need none
+SENTENCE_END = re.compile(r"[.!?…।]+[\"')\]]*(?=\s|$)|[。！？]+[」』\"')\]]*")
+
+
+def _time_range(match):
+    if not re.search(r":|[ap]m", match.group(0), re.I):
+        return match.group(0)
+    return f"{match.group(1)} to {match.group(2)}"
+
+
+def _end_sentence(line):
+    line = line.rstrip()
+    return line if not line or line[-1] in TERMINAL + "," else line + "."
+
+
+def strip_markdown(text):
+    """Plain spoken text: no markdown syntax, URLs or emojis; headings and list items become sentences"""
+    text = (text or "").replace("\r\n", "\n")
+    text = re.sub(r"```[a-zA-Z0-9_-]*\n?(.*?)```", r"\1", text, flags=re.S)
+    text = re.sub(r"`([^`]*)`", r"\1", text)
+    text = re.sub(r"!\[([^\]]*)\]\([^)]*\)", r"\1", text)
+    text = re.sub(r"\[([^\]]+)\]\([^)]*\)", r"\1", text)
+    text = re.sub(r"<?https?://\S+>?", "", text)
+    text = EMOJI.sub("", text)
+
+    lines = []
+    for line in text.split("\n"):
+        line = line.strip()
+        if re.fullmatch(r"[-*_=\s|:]{3,}", line):
+            # Horizontal rules and table separator rows
+            continue
+        line = re.sub(r"^#{1,6}\s*", "", line)
+        line = re.sub(r"^>\s?", "", line)
+        line = re.sub(r"^(?:[-*+•]|\d{1,2}[.)])\s+", "", line)
+        if line.startswith("|") or line.count("|") >= 2:
+            line = ", ".join(cell.strip() for cell in line.strip("|").split("|") if cell.strip())
+        line = re.sub(r"(\*\*|__|~~)(.+?)\1", r"\2", line)
+        line = re.sub(r"(?<![\w*])[*_](?!\s)(.+?)(?<!\s)[*_](?![\w*])", r"\1", line)
+        line = line.replace("*", "")
+        # "09:00-10:30" reads as "09:00 to 10:30"
+        line = TIME_RANGE.sub(_time_range, line)
+        lines.append(line)
+
+    paragraphs = []
+    current = []
+    for line in lines:
+        if not line:
+            if current:
+                paragraphs.append(" ".join(current))
+                current = []
+            continue
+        current.append(_end_sentence(line))
+    if current:
+        paragraphs.append(" ".join(current))
+    spoken = "\n\n".join(paragraphs)
+    spoken = re.sub(r"[ \t]+", " ", spoken)
+    spoken = re.sub(r"\s+([.,!?;:])", r"\1", spoken)
+    spoken = re.sub(r"([.!?])\.+", r"\1", spoken)
+    return spoken.strip()
+
+
+def split_sentences(text):
+    """Sentences of text, keeping their punctuation"""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        words = text[start:match.start()].split()
+        last_word = words[-1].lower().strip("(\"'") if words else ""
+        if match.group().startswith(".") and (last_word in ABBREVIATIONS or re.fullmatch(r"[a-z]", last_word)):
+            continue
+        sentence = text[start:match.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+    rest = text[start:].strip()
+    if rest:
+        sentences.append(rest)
+    return sentences
+
+
+def _split_long(sentence, max_chars):
+    """Break a sentence longer than max_chars at commas, then at spaces"""
+    pieces = []
+    while len(sentence) > max_chars:
+        cut = sentence.rfind(", ", 0, max_chars)
+        if cut < max_chars // 3:
+            cut = sentence.rfind(" ", 0, max_chars)
+        if cut <= 0:
+            # No space to break at (a long word, or CJK text): hard cut at the limit
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:].strip()
+            continue
+        pieces.append(sentence[:cut + 1].strip())
+        sentence = sentence[cut + 1:].strip()
+    if sentence:
+        pieces.append(sentence)
+    return pieces
+
+
+def chunk_text(text, max_chars=400):
+    """Pack whole sentences into chunks of at most max_chars (a longer sentence is split on its own)"""
+    chunks = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        for sentence in split_sentences(paragraph):
+            for piece in _split_long(sentence, max_chars):
+                if current and len(current) + 1 + len(piece) > max_chars:
+                    chunks.append(current)
+                    current = piece
+                else:
+                    current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
@@ -0,0 +1,228 @@
+"""Local vector index for per-user similarity lookups.
+
+Texts (likes, bookmarks, story themes, candidate places) are embedded on the CPU, either
+with a small sentence-embedding model through transformers or, when that cannot be loaded,
+with a hashed bag of words and character trigrams. Vectors are L2-normalised, so the inner
+product is the cosine similarity. VectorIndex searches with a brute-force NumPy matrix
+product; the optional hnswlib backend is used for large indexes when it is installed.
+"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class HashingEmbedder:
+    """Dependency-free embedding: hashed words and character trigrams"""
+
+    name = "hashing"
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def _features(self, text):
+        words = re.findall(r'[a-z0-9]+', (text or "").lower())
+        for word in words:
+            yield word, 1.0
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.5
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                sign = 1.0 if digest[4] & 1 else -1.0
+                vectors[row, bucket] += sign * weight
+        return normalize_rows(vectors)
+
+
+class TransformerEmbedder:
+    """Mean-pooled sentence embeddings from a small transformers model (e.g. all-MiniLM-L6-v2)"""
+
+    def __init__(self, model_name, batch_size=32):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        self.name = model_name
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name)
+        self.model.eval()
+        self.batch_size = batch_size
+        self.dim = self.model.config.hidden_size
+        self.lock = threading.Lock()
+
+    def embed(self, texts):
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        batches = []
+        with self.lock, self.torch.no_grad():
+            for start in range(0, len(texts), self.batch_size):
+                batch = self.tokenizer(list(texts[start:start + self.batch_size]), padding=True,
+                                       truncation=True, max_length=64, return_tensors="pt")
+                output = self.model(**batch).last_hidden_state
+                mask = batch["attention_mask"].unsqueeze(-1).to(output.dtype)
+                pooled = (output * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+                batches.append(pooled.numpy())
+        return normalize_rows(np.concatenate(batches))
+
+
+class CachedEmbedder:
+    """Memoizes vectors per text so per-user indexes can be rebuilt cheaply after profile changes"""
+
+    def __init__(self, embedder, max_size=20000):
+        self.embedder = embedder
+        self.name = embedder.name
+        self.dim = embedder.dim
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.vectors = OrderedDict()
+
+    def embed(self, texts):
+        with self.lock:
+            missing = list(dict.fromkeys(text for text in texts if text not in self.vectors))
+        if missing:
+            computed = self.embedder.embed(missing)
+            with self.lock:
+                for text, vector in zip(missing, computed):
+                    self.vectors[text] = vector
+                while len(self.vectors) > self.max_size:
+                    self.vectors.popitem(last=False)
+        with self.lock:
+            rows = []
+            for text in texts:
+                vector = self.vectors.get(text)
+                if vector is None:
+                    # Evicted by a concurrent caller between the two steps
+                    vector = self.embedder.embed([text])[0]
+                else:
+                    self.vectors.move_to_end(text)
+                rows.append(vector)
+        return np.stack(rows) if rows else np.zeros((0, self.dim), dtype=np.float32)
+
+
+def create_embedder(model_name="hashing", cache_size=20000):
+    """The named transformers model, falling back to HashingEmbedder if it cannot be loaded"""
+    embedder = None
+    if model_name and model_name != "hashing":
+        try:
+            embedder = TransformerEmbedder(model_name)
+        except Exception as e:
+            print(f"Embedding model {model_name} unavailable, using hashed features: {e}")
+    return CachedEmbedder(embedder or HashingEmbedder(), cache_size)
+
+
+class VectorIndex:
+    """Normalised vectors with an item dict each; search by inner product with optional filters.
+
+    `embedder` records what produced the vectors, so queries can be embedded the same way.
+    """
+
+    def __init__(self, dim, backend="numpy", ann_threshold=5000, embedder=None):
+        self.dim = dim
+        self.embedder = embedder
+        self.backend = backend
+        self.ann_threshold = ann_threshold
+        self.vectors = np.zeros((16, dim), dtype=np.float32)
+        self.items = []
+        self.ann = None
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def nbytes(self):
+        size = self.vectors[:len(self.items)].nbytes
+        if self.ann is not None:
+            # hnswlib keeps its own copy plus roughly 2*M links per element
+            size += len(self.items) * (self.dim * 4 + 2 * 16 * 4)
+        return size
+
+    def add(self, vectors, items):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        count = len(self.items)
+        needed = count + len(vectors)
+        if needed > len(self.vectors):
+            grown = np.zeros((max(needed, 2 * len(self.vectors)), self.dim), dtype=np.float32)
+            grown[:count] = self.vectors[:count]
+            self.vectors = grown
+        self.vectors[count:needed] = vectors
+        self.items.extend(items)
+        if self.ann is not None:
+            self._ann_add(vectors, range(count, needed))
+        elif self.backend == "hnsw" and needed >= self.ann_threshold:
+            self._build_ann()
+
+    def _build_ann(self):
+        try:
+            import hnswlib
+        except ImportError:
+            self.backend = "numpy"
+            return
+        self.ann = hnswlib.Index(space="ip", dim=self.dim)
+        self.ann.init_index(max_elements=max(2 * len(self.items), 1024), ef_construction=200, M=16)
+        self.ann.set_ef(64)
+        self._ann_add(self.vectors[:len(self.items)], range(len(self.items)))
+
+    def _ann_add(self, vectors, ids):
+        ids = list(ids)
+        if ids[-1] >= self.ann.get_max_elements():
+            self.ann.resize_index(2 * (ids[-1] + 1))
+        self.ann.add_items(vectors, ids)
+
+    def vectors_where(self, where):
+        rows = [i for i, item in enumerate(self.items) if where(item)]
+        return self.vectors[rows] if rows else np.zeros((0, self.dim), dtype=np.float32)
+
+    def search(self, query, k=5, where=None):
+        """Up to k (score, item) pairs, best first, among items accepted by `where`"""
+        count = len(self.items)
+        if count == 0 or k <= 0:
+            return []
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        if self.ann is not None:
+            labels, distances = self.ann.knn_query(query, k=min(count, k * 4 if where else k))
+            hits = [(1.0 - float(d), int(i)) for i, d in zip(labels[0], distances[0])]
+            results = [(score, self.items[i]) for score, i in hits if where is None or where(self.items[i])]
+            if len(results) >= k or where is None:
+                return results[:k]
+        if where is None:
+            candidates = np.arange(count)
+            scores = self.vectors[:count] @ query
+        else:
+            candidates = np.array([i for i, item in enumerate(self.items) if where(item)], dtype=np.int64)
+            if len(candidates) == 0:
+                return []
+            scores = self.vectors[candidates] @ query
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.items[int(candidates[i])]) for i in top]
+
+
+def rank_candidates(query, candidates, liked=None, disliked=None, dislike_weight=0.5):
+    """Candidate positions ordered by similarity to the request blended with the user's likes.
+
+    query is one vector, candidates/liked/disliked are row matrices. A candidate close to any
+    dislike is pushed down by dislike_weight times that similarity.
+    """
+    if len(candidates) == 0:
+        return []
+    taste = np.asarray(query, dtype=np.float32).reshape(-1)
+    if liked is not None and len(liked):
+        taste = taste + liked.mean(axis=0)
+        taste = taste / (np.linalg.norm(taste) or 1.0)
+    scores = candidates @ taste
+    if disliked is not None and len(disliked):
+        scores = scores - dislike_weight * np.clip((candidates @ disliked.T).max(axis=1), 0, None)
+    return [int(i) for i in np.argsort(-scores)]